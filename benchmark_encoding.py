@@ -0,0 +1,112 @@
+# מדידת קצב קידוד המקטעים לפי מספר הליבות (מספר תהליכי ffmpeg במקביל).
+#
+#   python -m benchmark_encoding --minutes 60
+#   python -m benchmark_encoding --audio lesson.mp3 --workers 1,2,4,8 --output encode_bench.json
+#
+# לכל מספר תהליכים נחתך אותו קובץ לאותם מקטעים, ומודפסים זמן הקידוד, שניות אודיו לשנייה והאצה ביחס לתהליך אחד.
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def default_worker_counts():
+    """חזקות של 2 עד מספר הליבות, ומספר הליבות עצמו."""
+    cores = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+
+def create_synthetic_audio(path, minutes):
+    """קובץ MP3 סטריאו 44.1kHz 128kbps של רעש ורוד - עלות הפענוח והקידוד דומה להקלטה אמיתית."""
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"anoisesrc=d={minutes * 60}:c=pink:r=44100:a=0.1",
+        "-ac", "2", "-c:a", "libmp3lame", "-b:a", "128k",
+        path
+    ], check=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="מדידת קצב קידוד המקטעים לפי מספר תהליכים במקביל")
+    parser.add_argument("--audio", help="קובץ אודיו למדידה (ברירת מחדל: קובץ סינתטי)")
+    parser.add_argument("--minutes", type=int, default=30, help="אורך הקובץ הסינתטי בדקות")
+    parser.add_argument("--segment-length", type=int, default=5, help="אורך מקטע בדקות")
+    parser.add_argument("--profile", default="speech_mp3", help="פרופיל הקידוד (כמו בממשק)")
+    parser.add_argument("--workers", help="רשימת מספרי תהליכים מופרדים בפסיקים (ברירת מחדל: עד מספר הליבות)")
+    parser.add_argument("--output", help="שמירת התוצאות כ-JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    worker_counts = [int(n) for n in args.workers.split(",")] if args.workers else default_worker_counts()
+
+    # המגבלה המשותפת על תהליכי הקידוד נקראת בעת טעינת הצינור, ולכן נקבעת לפני הייבוא
+    os.environ["SEGMENT_ENCODE_WORKERS"] = str(max(worker_counts))
+    import transcription_pipeline as pipeline
+
+    work_dir = tempfile.mkdtemp(prefix="encode_bench_")
+    try:
+        audio_path = args.audio
+        if not audio_path:
+            audio_path = os.path.join(work_dir, "synthetic.mp3")
+            print(f"יוצר קובץ סינתטי של {args.minutes} דקות...", flush=True)
+            create_synthetic_audio(audio_path, args.minutes)
+
+        total_ms = pipeline.probe_audio_duration_ms(audio_path)
+        bounds = pipeline.fixed_segment_bounds(total_ms, args.segment_length * 60 * 1000, 0)
+        extension = pipeline.ENCODING_PROFILES[args.profile]["extension"]
+
+        results = []
+        for workers in worker_counts:
+            run_dir = os.path.join(work_dir, f"workers_{workers}")
+            os.makedirs(run_dir)
+
+            def encode(i):
+                start_ms, end_ms, _ = bounds[i]
+                output_path = os.path.join(run_dir, f"segment_{i:03d}.{extension}")
+                pipeline.cut_audio_segment(audio_path, output_path, start_ms, end_ms, args.profile)
+                return os.path.getsize(output_path)
+
+            started = time.monotonic()
+            sizes = list(pipeline.ordered_parallel_map(encode, range(len(bounds)), workers=workers))
+            seconds = time.monotonic() - started
+            shutil.rmtree(run_dir)
+
+            results.append({
+                "workers": workers,
+                "seconds": round(seconds, 2),
+                "audio_seconds_per_second": round(total_ms / 1000 / seconds, 1),
+                "speedup": round(results[0]["seconds"] / seconds, 2) if results else 1.0,
+                "output_bytes": sum(sizes)
+            })
+            print(f"{workers:3d} תהליכים: {seconds:7.2f} שניות, {results[-1]['audio_seconds_per_second']:8.1f} "
+                  f"שניות אודיו לשנייה, האצה x{results[-1]['speedup']}", flush=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "cpu_count": os.cpu_count(),
+        "audio": args.audio or f"synthetic {args.minutes} min",
+        "audio_seconds": total_ms / 1000,
+        "segments": len(bounds),
+        "profile": args.profile,
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
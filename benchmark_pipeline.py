@@ -0,0 +1,277 @@
+# מדידת הצינור המלא (process_audio) מול השרת המדומה, על אודיו סינתטי באורכים שונים.
+#
+#   python -m benchmark_pipeline                              # 10 דקות, שעה ו-3 שעות
+#   python -m benchmark_pipeline --durations 10m --latency lognormal:3,0.5 --rate-429 0.05
+#
+# כל תרחיש רץ בתהליך נפרד מול שרת מדומה בתהליך הראשי, כך שזיכרון השיא נמדד לצינור בלבד.
+# התוצאות (זמן כולל, זמן לכל שלב, זיכרון שיא, בתים שהועלו ומספר בקשות) נשמרות כ-JSON להשוואה בין גרסאות.
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # אין מודול resource ב-Windows - זיכרון השיא לא נמדד
+    resource = None
+
+from mock_gemini_server import add_config_arguments, config_from_args, start_mock_server
+
+DEFAULT_DURATIONS = "10m,1h,3h"
+
+# פונקציות הצינור שנמדדות כשלבים - שם השלב ושם הפונקציה במודול
+STAGE_FUNCTIONS = (
+    ("probe", "probe_audio_duration_ms"),
+    ("silence_analysis", "compute_energy_envelope"),
+    ("encode", "cut_audio_segment"),
+    ("upload", "upload_audio_file"),
+    ("transcribe", "transcribe_with_gemini"),
+    ("segments", "process_segments"),
+    ("stitch", "combine_transcriptions"),
+)
+
+
+def parse_duration(label):
+    """'90s', '10m' או '3h' לשניות."""
+    units = {"s": 1, "m": 60, "h": 3600}
+    return int(float(label[:-1]) * units[label[-1]]) if label[-1] in units else int(label)
+
+
+def create_speech_like_audio(path, seconds):
+    """MP3 מונו 64kbps של רעש ורוד בקטעים של כ-6 שניות עם הפסקות קצרות, כמו דיבור עם נשימות."""
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"anoisesrc=d={seconds}:c=pink:r=22050:a=0.2",
+        "-af", "volume='if(lt(mod(t,7),6.2),1,0.01)':eval=frame",
+        "-ac", "1", "-c:a", "libmp3lame", "-b:a", "64k",
+        path
+    ], check=True)
+
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # ב-Linux הערך בקילובייטים, ב-macOS בבתים
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class StageTimer:
+    """עוטף פונקציות ומודד לכל שלב מספר קריאות, זמן עבודה מצטבר וזמן מהתחלה ראשונה עד סיום אחרון."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+
+    def record(self, name, started, finished):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "busy_seconds": 0.0, "first": started, "last": finished})
+            stage["calls"] += 1
+            stage["busy_seconds"] += finished - started
+            stage["first"] = min(stage["first"], started)
+            stage["last"] = max(stage["last"], finished)
+
+    def wrap(self, name, function):
+        def timed(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, started, time.monotonic())
+        return timed
+
+    def report(self):
+        with self._lock:
+            return {
+                name: {
+                    "calls": stage["calls"],
+                    "busy_seconds": round(stage["busy_seconds"], 3),
+                    "wall_seconds": round(stage["last"] - stage["first"], 3)
+                }
+                for name, stage in self.stages.items()
+            }
+
+
+def request_kind(method, path, kwargs):
+    """סיווג קריאת HTTP של הצינור לצורך המדידה."""
+    if "upload" in path:
+        return "http_upload"
+    if "cachedContents" in path:
+        return "http_cache"
+    if ":streamGenerateContent" in path or ":generateContent" in path:
+        return "http_process" if "json" in kwargs else "http_transcribe"
+    return f"http_{method.lower()}"
+
+
+def run_scenario(args):
+    """הרצת תרחיש אחד בתהליך הנוכחי (נקרא מהתהליך הראשי) וכתיבת התוצאה לקובץ."""
+    os.chdir(args.scenario_dir)
+    os.environ["GEMINI_API_BASE"] = args.api_base
+    import transcription_pipeline as pipeline
+
+    timer = StageTimer()
+    for name, attribute in STAGE_FUNCTIONS:
+        setattr(pipeline, attribute, timer.wrap(name, getattr(pipeline, attribute)))
+
+    # זמן עד תחילת התשובה לכל סוג קריאת HTTP (בקריאות זרם - לא כולל קריאת הזרם עצמו)
+    client_request = pipeline.gemini_client.request
+
+    def timed_request(method, path, api_key=None, **kwargs):
+        started = time.monotonic()
+        try:
+            return client_request(method, path, api_key=api_key, **kwargs)
+        finally:
+            timer.record(request_kind(method, path, kwargs), started, time.monotonic())
+    pipeline.gemini_client.request = timed_request
+
+    class Collector(pipeline.ProgressListener):
+        def __init__(self):
+            self.counts = {}
+            self.errors = []
+
+        def message(self, level, message):
+            self.counts[level] = self.counts.get(level, 0) + 1
+            if level == "error":
+                self.errors.append(message)
+
+    listener = Collector()
+    project_ids = [f"bench-project-{n + 1}" for n in range(args.projects)]
+    api_keys = [f"bench-key-{n + 1}" for n in range(args.projects)]
+
+    started = time.monotonic()
+    result = pipeline.process_audio(
+        pipeline.LocalAudioFile(args.run_scenario), ",".join(api_keys), ",".join(project_ids), args.model,
+        args.segment_length, args.overlap, "", listener, listener,
+        max_workers=args.workers, encoding_profile=args.encoding_profile,
+        stream_output=args.stream, use_cache=False, silence_split=args.silence_split,
+        batch_processing=args.batch, context_cache=not args.no_context_cache
+    )
+    wall_seconds = time.monotonic() - started
+    pipeline.get_token_usage_manager().flush()
+
+    with open(args.result_file, "w", encoding="utf-8") as f:
+        json.dump({
+            "success": bool(result),
+            "wall_seconds": round(wall_seconds, 2),
+            "result_characters": len(result or ""),
+            "stages": timer.report(),
+            "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+            "peak_ffmpeg_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+            "client": pipeline.gemini_client.connection_stats(),
+            "messages": listener.counts,
+            "errors": listener.errors[-5:]
+        }, f, indent=2, ensure_ascii=False)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="מדידת הצינור המלא מול שרת Gemini מדומה")
+    parser.add_argument("--durations", default=DEFAULT_DURATIONS, help="אורכי האודיו, למשל 10m,1h,3h")
+    parser.add_argument("--audio-dir", default=os.path.join(tempfile.gettempdir(), "transcription_benchmark_audio"),
+                        help="תיקייה לקבצי האודיו הסינתטיים (נוצרים פעם אחת ונשמרים להרצות הבאות)")
+    parser.add_argument("--output", default="benchmark_pipeline.json", help="קובץ התוצאות")
+    parser.add_argument("--projects", type=int, default=2, help="מספר פרויקטים (מפתח מדומה לכל אחד)")
+    parser.add_argument("--model", default="gemini-2.0-flash")
+    parser.add_argument("--segment-length", type=int, default=25)
+    parser.add_argument("--overlap", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--encoding-profile", default="speech_mp3")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--batch", action="store_true")
+    parser.add_argument("--silence-split", action="store_true")
+    parser.add_argument("--no-context-cache", action="store_true")
+    add_config_arguments(parser)
+    # ארגומנטים פנימיים להרצת תרחיש בתהליך נפרד
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--scenario-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--api-base", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def scenario_command(args, audio_path, scenario_dir, api_base, result_file):
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--run-scenario", audio_path, "--scenario-dir", scenario_dir,
+        "--api-base", api_base, "--result-file", result_file,
+        "--projects", str(args.projects), "--model", args.model,
+        "--segment-length", str(args.segment_length), "--overlap", str(args.overlap),
+        "--workers", str(args.workers), "--encoding-profile", args.encoding_profile
+    ]
+    for flag in ("stream", "batch", "silence_split", "no_context_cache"):
+        if getattr(args, flag):
+            command.append(f"--{flag.replace('_', '-')}")
+    return command
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.run_scenario:
+        run_scenario(args)
+        return 0
+
+    config = config_from_args(args)
+    server = start_mock_server(config)
+    os.makedirs(args.audio_dir, exist_ok=True)
+
+    scenarios = []
+    for label in args.durations.split(","):
+        seconds = parse_duration(label)
+        audio_path = os.path.join(args.audio_dir, f"speech_like_{seconds}s.mp3")
+        if not os.path.exists(audio_path):
+            print(f"יוצר אודיו סינתטי של {label}...", flush=True)
+            create_speech_like_audio(audio_path, seconds)
+
+        server.state.reset_stats()
+        with tempfile.TemporaryDirectory(prefix="pipeline_bench_") as scenario_dir:
+            result_file = os.path.join(scenario_dir, "result.json")
+            print(f"מריץ תרחיש {label}...", flush=True)
+            completed = subprocess.run(scenario_command(args, audio_path, scenario_dir, server.base_url, result_file),
+                                       capture_output=True, text=True)
+            if completed.returncode != 0 or not os.path.exists(result_file):
+                print(completed.stderr[-2000:], file=sys.stderr)
+                scenarios.append({"duration": label, "success": False, "error": f"קוד יציאה {completed.returncode}"})
+                continue
+            with open(result_file, "r", encoding="utf-8") as f:
+                result = json.load(f)
+
+        mock_stats = server.state.snapshot()
+        scenario = {
+            "duration": label,
+            "audio_seconds": seconds,
+            "audio_bytes": os.path.getsize(audio_path),
+            **result,
+            "bytes_uploaded": mock_stats["bytes_received_total"],
+            "requests": mock_stats["requests"],
+            "requests_total": mock_stats["requests_total"],
+            "status_codes": mock_stats["status_codes"],
+            "mock": mock_stats
+        }
+        scenarios.append(scenario)
+        print(f"  {label}: {scenario['wall_seconds']} שניות, "
+              f"{scenario['bytes_uploaded'] / 1024 / 1024:.1f}MB הועלו, {scenario['requests_total']} בקשות, "
+              f"זיכרון שיא {scenario['peak_rss_mb']}MB, {'הצליח' if scenario['success'] else 'נכשל'}", flush=True)
+
+    report = {
+        "generated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "machine": {"cpu_count": os.cpu_count(), "platform": platform.platform(),
+                    "python": platform.python_version()},
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("run_scenario", "scenario_dir", "api_base", "result_file")},
+        "scenarios": scenarios
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"התוצאות נשמרו ב-{args.output}", flush=True)
+    server.shutdown()
+    return 0 if all(scenario["success"] for scenario in scenarios) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
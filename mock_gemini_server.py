@@ -0,0 +1,501 @@
+# שרת Gemini מקומי למדידות ובדיקות ללא צריכת מכסה אמיתית.
+#
+#   python -m mock_gemini_server --port 8765 --latency lognormal:2,0.5 --rate-429 0.05
+#   GEMINI_API_BASE=http://127.0.0.1:8765 streamlit run streamlit-transcription-app.py
+#
+# תומך ב-generateContent, ב-streamGenerateContent (SSE), בהעלאה מתחדשת של קבצים ובהוראות שמורות
+# (cachedContents). התשובות הן טקסט עברי קבוע באורך שתלוי במשך האודיו, עם usageMetadata, והשרת
+# יכול להשהות תשובות לפי התפלגות, להחזיר 429/5xx באקראי ולדמות מכסת בקשות לדקה וטוקנים ליום לכל מפתח.
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# אוצר מילים לתשובות הקבועות - טקסט בסגנון שיעור תורה
+CANNED_WORDS = (
+    "הרב אמר שהגמרא במסכת ברכות דנה בשאלה מתי קוראים את שמע בערבית ורבי אליעזר סובר שזמנה "
+    "משעה שהכהנים נכנסים לאכול בתרומתם וחכמים אומרים עד חצות ורבן גמליאל אומר עד שיעלה עמוד השחר "
+    "והרמבם פוסק כחכמים אבל מוסיף שאם עבר ואיחר יצא ידי חובתו והשולחן ערוך מביא את דבריו "
+    "ויש לשאול מה הטעם של הגזירה ומתי אמרו חכמים לעשות סייג לתורה כדי להרחיק את האדם מן העבירה "
+    "והתוספות מקשים על רשי מהסוגיה בפסחים ומתרצים שיש לחלק בין מצווה דאורייתא למצווה דרבנן "
+    "הפסוק אומר ושיננתם לבניך ודברת בם בשבתך בביתך ובלכתך בדרך ובשכבך ובקומך ומכאן לומדים "
+    "שאלה מהקהל האם הדין הזה נוהג גם בזמן הזה והרב משיב שרוב הפוסקים סוברים שכן ובלבד "
+    "שיזהר לכוון את ליבו וזה יסוד גדול בעבודת השם כפי שכתב הרמחל במסילת ישרים"
+).split()
+
+# קצב הנתונים המשוער של האודיו לפי סוג הקובץ, לחישוב משך האודיו מגודל הבקשה
+AUDIO_BYTES_PER_SECOND = {"audio/ogg": 3000, "audio/mp3": 4000, "audio/mpeg": 4000}
+DEFAULT_AUDIO_BYTES_PER_SECOND = 4000
+
+# טוקנים לשנייה של אודיו, כמו בחיוב של Gemini
+AUDIO_TOKENS_PER_SECOND = 32
+
+BATCH_SECTION = re.compile(r"<<<מקטע (\d+)>>>\n(.*?)\n<<<סוף מקטע \1>>>", re.DOTALL)
+RAW_TEXT_MARKER = "טקסט גולמי לעיבוד:\n"
+
+
+@dataclass
+class MockGeminiConfig:
+    """הגדרות השרת המדומה; 0 בשיעורי השגיאות ובמכסות פירושו ללא הגבלה."""
+    latency: str = "lognormal:1.0,0.4"
+    stream_chunk_chars: int = 200
+    stream_chunk_delay: float = 0.02
+    rate_429: float = 0.0
+    rate_5xx: float = 0.0
+    requests_per_minute: int = 0
+    tokens_per_day: int = 0
+    min_cache_tokens: int = 0
+    chars_per_audio_second: float = 12.0
+    max_output_chars: int = 30000
+    seed: int = None
+
+
+def latency_sampler(spec, rng):
+    """פענוח התפלגות השהייה: fixed:S, uniform:A,B, exponential:MEAN או lognormal:MEDIAN,SIGMA (בשניות)."""
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == "exponential":
+        return lambda: rng.expovariate(1 / values[0]) if values[0] else 0.0
+    if kind == "lognormal":
+        return lambda: rng.lognormvariate(math.log(values[0]), values[1]) if values[0] else 0.0
+    raise ValueError(f"התפלגות השהייה לא מוכרת: {spec}")
+
+
+def canned_hebrew_text(length, seed):
+    """טקסט עברי קבוע באורך המבוקש; אותו seed מחזיר תמיד אותו טקסט, ו-seed שונה טקסט שונה."""
+    rng = random.Random(seed)
+    words = []
+    size = 0
+    sentence_length = 0
+    while size < length:
+        word = rng.choice(CANNED_WORDS)
+        sentence_length += 1
+        if sentence_length >= rng.randint(8, 16):
+            word += "."
+            sentence_length = 0
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+
+class MockGeminiState:
+    """המצב המשותף של השרת: קבצים, העלאות, הוראות שמורות, מכסות וסטטיסטיקה."""
+
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.sample_latency = latency_sampler(config.latency, self.rng)
+        self._lock = threading.Lock()
+        self.files = {}
+        self.uploads = {}
+        self.caches = {}
+        self._minute_windows = {}
+        self._daily_tokens = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {
+                "requests": {},
+                "status_codes": {},
+                "bytes_received": {},
+                "injected_errors": 0,
+                "quota_rejections": 0,
+                "latency_seconds": 0.0
+            }
+
+    def count(self, kind, status_code, bytes_received=0):
+        with self._lock:
+            self.stats["requests"][kind] = self.stats["requests"].get(kind, 0) + 1
+            code = str(status_code)
+            self.stats["status_codes"][code] = self.stats["status_codes"].get(code, 0) + 1
+            self.stats["bytes_received"][kind] = self.stats["bytes_received"].get(kind, 0) + bytes_received
+
+    def snapshot(self):
+        with self._lock:
+            stats = json.loads(json.dumps(self.stats))
+        stats["bytes_received_total"] = sum(stats["bytes_received"].values())
+        stats["requests_total"] = sum(stats["requests"].values())
+        return stats
+
+    def check_quota(self, api_key):
+        """מחזיר (הודעה, שניות המתנה) אם הבקשה חורגת מהמכסה המדומה, אחרת None."""
+        now = time.monotonic()
+        with self._lock:
+            if self.config.tokens_per_day and self._daily_tokens.get(api_key, 0) >= self.config.tokens_per_day:
+                self.stats["quota_rejections"] += 1
+                return "Quota exceeded for metric: generate_content_tokens_per_day", None
+            if self.config.requests_per_minute:
+                window = self._minute_windows.setdefault(api_key, deque())
+                while window and now - window[0] >= 60:
+                    window.popleft()
+                if len(window) >= self.config.requests_per_minute:
+                    self.stats["quota_rejections"] += 1
+                    return "Quota exceeded for metric: generate_content_requests_per_minute", 60 - (now - window[0])
+                window.append(now)
+        return None
+
+    def next_latency(self):
+        with self._lock:
+            latency = self.sample_latency()
+            self.stats["latency_seconds"] += latency
+        return latency
+
+    def record_tokens(self, api_key, tokens):
+        with self._lock:
+            self._daily_tokens[api_key] = self._daily_tokens.get(api_key, 0) + tokens
+
+    def injected_error(self):
+        """שגיאה אקראית לפי השיעורים שהוגדרו: (קוד, הודעה) או None."""
+        with self._lock:
+            draw = self.rng.random()
+            if draw < self.config.rate_429:
+                self.stats["injected_errors"] += 1
+                return 429, "Resource has been exhausted (e.g. check quota)."
+            if draw < self.config.rate_429 + self.config.rate_5xx:
+                self.stats["injected_errors"] += 1
+                return self.rng.choice(((500, "Internal error encountered."),
+                                        (503, "The model is overloaded. Please try again later.")))
+        return None
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _read_body(self):
+        """קריאת גוף הבקשה - לפי Content-Length או בקידוד chunked."""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().strip().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status_code, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status_code, message, retry_seconds=None):
+        status_names = {429: "RESOURCE_EXHAUSTED", 404: "NOT_FOUND", 403: "PERMISSION_DENIED", 400: "INVALID_ARGUMENT"}
+        error = {"code": status_code, "message": message, "status": status_names.get(status_code, "UNAVAILABLE")}
+        if retry_seconds is not None:
+            error["details"] = [{"@type": "type.googleapis.com/google.rpc.RetryInfo",
+                                 "retryDelay": f"{max(retry_seconds, 0):.0f}s"}]
+        self._send_json(status_code, {"error": error})
+
+    def _base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/stats":
+            return self._send_json(200, self.state.snapshot())
+        match = re.fullmatch(r"/v1beta/(files/[\w-]+)", url.path)
+        if match and match.group(1) in self.state.files:
+            self.state.count("file_get", 200)
+            return self._send_json(200, self.state.files[match.group(1)])
+        self.state.count("other", 404)
+        self._send_error(404, f"Not found: {url.path}")
+
+    def do_DELETE(self):
+        url = urlsplit(self.path)
+        name = url.path.replace("/v1beta/", "", 1)
+        if self.state.files.pop(name, None) is not None:
+            self.state.count("file_delete", 200)
+            return self._send_json(200, {})
+        if self.state.caches.pop(name, None) is not None:
+            self.state.count("cache_delete", 200)
+            return self._send_json(200, {})
+        self.state.count("cache_delete", 404)
+        self._send_error(404, f"CachedContent not found: {name}")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        body = self._read_body()
+
+        if url.path == "/upload/v1beta/files":
+            return self._handle_upload(query, body)
+        if url.path == "/v1beta/cachedContents":
+            return self._handle_cache_create(body)
+        match = re.fullmatch(r"/v1beta/models/([\w.-]+):(generateContent|streamGenerateContent)", url.path)
+        if match:
+            return self._handle_generate(query.get("key", [""])[0], body, match.group(2) == "streamGenerateContent")
+        self.state.count("other", 404, len(body))
+        self._send_error(404, f"Not found: {url.path}")
+
+    def _handle_upload(self, query, body):
+        """העלאה מתחדשת: start, upload, upload+finalize ו-query, כמו ב-Files API."""
+        command = self.headers.get("X-Goog-Upload-Command", "")
+        state = self.state
+
+        if command == "start":
+            upload_id = uuid.uuid4().hex
+            state.uploads[upload_id] = {
+                "received": 0,
+                "size": int(self.headers.get("X-Goog-Upload-Header-Content-Length") or 0),
+                "mime_type": self.headers.get("X-Goog-Upload-Header-Content-Type", "audio/mp3")
+            }
+            state.count("upload_start", 200, len(body))
+            return self._send_json(200, {}, headers={
+                "X-Goog-Upload-URL": f"{self._base_url()}/upload/v1beta/files?upload_id={upload_id}",
+                "X-Goog-Upload-Status": "active"
+            })
+
+        upload_id = query.get("upload_id", [""])[0]
+        upload = state.uploads.get(upload_id)
+        if upload is None:
+            state.count("upload", 404, len(body))
+            return self._send_error(404, "Upload not found")
+
+        if command == "query":
+            state.count("upload_query", 200)
+            if "file" in upload:
+                # העלאה שכבר הסתיימה - התשובה נושאת את הקובץ שנוצר
+                return self._send_json(200, {"file": state.files.get(upload["file"])}, headers={
+                    "X-Goog-Upload-Status": "final",
+                    "X-Goog-Upload-Size-Received": str(upload["received"])
+                })
+            return self._send_json(200, {}, headers={
+                "X-Goog-Upload-Status": "active",
+                "X-Goog-Upload-Size-Received": str(upload["received"])
+            })
+        if "file" in upload:
+            state.count("upload", 400, len(body))
+            return self._send_error(400, "Upload has already been finalized")
+
+        offset = int(self.headers.get("X-Goog-Upload-Offset") or 0)
+        if offset != upload["received"]:
+            state.count("upload", 400, len(body))
+            return self._send_error(400, f"Invalid upload offset {offset}, expected {upload['received']}")
+        upload["received"] += len(body)
+        state.count("upload", 200, len(body))
+
+        if "finalize" not in command:
+            return self._send_json(200, {}, headers={"X-Goog-Upload-Status": "active"})
+
+        name = f"files/{upload_id[:12]}"
+        upload["file"] = name
+        state.files[name] = {
+            "name": name,
+            "uri": f"{self._base_url()}/v1beta/{name}",
+            "mimeType": upload["mime_type"],
+            "sizeBytes": str(upload["received"]),
+            "state": "ACTIVE"
+        }
+        self._send_json(200, {"file": state.files[name]}, headers={"X-Goog-Upload-Status": "final"})
+
+    def _handle_cache_create(self, body):
+        request = json.loads(body)
+        instructions = "".join(part.get("text", "") for part in
+                               request.get("systemInstruction", {}).get("parts", []))
+        tokens = len(instructions) // 3
+        if tokens < self.state.config.min_cache_tokens:
+            self.state.count("cache_create", 400, len(body))
+            return self._send_error(400, f"Cached content is too small. total_token_count={tokens}, "
+                                         f"min_total_token_count={self.state.config.min_cache_tokens}")
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        self.state.caches[name] = {"tokens": tokens}
+        self.state.count("cache_create", 200, len(body))
+        self._send_json(200, {"name": name, "model": request.get("model"),
+                              "usageMetadata": {"totalTokenCount": tokens}})
+
+    def _parse_generate_request(self, request):
+        """פירוק הבקשה לטקסט הפרומפט ולגודל/סוג האודיו (מוטבע או כהפניה לקובץ שהועלה)."""
+        prompt = ""
+        audio_bytes = 0
+        mime_type = None
+        for content in request.get("contents", []):
+            for part in content.get("parts", []):
+                inline = part.get("inline_data") or part.get("inlineData")
+                file_data = part.get("file_data") or part.get("fileData")
+                if "text" in part:
+                    prompt += part["text"]
+                elif inline:
+                    audio_bytes += len(inline.get("data", "")) * 3 // 4
+                    mime_type = inline.get("mime_type") or inline.get("mimeType")
+                elif file_data:
+                    uri = file_data.get("file_uri") or file_data.get("fileUri", "")
+                    info = self.state.files.get(uri.split("/v1beta/")[-1])
+                    if info is None:
+                        raise KeyError(uri)
+                    audio_bytes += int(info["sizeBytes"])
+                    mime_type = info["mimeType"]
+        return prompt, audio_bytes, mime_type
+
+    def _response_text(self, prompt, audio_bytes, mime_type, seed):
+        """טקסט התשובה: תמלול באורך שתלוי במשך האודיו, או הטקסט הגולמי עצמו בבקשות עיבוד."""
+        config = self.state.config
+        sections = BATCH_SECTION.findall(prompt)
+        if sections:
+            return "\n\n".join(f"<<<מקטע {number}>>>\n{text.strip()}\n<<<סוף מקטע {number}>>>"
+                               for number, text in sections)
+        if RAW_TEXT_MARKER in prompt:
+            return prompt.split(RAW_TEXT_MARKER, 1)[1].strip()
+        if audio_bytes:
+            seconds = audio_bytes / AUDIO_BYTES_PER_SECOND.get(mime_type, DEFAULT_AUDIO_BYTES_PER_SECOND)
+            length = min(int(seconds * config.chars_per_audio_second), config.max_output_chars)
+            return canned_hebrew_text(max(length, 20), seed)
+        return canned_hebrew_text(200, seed)
+
+    def _handle_generate(self, api_key, body, stream):
+        state = self.state
+        kind = "stream" if stream else "generate"
+
+        quota = state.check_quota(api_key)
+        if quota:
+            message, retry_seconds = quota
+            state.count(kind, 429, len(body))
+            return self._send_error(429, message, retry_seconds)
+
+        injected = state.injected_error()
+        if injected:
+            state.count(kind, injected[0], len(body))
+            return self._send_error(injected[0], injected[1], 1 if injected[0] == 429 else None)
+
+        request = json.loads(body)
+        cache_name = request.get("cachedContent")
+        if cache_name and cache_name not in state.caches:
+            state.count(kind, 404, len(body))
+            return self._send_error(404, f"CachedContent not found (or permission denied): {cache_name}")
+
+        try:
+            prompt, audio_bytes, mime_type = self._parse_generate_request(request)
+        except KeyError as e:
+            # קובץ שנמחק או שלא הועלה - כמו ב-API האמיתי
+            state.count(kind, 403, len(body))
+            return self._send_error(403, f"You do not have permission to access the File {e.args[0]} "
+                                         f"or it may not exist.")
+        kind = f"{kind}_{'transcribe' if audio_bytes else 'process'}"
+        seed = zlib.crc32(f"{audio_bytes}:{prompt[-2000:]}".encode("utf-8"))
+        text = self._response_text(prompt, audio_bytes, mime_type, seed)
+
+        audio_seconds = audio_bytes / AUDIO_BYTES_PER_SECOND.get(mime_type, DEFAULT_AUDIO_BYTES_PER_SECOND)
+        usage = {
+            "promptTokenCount": len(prompt) // 3 + int(audio_seconds * AUDIO_TOKENS_PER_SECOND),
+            "candidatesTokenCount": len(text) // 3
+        }
+        if cache_name:
+            usage["cachedContentTokenCount"] = state.caches[cache_name]["tokens"]
+            usage["promptTokenCount"] += usage["cachedContentTokenCount"]
+        usage["totalTokenCount"] = usage["promptTokenCount"] + usage["candidatesTokenCount"]
+        state.record_tokens(api_key, usage["totalTokenCount"])
+
+        time.sleep(state.next_latency())
+        state.count(kind, 200, len(body))
+
+        if not stream:
+            return self._send_json(200, {
+                "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+                "usageMetadata": usage
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk_chars = max(state.config.stream_chunk_chars, 1)
+        for offset in range(0, len(text), chunk_chars):
+            candidate = {"content": {"parts": [{"text": text[offset:offset + chunk_chars]}], "role": "model"}}
+            if offset + chunk_chars >= len(text):
+                candidate["finishReason"] = "STOP"
+            event = json.dumps({"candidates": [candidate], "usageMetadata": usage}, ensure_ascii=False)
+            data = f"data: {event}\r\n\r\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+            time.sleep(state.config.stream_chunk_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_mock_server(config=None, host="127.0.0.1", port=0):
+    """הפעלת השרת בתהליכון רקע; port=0 בוחר פורט פנוי. מחזיר את השרת (server.state, server.base_url)."""
+    server = ThreadingHTTPServer((host, port), MockGeminiHandler)
+    server.daemon_threads = True
+    server.state = MockGeminiState(config or MockGeminiConfig())
+    server.base_url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="mock-gemini", daemon=True).start()
+    return server
+
+
+def add_config_arguments(parser):
+    """ארגומנטים של הגדרות השרת המדומה - משותפים לשרת ולכלי המדידה."""
+    defaults = MockGeminiConfig()
+    parser.add_argument("--latency", default=defaults.latency,
+                        help="התפלגות השהייה לתשובה: fixed:S, uniform:A,B, exponential:MEAN, lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--stream-chunk-delay", type=float, default=defaults.stream_chunk_delay)
+    parser.add_argument("--rate-429", type=float, default=defaults.rate_429, help="שיעור תשובות 429 אקראיות")
+    parser.add_argument("--rate-5xx", type=float, default=defaults.rate_5xx, help="שיעור תשובות 500/503 אקראיות")
+    parser.add_argument("--requests-per-minute", type=int, default=defaults.requests_per_minute,
+                        help="מכסת בקשות לדקה לכל מפתח API")
+    parser.add_argument("--tokens-per-day", type=int, default=defaults.tokens_per_day,
+                        help="מכסת טוקנים יומית לכל מפתח API")
+    parser.add_argument("--min-cache-tokens", type=int, default=defaults.min_cache_tokens,
+                        help="גודל מינימלי להוראות שמורות (cachedContents)")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def config_from_args(args):
+    return MockGeminiConfig(
+        latency=args.latency,
+        stream_chunk_delay=args.stream_chunk_delay,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_day=args.tokens_per_day,
+        min_cache_tokens=args.min_cache_tokens,
+        seed=args.seed
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="שרת Gemini מקומי למדידות ובדיקות")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    config = config_from_args(args)
+    server = start_mock_server(config, host=args.host, port=args.port)
+    print(f"שרת Gemini מדומה מאזין ב-{server.base_url} ({json.dumps(asdict(config))})", flush=True)
+    print(f"סטטיסטיקה: {server.base_url}/stats", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+# המודולים של האפליקציה נמצאים בשורש המאגר ולא בחבילה
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transcription_pipeline as pipeline
+from mock_gemini_server import MockGeminiConfig, start_mock_server
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """ספריית נתונים ריקה לכל בדיקה, עם מופעים משותפים חדשים (מאגר עבודות, מטמון, מאגר קבצים)."""
+    monkeypatch.setenv("TRANSCRIPTION_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(pipeline, "_shared_instances", {})
+    return tmp_path / "data"
+
+
+@pytest.fixture
+def mock_gemini(data_dir, monkeypatch):
+    """שרת Gemini מדומה ללא השהיות, שהלקוח המשותף פונה אליו במקום ל-API האמיתי."""
+    server = start_mock_server(MockGeminiConfig(latency="fixed:0", stream_chunk_delay=0, seed=1))
+    monkeypatch.setattr(pipeline.gemini_client, "base_url", server.base_url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class SilentWidget:
+    """מחליף את מד ההתקדמות ואזור הסטטוס של Streamlit - כל קריאה מתעלמת."""
+    
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class AudioUpload:
+    """קובץ מועלה כמו ב-Streamlit: שם ותוכן."""
+    name = "lesson.mp3"
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def getbuffer(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+@pytest.fixture
+def widget():
+    return SilentWidget()
+
+
+@pytest.fixture
+def make_lesson_audio(tmp_path):
+    """יצירת קובץ שיעור באורך נתון (בשניות) בעזרת ffmpeg."""
+    if shutil.which("ffmpeg") is None:
+        pytest.skip("ffmpeg לא מותקן")
+    
+    def make(seconds):
+        path = tmp_path / f"lesson_{seconds}.mp3"
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+                        "-c:a", "libmp3lame", "-b:a", "32k", str(path)], check=True)
+        return AudioUpload(str(path))
+    return make
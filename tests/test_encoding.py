@@ -0,0 +1,28 @@
+import hashlib
+import shutil
+import subprocess
+
+import pytest
+
+import transcription_pipeline as pipeline
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg לא מותקן")
+
+
+@pytest.fixture(scope="module")
+def source_audio(tmp_path_factory):
+    path = tmp_path_factory.mktemp("audio") / "source.mp3"
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "sine=frequency=440:duration=20",
+                    "-c:a", "libmp3lame", "-b:a", "64k", str(path)], check=True)
+    return str(path)
+
+
+@pytest.mark.parametrize("profile", list(pipeline.ENCODING_PROFILES))
+def test_segment_encoding_is_reproducible(source_audio, tmp_path, profile):
+    """אותו מקטע מקודד פעמיים חייב לצאת זהה, אחרת מטמון התמלולים לא תופס."""
+    digests = set()
+    for run in range(2):
+        output = tmp_path / f"segment_{run}.{pipeline.ENCODING_PROFILES[profile]['extension']}"
+        pipeline.cut_audio_segment(source_audio, str(output), 2000, 12000, profile)
+        digests.add(hashlib.sha256(output.read_bytes()).hexdigest())
+    assert len(digests) == 1
@@ -0,0 +1,31 @@
+import transcription_pipeline as pipeline
+
+
+def test_finished_jobs_are_evicted_and_read_from_the_job_store(data_dir):
+    job_store = pipeline.get_job_store()
+    job_queue = pipeline.TranscriptionJobQueue(num_workers=0, retention_seconds=0)
+    job_id = job_store.create_job("lesson.mp3", b"audio", {})
+    job_queue.submit(job_id, "key")
+    
+    # העבודה רצה והסתיימה (בלי תהליכון עבודה - ישירות)
+    job_store.complete(job_id, "תמלול מלא")
+    job_queue.jobs[job_id].set_state("completed", "תמלול מלא")
+    snapshot = job_queue.snapshot(job_id)
+    
+    assert job_id not in job_queue.jobs
+    assert snapshot["state"] == "completed"
+    assert snapshot["result"] == "תמלול מלא"
+    assert snapshot["file_name"] == "lesson.mp3"
+
+
+def test_queued_jobs_are_kept_and_unfinished_stored_jobs_are_unknown(data_dir):
+    job_store = pipeline.get_job_store()
+    job_queue = pipeline.TranscriptionJobQueue(num_workers=0, retention_seconds=0)
+    queued = job_store.create_job("queued.mp3", b"audio", {})
+    interrupted = job_store.create_job("interrupted.mp3", b"audio", {})
+    job_store.update(interrupted, status="interrupted")
+    job_queue.submit(queued, "key")
+    
+    assert job_queue.snapshot(queued)["state"] == "queued"
+    # עבודה שנקטעה לא מוצגת כעבודה שהסתיימה - ממשיכים אותה מרשימת העבודות שלא הושלמו
+    assert job_queue.snapshot(interrupted) is None
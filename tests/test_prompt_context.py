@@ -0,0 +1,62 @@
+import transcription_pipeline as pipeline
+
+INSTRUCTIONS = "תמלל את השיעור במדויק, כולל מקורות וציטוטים. " * 40
+
+
+def generate(context, api_key="key"):
+    """בקשת generateContent אחת עם ההוראות הקבועות, כמו בשלבי התמלול והעיבוד."""
+    fields = context.request_fields(api_key)
+    with context.guard(api_key, fields):
+        response = pipeline.gemini_client.post("v1beta/models/gemini-2.0-flash:generateContent", api_key=api_key,
+                                               json={**fields, "contents": [{"parts": [{"text": "מקטע 1"}]}]})
+        if response.status_code != 200:
+            raise pipeline.GeminiAPIError.from_response(response)
+    return fields
+
+
+def test_instructions_below_cache_minimum_are_sent_inline(mock_gemini):
+    mock_gemini.state.config.min_cache_tokens = 10 ** 6
+    context = pipeline.PromptContext("gemini-2.0-flash", INSTRUCTIONS)
+    
+    for _ in range(3):
+        fields = generate(context)
+    
+    assert "systemInstruction" in fields
+    # היצירה שנכשלה לא מנוסה שוב בכל בקשה
+    assert mock_gemini.state.snapshot()["requests"]["cache_create"] == 1
+    assert context.stats == {"created": 0, "failed": 1, "expired": 0}
+
+
+def test_expired_cache_is_recreated_on_retry(mock_gemini):
+    context = pipeline.PromptContext("gemini-2.0-flash", INSTRUCTIONS)
+    first_name = generate(context)["cachedContent"]
+    # המשאב פג בצד השרת
+    mock_gemini.state.caches.clear()
+    
+    # הניסיון הראשון נכשל על המשאב שפג, והניסיון החוזר יוצר אותו מחדש
+    fields = pipeline.RetryPolicy(base_delay=0).run(lambda deadline: generate(context))
+    
+    assert fields["cachedContent"] != first_name
+    assert context.stats == {"created": 2, "failed": 0, "expired": 1}
+    context.close()
+    assert mock_gemini.state.caches == {}
+
+
+class RejectingCaches(dict):
+    """מאגר הוראות שמורות בשרת שלא שומר דבר - כל הפניה למשאב נדחית."""
+    
+    def __setitem__(self, name, value):
+        pass
+
+
+def test_cache_that_keeps_failing_falls_back_to_inline_instructions(mock_gemini):
+    mock_gemini.state.caches = RejectingCaches()
+    context = pipeline.PromptContext("gemini-2.0-flash", INSTRUCTIONS)
+    
+    for _ in range(4):
+        fields = pipeline.RetryPolicy(base_delay=0).run(lambda deadline: generate(context))
+    
+    assert "systemInstruction" in fields
+    # יצירה ראשונה ויצירה מחדש אחת - אחר כך ההוראות בתוך כל בקשה
+    assert mock_gemini.state.snapshot()["requests"]["cache_create"] == 2
+    assert context.stats == {"created": 2, "failed": 0, "expired": 2}
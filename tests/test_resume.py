@@ -0,0 +1,59 @@
+import transcription_pipeline as pipeline
+
+
+def test_resume_retranscribes_only_the_failed_segment(mock_gemini, make_lesson_audio, widget, monkeypatch):
+    # שתי דקות וחצי - שלושה מקטעים של דקה
+    lesson_audio = make_lesson_audio(150)
+    transcribe = pipeline.transcribe_with_gemini
+    
+    def failing_transcribe(api_key, model, prompt, audio_path, *args, **kwargs):
+        if "segment_001." in audio_path:
+            raise pipeline.GeminiAPIError(400, "Request contains an invalid argument.")
+        return transcribe(api_key, model, prompt, audio_path, *args, **kwargs)
+    
+    monkeypatch.setattr(pipeline, "transcribe_with_gemini", failing_transcribe)
+    first_run = pipeline.process_audio(lesson_audio, "key", "p1", "gemini-2.0-flash", 1, 5, "",
+                                       widget, widget, use_cache=False)
+    job = pipeline.get_job_store().list_jobs(include_completed=True)[0]
+    assert job["num_segments"] == 3
+    assert job["segments"]["1"]["stages"]["transcribed"] == "failed"
+    assert "[שגיאה" in first_run
+    
+    monkeypatch.setattr(pipeline, "transcribe_with_gemini", transcribe)
+    mock_gemini.state.reset_stats()
+    resumed = pipeline.resume_job(job["job_id"], "key", widget, widget)
+    
+    # המקטעים שהושלמו נלקחים מהדיסק; רק המקטע שנכשל נשלח שוב לתמלול
+    assert mock_gemini.state.snapshot()["requests"]["generate_transcribe"] == 1
+    assert "[שגיאה" not in resumed
+    job = pipeline.get_job_store().load(job["job_id"])
+    assert job["status"] == "completed"
+    assert all(entry["stages"] == {"split": "done", "transcribed": "done", "processed": "done"}
+               for entry in job["segments"].values())
+
+
+def test_run_that_ends_without_completing_is_marked_failed(data_dir):
+    job_store = pipeline.get_job_store()
+    job_id = job_store.create_job("lesson.mp3", b"audio", {})
+    
+    # יציאה רגילה בלי complete() - למשל כשאין פרויקט זמין
+    with job_store.running(job_id):
+        pass
+    
+    assert job_store.load(job_id)["status"] == "failed"
+
+
+def test_run_cut_by_an_exception_is_marked_interrupted(data_dir):
+    job_store = pipeline.get_job_store()
+    job_id = job_store.create_job("lesson.mp3", b"audio", {})
+    
+    try:
+        with job_store.running(job_id):
+            raise KeyboardInterrupt
+    except KeyboardInterrupt:
+        pass
+    
+    assert job_store.load(job_id)["status"] == "interrupted"
+    with job_store.running(job_id):
+        job_store.complete(job_id, "תמלול מלא")
+    assert job_store.load(job_id)["status"] == "completed"
@@ -0,0 +1,34 @@
+import time
+
+import pytest
+
+import transcription_pipeline as pipeline
+
+
+def test_deadline_keeps_the_original_api_error():
+    policy = pipeline.RetryPolicy(max_attempts=5)
+    policy.delay = lambda attempt: 10.0
+    calls = []
+    
+    def call(deadline):
+        calls.append(deadline)
+        raise pipeline.GeminiAPIError(429, "quota", retry_after=30)
+    
+    with pytest.raises(pipeline.GeminiAPIError) as error:
+        policy.run(call, deadline=time.monotonic() + 0.01)
+    assert error.value.status_code == 429
+    assert error.value.retry_after == 30
+    assert len(calls) == 1
+
+
+def test_permanent_error_is_not_retried():
+    policy = pipeline.RetryPolicy(max_attempts=5, base_delay=0.0)
+    calls = []
+    
+    def call(deadline):
+        calls.append(deadline)
+        raise pipeline.GeminiAPIError(400, "bad request")
+    
+    with pytest.raises(pipeline.GeminiAPIError):
+        policy.run(call)
+    assert len(calls) == 1
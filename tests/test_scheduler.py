@@ -0,0 +1,99 @@
+import time
+
+import pytest
+
+import transcription_pipeline as pipeline
+
+
+class UnlimitedTokens:
+    """מנהל מכסות יומיות בלי הגבלה - הבדיקות עוסקות רק במגבלות לדקה ובשגיאות."""
+    
+    def daily_remaining(self, project_ids):
+        return {project_id: 10 ** 9 for project_id in project_ids}
+
+
+def run_lease(scheduler, error=None, deadline_seconds=None):
+    deadline = time.monotonic() + deadline_seconds if deadline_seconds is not None else None
+    try:
+        with scheduler.lease(100, deadline=deadline) as project_id:
+            if error is not None:
+                raise error
+            return project_id
+    except type(error) if error is not None else ():
+        return None
+
+
+def test_concurrent_jobs_share_the_project_rate_limit():
+    pool = pipeline.ProjectPool(requests_per_minute=2)
+    first_job = pipeline.ProjectScheduler(UnlimitedTokens(), ["p1"], ["key"], pool=pool)
+    second_job = pipeline.ProjectScheduler(UnlimitedTokens(), ["p1"], ["key"], pool=pool)
+    
+    run_lease(first_job)
+    run_lease(first_job)
+    # עבודה שנייה לא מקבלת מכסה לדקה משלה
+    with pytest.raises(Exception):
+        run_lease(second_job, deadline_seconds=1)
+    
+    assert first_job.stats()["p1"]["requests"] == 2
+    assert second_job.stats()["p1"]["requests"] == 0
+
+
+def test_rate_limited_project_is_skipped_by_every_job():
+    pool = pipeline.ProjectPool()
+    first_job = pipeline.ProjectScheduler(UnlimitedTokens(), ["pa"], ["key"], pool=pool)
+    second_job = pipeline.ProjectScheduler(UnlimitedTokens(), ["pa", "pb"], ["key"], pool=pool)
+    
+    run_lease(first_job, error=pipeline.GeminiAPIError(429, "quota", retry_after=60))
+    
+    assert {run_lease(second_job) for _ in range(3)} == {"pb"}
+
+
+def test_error_rate_decays_so_a_recovered_project_is_used_again():
+    pool = pipeline.ProjectPool(error_half_life=0.05)
+    failing_job = pipeline.ProjectScheduler(UnlimitedTokens(), ["pa"], ["key"], pool=pool)
+    job = pipeline.ProjectScheduler(UnlimitedTokens(), ["pa", "pb"], ["key"], pool=pool)
+    
+    for _ in range(3):
+        run_lease(failing_job, error=pipeline.GeminiAPIError(503, "unavailable"))
+    assert run_lease(job) == "pb"
+    
+    # בלי בקשות נוספות ל-pa שיעור השגיאות שלו דועך, וכשגם pb נכשל מדי פעם - pa נבחר שוב
+    time.sleep(0.5)
+    assert pool.error_rate(pool.project("pa"), time.monotonic()) < 0.01
+    run_lease(job, error=pipeline.GeminiAPIError(503, "unavailable"))
+    assert run_lease(job) == "pa"
+
+
+def test_breaker_opened_by_one_job_protects_other_jobs():
+    pool = pipeline.ProjectPool()
+    failing_job = pipeline.ProjectScheduler(UnlimitedTokens(), ["pa"], ["key"], pool=pool)
+    other_job = pipeline.ProjectScheduler(UnlimitedTokens(), ["pa"], ["key"], pool=pool)
+    
+    for _ in range(pipeline.CIRCUIT_BREAKER_FAILURE_THRESHOLD):
+        run_lease(failing_job, error=pipeline.GeminiAPIError(500, "internal"))
+    
+    assert other_job.stats()["pa"]["breaker_open"]
+    with pytest.raises(Exception):
+        run_lease(other_job, deadline_seconds=1)
+
+
+def test_request_in_flight_when_the_breaker_opens_does_not_release_the_probe():
+    pool = pipeline.ProjectPool()
+    job = pipeline.ProjectScheduler(UnlimitedTokens(), ["pa"], ["key"], pool=pool)
+    
+    with pytest.raises(pipeline.GeminiAPIError):
+        with job.lease(100):
+            # בזמן שהבקשה הזו רצה, המפסק נפתח ואחרי ההשבתה יוצאת בקשת בדיקה
+            for _ in range(pipeline.CIRCUIT_BREAKER_FAILURE_THRESHOLD):
+                run_lease(job, error=pipeline.GeminiAPIError(500, "internal"))
+            pool.project("pa")["breaker_until"] = time.monotonic()
+            probe = job.lease(100)
+            probe.__enter__()
+            # שגיאה בבקשה עצמה - לא סוגרת את המפסק ולא מאריכה אותו
+            raise pipeline.GeminiAPIError(400, "bad request")
+    
+    # הבקשה הישנה הסתיימה, אבל בקשת הבדיקה עדיין רצה - אין בדיקה שנייה
+    with pytest.raises(Exception):
+        run_lease(job, deadline_seconds=0.5)
+    probe.__exit__(None, None, None)
+    assert run_lease(job) == "pa"
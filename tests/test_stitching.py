@@ -0,0 +1,62 @@
+import random
+
+import transcription_pipeline as pipeline
+
+# אוצר מילים סינתטי גדול מספיק כדי שרצפים אקראיים לא יחזרו במקרה
+VOCABULARY = [first + second for first in ("בר", "של", "מח", "דב", "קד", "תר", "חס", "נש", "עמ", "גל",
+                                           "פר", "זכ", "סמ", "רח", "אמ", "הל", "שב", "כת", "למ", "יש")
+              for second in ("ום", "ית", "ה", "ים", "ות", "ן", "ך", "ני", "תי", "נו", "כם", "לה")]
+SHARED_PHRASE = "שאלה מהקהל האם הדין הזה נוהג גם בזמן הזה".split()
+
+
+def words(count, seed):
+    rng = random.Random(seed)
+    return [rng.choice(VOCABULARY) for _ in range(count)]
+
+
+def test_overlapping_segments_are_stitched_once():
+    lecture = words(800, seed=1)
+    previous, following = lecture[:420], lecture[378:]
+    # טעות תמלול קטנה בקטע הכפול לא מונעת את היישור
+    following[10] = "אחרת"
+    bounds = [[0, 300000, False], [270000, 570000, False]]
+    
+    combined = pipeline.combine_transcriptions([" ".join(previous), " ".join(following)], bounds,
+                                               pipeline.ProgressListener(), pipeline.ProgressListener())
+    
+    assert combined.split() == lecture
+
+
+def test_pause_boundary_is_not_aligned():
+    lecture = words(600, seed=2)
+    previous, following = " ".join(lecture[:320]), " ".join(lecture[280:])
+    bounds = [[0, 300000, True], [300000, 560000, False]]
+    
+    combined = pipeline.combine_transcriptions([previous, following], bounds,
+                                               pipeline.ProgressListener(), pipeline.ProgressListener())
+    
+    assert combined == previous + "\n\n" + following
+
+
+def test_unrelated_segments_sharing_a_phrase_keep_all_text():
+    ending = "והרב ענה כן בוודאי. ועוד דברים רבים נאמרו בשיעור עד סופו".split()
+    previous = " ".join(words(200, seed=3) + SHARED_PHRASE + ending)
+    following = " ".join(words(30, seed=4) + SHARED_PHRASE + words(200, seed=5))
+    
+    # גם כשהאודיו חופף, ביטוי בודד שחוזר במקום אחר אינו חפיפה
+    assert pipeline.find_overlap(previous, following) is None
+    assert pipeline.find_overlap(previous, following, expected_tokens=25) is None
+    
+    for bounds in ([[0, 300000, True], [300000, 600000, False]],
+                   [[0, 300000, False], [280000, 580000, False]]):
+        combined = pipeline.combine_transcriptions([previous, following], bounds,
+                                                   pipeline.ProgressListener(), pipeline.ProgressListener())
+        assert combined == previous + "\n\n" + following
+
+
+def test_overlap_far_from_expected_position_is_rejected():
+    lecture = words(800, seed=6)
+    previous, following = " ".join(lecture[:420]), " ".join(lecture[300:])
+    
+    assert pipeline.find_overlap(previous, following, expected_tokens=120) is not None
+    assert pipeline.find_overlap(previous, following, expected_tokens=20) is None
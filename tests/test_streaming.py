@@ -0,0 +1,39 @@
+import os
+
+import requests
+
+import transcription_pipeline as pipeline
+
+
+def test_interrupted_stream_resumes_from_partial_output(mock_gemini, tmp_path):
+    mock_gemini.state.config.stream_chunk_chars = 40
+    output_path = str(tmp_path / "raw_000.txt")
+    prompts = []
+    received = []
+    
+    def build_request(partial_text):
+        prompt = pipeline.with_resume_instructions("טקסט גולמי לעיבוד:\n" + "שורה של תמלול. " * 20, partial_text)
+        prompts.append(prompt)
+        return {"json": {"contents": [{"parts": [{"text": prompt}]}]}}
+    
+    def on_text(text):
+        received.append(text)
+        # החיבור נופל אחרי החלק הראשון של הזרם הראשון
+        if len(prompts) == 1:
+            raise requests.ConnectionError("connection reset")
+    
+    usage = {}
+    text = pipeline.RetryPolicy(base_delay=0).run(
+        lambda deadline: pipeline.stream_generate_content("key", "gemini-2.0-flash", build_request, output_path,
+                                                          on_text=on_text, usage=usage)
+    )
+    first_chunk = received[0]
+    
+    assert mock_gemini.state.snapshot()["requests"]["stream_process"] == 2
+    # הבקשה השנייה ממשיכה מהטקסט שכבר התקבל, והוא לא נשלח שוב לממשק
+    assert first_chunk in prompts[1]
+    # השרת המדומה מחזיר את הטקסט הגולמי כמו שהוא, כך שהתוצאה היא החלק הראשון ואחריו תשובת הבקשה השנייה
+    assert text == first_chunk + prompts[1].split("טקסט גולמי לעיבוד:\n", 1)[1].strip()
+    assert not os.path.exists(f"{output_path}.partial")
+    # שני הזרמים חויבו
+    assert usage["billed"]
@@ -0,0 +1,11 @@
+import transcription_pipeline as pipeline
+
+
+def test_record_request_returns_the_recorded_tokens(data_dir):
+    token_manager = pipeline.get_token_usage_manager()
+    token_manager.register_project("p1")
+    
+    # בלי usageMetadata נרשם האומדן, ועם usageMetadata - הספירה מהתשובה
+    assert token_manager.record_request("p1", "gemini-2.0-flash", "transcription", 100) == 100
+    assert token_manager.record_request("p1", "gemini-2.0-flash", "transcription", 100, {"total_tokens": 150}) == 150
+    assert token_manager.get_usage_summary()[0]["daily_usage"] == 250
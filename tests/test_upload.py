@@ -0,0 +1,120 @@
+import pytest
+import requests
+
+import transcription_pipeline as pipeline
+
+
+@pytest.fixture
+def audio_file(tmp_path, monkeypatch):
+    # חלקים קטנים כך שגם קובץ קטן מועלה בכמה בקשות
+    monkeypatch.setattr(pipeline, "UPLOAD_CHUNK_BYTES", 1024)
+    path = tmp_path / "segment.mp3"
+    path.write_bytes(bytes(range(256)) * 16)
+    return str(path)
+
+
+def test_uploaded_file_is_reused(mock_gemini, audio_file):
+    first_uri = pipeline.upload_audio_file("key", audio_file, "audio/mp3", "sha-reuse")
+    mock_gemini.state.reset_stats()
+    
+    assert pipeline.upload_audio_file("key", audio_file, "audio/mp3", "sha-reuse") == first_uri
+    assert mock_gemini.state.snapshot()["requests_total"] == 0
+
+
+def test_interrupted_upload_resumes_from_server_offset(mock_gemini, audio_file, monkeypatch):
+    post = pipeline.gemini_client.post
+    chunks_sent = []
+    
+    def failing_post(path, **kwargs):
+        # החיבור נופל בחלק השלישי של ההעלאה
+        if "upload_id=" in path and kwargs.get("headers", {}).get("X-Goog-Upload-Command", "").startswith("upload"):
+            chunks_sent.append(kwargs["headers"]["X-Goog-Upload-Offset"])
+            if len(chunks_sent) == 3:
+                raise requests.ConnectionError("connection reset")
+        return post(path, **kwargs)
+    
+    monkeypatch.setattr(pipeline.gemini_client, "post", failing_post)
+    with pytest.raises(Exception):
+        pipeline.upload_audio_file("key", audio_file, "audio/mp3", "sha-resume", max_chunk_retries=0)
+    monkeypatch.setattr(pipeline.gemini_client, "post", post)
+    
+    mock_gemini.state.reset_stats()
+    uri = pipeline.upload_audio_file("key", audio_file, "audio/mp3", "sha-resume")
+    stats = mock_gemini.state.snapshot()
+    
+    assert uri
+    assert "upload_start" not in stats["requests"]
+    assert stats["requests"]["upload_query"] == 1
+    # רק שני החלקים שלא התקבלו נשלחים שוב
+    assert stats["bytes_received"]["upload"] == 4096 - 2 * 1024
+
+
+def command_of(kwargs):
+    return kwargs.get("headers", {}).get("X-Goog-Upload-Command", "")
+
+
+def test_failed_offset_query_counts_as_a_retry(mock_gemini, audio_file, monkeypatch):
+    monkeypatch.setattr(pipeline.gemini_retry_policy, "delay", lambda attempt: 0)
+    post = pipeline.gemini_client.post
+    failed = set()
+    
+    def flaky_post(path, **kwargs):
+        # החלק השני נכשל, וגם הבירור הראשון שאחריו
+        command = command_of(kwargs)
+        if command == "upload" and kwargs["headers"]["X-Goog-Upload-Offset"] == "1024" and "chunk" not in failed:
+            failed.add("chunk")
+            raise requests.ConnectionError("connection reset")
+        if command == "query" and "query" not in failed:
+            failed.add("query")
+            raise requests.ConnectionError("connection reset")
+        return post(path, **kwargs)
+    
+    monkeypatch.setattr(pipeline.gemini_client, "post", flaky_post)
+    uri = pipeline.upload_audio_file("key", audio_file, "audio/mp3", "sha-query")
+    stats = mock_gemini.state.snapshot()
+    
+    assert uri
+    assert failed == {"chunk", "query"}
+    assert stats["requests"]["upload_query"] == 1
+    assert stats["bytes_received"]["upload"] == 4096
+
+
+def test_lost_finalize_response_uses_the_created_file(mock_gemini, audio_file, monkeypatch):
+    monkeypatch.setattr(pipeline.gemini_retry_policy, "delay", lambda attempt: 0)
+    post = pipeline.gemini_client.post
+    
+    def lossy_post(path, **kwargs):
+        response = post(path, **kwargs)
+        # החלק האחרון הגיע לשרת והקובץ נוצר, אבל התשובה אבדה בדרך
+        if command_of(kwargs) == "upload, finalize":
+            raise requests.ConnectionError("connection reset")
+        return response
+    
+    monkeypatch.setattr(pipeline.gemini_client, "post", lossy_post)
+    uri = pipeline.upload_audio_file("key", audio_file, "audio/mp3", "sha-final")
+    stats = mock_gemini.state.snapshot()
+    
+    assert uri == next(iter(mock_gemini.state.files.values()))["uri"]
+    assert stats["requests"]["upload_query"] == 1
+    assert stats["status_codes"].get("400") is None
+    assert stats["bytes_received"]["upload"] == 4096
+
+
+def test_file_deleted_on_server_is_uploaded_again(mock_gemini, make_lesson_audio, widget, monkeypatch):
+    # כל מקטע נשלח כקובץ שהועלה ולא בתוך הבקשה
+    monkeypatch.setattr(pipeline, "INLINE_PAYLOAD_LIMIT_BYTES", 0)
+    lesson_audio = make_lesson_audio(40)
+    pipeline.process_audio(lesson_audio, "key", "p1", "gemini-2.0-flash", 1, 5, "", widget, widget,
+                           use_cache=False)
+    
+    # השרת מוחק את הקובץ לפני שפג במאגר המקומי
+    mock_gemini.state.files.clear()
+    mock_gemini.state.reset_stats()
+    text = pipeline.process_audio(lesson_audio, "key", "p1", "gemini-2.0-flash", 1, 5, "", widget, widget,
+                                  use_cache=False)
+    stats = mock_gemini.state.snapshot()
+    
+    assert "[שגיאה" not in text
+    assert stats["requests"]["upload_start"] == 1
+    assert stats["status_codes"]["403"] == 1
+    assert stats["requests"]["generate_transcribe"] == 1
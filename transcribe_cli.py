@@ -0,0 +1,290 @@
+# תמלול מקבצים ללא דפדפן: רשימת קבצים או מעקב אחרי תיקיית קלט, עם דו"ח JSON לכל הרצה.
+#
+#   python -m transcribe_cli lesson1.mp3 lesson2.mp3 --projects p1,p2
+#   python -m transcribe_cli --watch inbox --output transcripts
+#
+# מפתח ה-API נלקח מ-GEMINI_API_KEY (או --api-key), ואפשר להזין מפתח לכל פרויקט מופרדים בפסיקים.
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+# סיומות הקבצים שמתקבלים לתמלול. הפרופילים שמקודדים מחדש קוראים כל פורמט ש-ffmpeg מכיר,
+# אבל הפרופיל original מעתיק את הזרם כמו שהוא למקטעי MP3, ולכן מקבל קבצי MP3 בלבד
+AUDIO_EXTENSIONS = (".mp3", ".m4a", ".wav", ".ogg", ".flac")
+COPY_PROFILE_EXTENSIONS = (".mp3",)
+
+
+def audio_extensions(encoding_profile):
+    return COPY_PROFILE_EXTENSIONS if encoding_profile == "original" else AUDIO_EXTENSIONS
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="תמלול שיעורי תורה עם Google Gemini ללא ממשק משתמש")
+    parser.add_argument("files", nargs="*", help="קבצי אודיו לתמלול")
+    parser.add_argument("--watch", metavar="DIR",
+                        help="תיקיית קלט למעקב - כל קובץ אודיו חדש מתומלל ומועבר ל-done או ל-failed")
+    parser.add_argument("--output", default="transcripts", help="תיקיית התמלולים ודו\"ח ההרצה")
+    parser.add_argument("--report", help="נתיב דו\"ח ההרצה (ברירת מחדל: run_report_<זמן>.json בתיקיית התמלולים)")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY", ""),
+                        help="מפתח API של Google AI Studio, או מפתח לכל פרויקט מופרדים בפסיקים")
+    parser.add_argument("--projects", default=os.environ.get("GEMINI_PROJECTS", ""),
+                        help="מזהי פרויקטים של Google Cloud מופרדים בפסיקים")
+    parser.add_argument("--model", default="gemini-2.0-flash")
+    parser.add_argument("--segment-length", type=int, default=25, help="אורך מקטע מקסימלי בדקות")
+    parser.add_argument("--overlap", type=int, default=30, help="חפיפה בין מקטעים בשניות")
+    parser.add_argument("--prompt-file", help="קובץ פרומפט מותאם אישית (ברירת מחדל: פרומפט שיעורי התורה)")
+    parser.add_argument("--segment-workers", type=int, default=3, help="מספר מקטעים לעיבוד במקביל בכל קובץ")
+    parser.add_argument("--parallel-files", type=int, default=int(os.environ.get("TRANSCRIPTION_JOB_WORKERS", "2")),
+                        help="מספר קבצים שמתומללים במקביל")
+    parser.add_argument("--max-requests", type=int,
+                        help="מגבלה כוללת על הקריאות המקבילות ל-Gemini מכל הקבצים יחד")
+    parser.add_argument("--encoding-profile", default="speech_mp3",
+                        help="פרופיל הקידוד לפני העלאה: speech_mp3, speech_opus או original (העתקה ללא קידוד, MP3 בלבד)")
+    parser.add_argument("--silence-split", action="store_true",
+                        help="חיתוך מקטעים בהפסקות בדיבור (מפענח את כל הקובץ לפני תחילת התמלול)")
+    parser.add_argument("--batch-processing", action="store_true", help="עיבוד כמה מקטעים קצרים בבקשה אחת")
+    parser.add_argument("--no-cache", action="store_true", help="ללא שימוש במטמון תמלולים קודמים")
+    parser.add_argument("--force", action="store_true", help="תמלול מחדש גם של קבצים שכבר יש להם תמלול")
+    parser.add_argument("--poll-interval", type=float, default=10, help="שניות בין סריקות של תיקיית הקלט")
+    parser.add_argument("--data-dir", default=os.environ.get("TRANSCRIPTION_DATA_DIR"),
+                        help="ספריית הנתונים (עבודות, מטמון ומאגר השימוש; ברירת מחדל: הספרייה הנוכחית)")
+    parser.add_argument("--quiet", action="store_true", help="הדפסת שגיאות וסיכומים בלבד")
+    args = parser.parse_args(argv)
+
+    if not args.files and not args.watch:
+        parser.error("יש לציין קבצים לתמלול או תיקייה למעקב (--watch)")
+    if not args.api_key:
+        parser.error("יש לספק מפתח API ב---api-key או במשתנה הסביבה GEMINI_API_KEY")
+    if not args.projects:
+        parser.error("יש לספק לפחות מזהה פרויקט אחד ב---projects או במשתנה הסביבה GEMINI_PROJECTS")
+    return args
+
+
+class ConsoleProgress:
+    """מדפיס את הודעות העבודה לקונסול עם שם הקובץ; מתאים לממשק ProgressListener של הצינור."""
+
+    _print_lock = threading.Lock()
+
+    def __init__(self, file_name, quiet=False):
+        self.file_name = file_name
+        self.quiet = quiet
+        self._last_text = None
+
+    def _print(self, message, stream=sys.stdout):
+        with self._print_lock:
+            print(f"[{self.file_name}] {message}", file=stream, flush=True)
+
+    def progress(self, value, text=None):
+        # רק שינוי בטקסט ההתקדמות מודפס, לא כל עדכון של הערך
+        if text and text != self._last_text and not self.quiet:
+            self._last_text = text
+            self._print(f"{value * 100:.0f}% {text}")
+
+    def message(self, level, message):
+        if level == "error":
+            self._print(message.strip(), stream=sys.stderr)
+        elif not self.quiet or level == "success":
+            self._print(message.strip())
+
+
+def transcript_path(output_dir, source_path):
+    """נתיב קובץ התמלול - אותו שם כמו בהורדה מהממשק."""
+    return os.path.join(output_dir, f"{os.path.splitext(os.path.basename(source_path))[0]}_transcription.txt")
+
+
+class BatchRun:
+    """הרצה אחת של ה-CLI: הגשת קבצים לתור העבודות, איסוף התוצאות וכתיבת הדו"ח."""
+
+    def __init__(self, pipeline, args):
+        self.pipeline = pipeline
+        self.args = args
+        self.job_queue = pipeline.TranscriptionJobQueue(num_workers=args.parallel_files)
+        self.custom_prompt = ""
+        if args.prompt_file:
+            with open(args.prompt_file, "r", encoding="utf-8") as f:
+                self.custom_prompt = f.read()
+        self.pending = {}
+        self.results = []
+        self.started_at = datetime.datetime.now()
+        os.makedirs(args.output, exist_ok=True)
+        self.report_path = args.report or os.path.join(
+            args.output, f"run_report_{self.started_at.strftime('%Y%m%d-%H%M%S')}.json"
+        )
+
+    def submit(self, source_path):
+        """יצירת עבודה לקובץ והוספתה לתור; קבצים שכבר תומללו מדולגים (אלא אם --force)."""
+        output_path = transcript_path(self.args.output, source_path)
+        if os.path.exists(output_path) and not self.args.force:
+            self.results.append({"file": source_path, "status": "skipped", "transcript": output_path})
+            return False
+
+        job_id = self.pipeline.create_transcription_job(
+            self.pipeline.LocalAudioFile(source_path), self.args.projects, self.args.model,
+            self.args.segment_length, self.args.overlap, self.custom_prompt,
+            max_workers=self.args.segment_workers, encoding_profile=self.args.encoding_profile,
+            use_cache=not self.args.no_cache, silence_split=self.args.silence_split,
+            batch_processing=self.args.batch_processing
+        )
+        listener = ConsoleProgress(os.path.basename(source_path), quiet=self.args.quiet)
+        self.job_queue.submit(job_id, self.args.api_key, listener=listener)
+        self.pending[job_id] = {"file": source_path, "transcript": output_path, "submitted": time.monotonic()}
+        return True
+
+    def collect(self):
+        """איסוף העבודות שהסתיימו, כתיבת התמלולים ועדכון הדו"ח; מחזיר את רשומות העבודות שהסתיימו."""
+        finished = []
+        for job_id, entry in list(self.pending.items()):
+            snapshot = self.job_queue.snapshot(job_id)
+            if snapshot["state"] not in ("completed", "failed"):
+                continue
+            del self.pending[job_id]
+
+            job = self.pipeline.get_job_store().load(job_id)
+            record = {
+                "file": entry["file"],
+                "job_id": job_id,
+                "status": snapshot["state"],
+                "seconds": round(time.monotonic() - entry["submitted"], 1),
+                "num_segments": job.get("num_segments"),
+                "segmentation": job.get("segmentation"),
+                "timing": snapshot["timing"],
+                "counters": snapshot["counters"],
+                "timeline": os.path.join(self.pipeline.get_job_store().job_dir(job_id), "timeline.json")
+            }
+            if snapshot["state"] == "completed":
+                with open(entry["transcript"], "w", encoding="utf-8") as f:
+                    f.write(snapshot["result"])
+                record["transcript"] = entry["transcript"]
+                record["characters"] = len(snapshot["result"])
+            else:
+                errors = [message for level, message in snapshot["messages"] if level == "error"]
+                record["error"] = job.get("error") or (errors[-1] if errors else None)
+            self.results.append(record)
+            finished.append(record)
+
+        if finished:
+            self.write_report()
+        return finished
+
+    def write_report(self, final=False):
+        """כתיבה אטומית של דו"ח ההרצה - מתעדכן אחרי כל קובץ, כך שגם הרצת לילה שנקטעה משאירה דו"ח."""
+        counts = {}
+        for record in self.results:
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+        report = {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "finished_at": datetime.datetime.now().isoformat(timespec="seconds") if final else None,
+            "elapsed_seconds": round((datetime.datetime.now() - self.started_at).total_seconds(), 1),
+            "settings": {
+                "model": self.args.model,
+                "projects": self.args.projects,
+                "parallel_files": self.args.parallel_files,
+                "segment_workers": self.args.segment_workers,
+                "max_requests": self.args.max_requests
+            },
+            "counts": counts,
+            "in_progress": [entry["file"] for entry in self.pending.values()],
+            "files": self.results,
+            "token_usage": self.pipeline.get_token_usage_manager().get_usage_summary(),
+            "connections": self.pipeline.gemini_client.connection_stats(),
+            "metrics_file": self.pipeline.TRANSCRIPTION_METRICS_FILE
+        }
+        with open(f"{self.report_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        os.replace(f"{self.report_path}.tmp", self.report_path)
+
+    def run_files(self, paths):
+        """תמלול רשימת קבצים עד שכולם מסתיימים."""
+        for path in paths:
+            if not os.path.isfile(path):
+                print(f"הקובץ {path} לא נמצא", file=sys.stderr)
+                self.results.append({"file": path, "status": "failed", "error": "הקובץ לא נמצא"})
+                continue
+            if not path.lower().endswith(audio_extensions(self.args.encoding_profile)):
+                error = f"פורמט הקובץ לא נתמך בפרופיל {self.args.encoding_profile}"
+                print(f"{path}: {error}", file=sys.stderr)
+                self.results.append({"file": path, "status": "failed", "error": error})
+                continue
+            self.submit(path)
+
+        while self.pending:
+            time.sleep(1)
+            self.collect()
+
+    def watch(self, inbox):
+        """מעקב אחרי תיקיית קלט: קובץ נאסף רק כשגודלו לא השתנה בין שתי סריקות (ההעתקה הסתיימה)."""
+        done_dir = os.path.join(inbox, "done")
+        failed_dir = os.path.join(inbox, "failed")
+        os.makedirs(done_dir, exist_ok=True)
+        os.makedirs(failed_dir, exist_ok=True)
+
+        sizes = {}
+        submitted = set()
+        print(f"עוקב אחרי {inbox} (Ctrl+C לעצירה)", flush=True)
+        while True:
+            for name in sorted(os.listdir(inbox)):
+                path = os.path.join(inbox, name)
+                if path in submitted or not name.lower().endswith(audio_extensions(self.args.encoding_profile)) or not os.path.isfile(path):
+                    continue
+                size = os.path.getsize(path)
+                if sizes.get(path) != size:
+                    sizes[path] = size
+                    continue
+                submitted.add(path)
+                if not self.submit(path):
+                    shutil.move(path, os.path.join(done_dir, name))
+                    submitted.discard(path)
+
+            for record in self.collect():
+                source = record["file"]
+                target_dir = done_dir if record["status"] == "completed" else failed_dir
+                shutil.move(source, os.path.join(target_dir, os.path.basename(source)))
+                submitted.discard(source)
+                sizes.pop(source, None)
+
+            time.sleep(self.args.poll_interval)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # המגבלה הכוללת על הקריאות נקראת בעת טעינת הצינור, ולכן נקבעת לפני הייבוא
+    if args.max_requests:
+        os.environ["GEMINI_MAX_CONCURRENT_REQUESTS"] = str(args.max_requests)
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        os.environ["TRANSCRIPTION_DATA_DIR"] = args.data_dir
+    import transcription_pipeline as pipeline
+
+    # הפרופילים מוגדרים בצינור, שנטען רק אחרי קביעת משתני הסביבה - ולכן נבדקים כאן ולא ב-argparse
+    if args.encoding_profile not in pipeline.ENCODING_PROFILES:
+        print(f"פרופיל קידוד לא מוכר: {args.encoding_profile} (אפשרויות: {', '.join(pipeline.ENCODING_PROFILES)})",
+              file=sys.stderr)
+        return 2
+
+    run = BatchRun(pipeline, args)
+    try:
+        if args.files:
+            run.run_files(args.files)
+        if args.watch:
+            run.watch(args.watch)
+    except KeyboardInterrupt:
+        print("ההרצה הופסקה; עבודות שלא הושלמו נשמרו וניתן להמשיך אותן מהממשק", file=sys.stderr)
+    finally:
+        pipeline.get_token_usage_manager().flush()
+        run.write_report(final=True)
+
+    counts = {}
+    for record in run.results:
+        counts[record["status"]] = counts.get(record["status"], 0) + 1
+    print(f"הסתיים: {counts}. דו\"ח ההרצה: {run.report_path}", flush=True)
+    return 1 if counts.get("failed") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3422 @@
+# צינור התמלול - חלוקה, תמלול, עיבוד ושילוב, ללא תלות בממשק המשתמש.
+# משמש את אפליקציית Streamlit ואת transcribe_cli.py; ההתקדמות מדווחת דרך ממשק ProgressListener.
+import os
+import json
+import datetime
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import base64
+import hashlib
+import mmap
+import shutil
+import random
+import email.utils
+import sqlite3
+import traceback
+import uuid
+import itertools
+import threading
+import re
+import queue
+import html
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from contextlib import contextmanager
+import numpy as np
+
+
+# קובץ המדדים בפורמט הטקסט של Prometheus - נכתב מחדש בסוף כל עבודה (מתאים ל-textfile collector)
+TRANSCRIPTION_METRICS_FILE = os.environ.get("TRANSCRIPTION_METRICS_FILE", "transcription_metrics.prom")
+
+
+class MetricsRegistry:
+    """מדדים מצטברים לכל התהליך (כל העבודות), לייצוא בפורמט הטקסט של Prometheus."""
+    
+    def __init__(self, prefix="transcription"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.counters = {}
+    
+    def observe(self, name, seconds):
+        with self._lock:
+            count, total = self.durations.get(name, (0, 0.0))
+            self.durations[name] = (count + 1, total + seconds)
+    
+    def add(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+    
+    def to_prometheus(self):
+        with self._lock:
+            durations = dict(self.durations)
+            counters = dict(self.counters)
+        lines = [
+            f"# HELP {self.prefix}_stage_seconds Time spent in each pipeline stage.",
+            f"# TYPE {self.prefix}_stage_seconds summary"
+        ]
+        for name, (count, total) in sorted(durations.items()):
+            lines.append(f'{self.prefix}_stage_seconds_sum{{stage="{name}"}} {total:.6f}')
+            lines.append(f'{self.prefix}_stage_seconds_count{{stage="{name}"}} {count}')
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+            lines.append(f"{self.prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+    
+    def write(self, path=TRANSCRIPTION_METRICS_FILE):
+        """כתיבה אטומית של קובץ המדדים."""
+        if not path:
+            return
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(f"{path}.tmp", path)
+
+
+metrics_registry = MetricsRegistry()
+
+
+class JobMetrics:
+    """מדידה של עבודה אחת: מקטעי זמן (spans) על ציר זמן ומונים, שמצטברים גם במדדי התהליך.
+    
+    המדידה הנוכחית נשמרת לכל תהליכון (ראו use_metrics ו-bind_metrics), כך שפונקציות עמוקות
+    כמו GeminiClient.request רושמות לעבודה שמריצה אותן בלי להעביר פרמטר.
+    """
+    
+    def __init__(self, job_id=None, registry=metrics_registry):
+        self.job_id = job_id
+        self.registry = registry
+        self.started_at = datetime.datetime.now().isoformat(timespec="seconds")
+        self._origin = time.monotonic()
+        self._lock = threading.Lock()
+        self.spans = []
+        self.counters = {}
+    
+    @contextmanager
+    def span(self, name, **attributes):
+        """מדידת קטע קוד; הקורא יכול להוסיף מאפיינים למילון המוחזר במהלך הקטע."""
+        started = time.monotonic()
+        try:
+            yield attributes
+        finally:
+            self.record(name, time.monotonic() - started, started=started, **attributes)
+    
+    def record(self, name, seconds, started=None, **attributes):
+        """רישום משך שנמדד (גם משך מצטבר שאינו רציף, כמו קידוד base64 בחלקים)."""
+        if started is None:
+            started = time.monotonic() - seconds
+        entry = {
+            "name": name,
+            "start": round(started - self._origin, 4),
+            "seconds": round(seconds, 4),
+            "thread": threading.current_thread().name
+        }
+        if attributes:
+            entry["attributes"] = attributes
+        with self._lock:
+            self.spans.append(entry)
+        if self.registry:
+            self.registry.observe(name, seconds)
+    
+    def add(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+        if self.registry:
+            self.registry.add(counter, value)
+    
+    def counter_values(self):
+        with self._lock:
+            return dict(self.counters)
+    
+    def summary(self):
+        """סיכום לכל סוג מקטע זמן: מספר פעמים, זמן מצטבר וזמן מרבי, מהכבד לקל."""
+        totals = {}
+        with self._lock:
+            for entry in self.spans:
+                stage = totals.setdefault(entry["name"], {"stage": entry["name"], "count": 0,
+                                                          "total_seconds": 0.0, "max_seconds": 0.0})
+                stage["count"] += 1
+                stage["total_seconds"] += entry["seconds"]
+                stage["max_seconds"] = max(stage["max_seconds"], entry["seconds"])
+        for stage in totals.values():
+            stage["total_seconds"] = round(stage["total_seconds"], 3)
+        return sorted(totals.values(), key=lambda stage: -stage["total_seconds"])
+    
+    def timeline(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda entry: entry["start"])
+            counters = dict(self.counters)
+        return {
+            "job_id": self.job_id,
+            "started_at": self.started_at,
+            "elapsed_seconds": round(time.monotonic() - self._origin, 3),
+            "summary": self.summary(),
+            "counters": counters,
+            "spans": spans
+        }
+    
+    def write_timeline(self, path):
+        """כתיבה אטומית של ציר הזמן של העבודה כ-JSON."""
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.timeline(), f, indent=2, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+
+class _NoMetrics(JobMetrics):
+    """מדידה ריקה לקוד שרץ מחוץ לעבודה."""
+    
+    def record(self, name, seconds, started=None, **attributes):
+        pass
+    
+    def add(self, counter, value=1):
+        pass
+
+
+_no_metrics = _NoMetrics(registry=None)
+_metrics_context = threading.local()
+
+
+def current_metrics():
+    """המדידה של העבודה שרצה בתהליכון הנוכחי."""
+    return getattr(_metrics_context, "metrics", None) or _no_metrics
+
+
+@contextmanager
+def use_metrics(metrics):
+    """קביעת המדידה הנוכחית של התהליכון לאורך הבלוק."""
+    previous = getattr(_metrics_context, "metrics", None)
+    _metrics_context.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _metrics_context.metrics = previous
+
+
+def bind_metrics(function):
+    """עטיפת פונקציה שתרוץ בתהליכון אחר כך שתרשום למדידה של העבודה הנוכחית."""
+    metrics = current_metrics()
+    
+    def bound(*args, **kwargs):
+        with use_metrics(metrics):
+            return function(*args, **kwargs)
+    return bound
+
+
+# ספריית הנתונים של האפליקציה (מאגר השימוש, מטמון התמלולים, מאגר הקבצים שהועלו והעבודות).
+# נקראת בשימוש הראשון ולא בטעינת המודול, כך שייבוא המודול לא יוצר קבצים בספרייה הנוכחית
+def data_path(name):
+    """נתיב קובץ או ספרייה תחת TRANSCRIPTION_DATA_DIR (ברירת מחדל: הספרייה הנוכחית)."""
+    data_dir = os.environ.get("TRANSCRIPTION_DATA_DIR", ".")
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, name)
+
+
+_shared_lock = threading.RLock()
+_shared_instances = {}
+
+
+def _shared_instance(name, factory):
+    """מופע משותף לכל התהליך, שנוצר בקריאה הראשונה."""
+    with _shared_lock:
+        if name not in _shared_instances:
+            _shared_instances[name] = factory()
+        return _shared_instances[name]
+
+
+def get_token_usage_manager():
+    return _shared_instance("token_usage_manager", lambda: TokenUsageManager(
+        SqliteUsageStore(data_path("token_usage.db")), usage_file=data_path("token_usage.json")
+    ))
+
+
+def get_transcript_cache():
+    return _shared_instance("transcript_cache", lambda: TranscriptCache(data_path("transcript_cache")))
+
+
+def get_uploaded_file_registry():
+    return _shared_instance("uploaded_file_registry",
+                            lambda: UploadedFileRegistry(data_path("uploaded_files.json")))
+
+
+def get_job_store():
+    return _shared_instance("job_store", lambda: JobStore(data_path("transcription_jobs")))
+
+
+class SqliteUsageStore:
+    """מאגר שימוש בטוקנים ב-SQLite במצב WAL - שורה לכל פרויקט ויום, עם הוספה אטומית שבטוחה גם בין תהליכים."""
+    
+    def __init__(self, db_path="token_usage.db"):
+        self.db_path = db_path
+        # חיבור נפרד לכל תהליכון - חיבור SQLite אינו משותף בין תהליכונים
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS projects (
+                    project_id TEXT PRIMARY KEY,
+                    daily_limit INTEGER NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS daily_usage (
+                    project_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    tokens INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (project_id, day)
+                )
+            """)
+            # השוואת אומדן הטוקנים לשימוש בפועל לפי מודל ושלב, לכיול האומדן
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS calibration (
+                    model TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    samples INTEGER NOT NULL DEFAULT 0,
+                    estimated_tokens INTEGER NOT NULL DEFAULT 0,
+                    actual_tokens INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (model, stage)
+                )
+            """)
+    
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def set_daily_limit(self, project_id, daily_limit):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO projects (project_id, daily_limit) VALUES (?, ?) "
+                "ON CONFLICT(project_id) DO UPDATE SET daily_limit = excluded.daily_limit",
+                (project_id, daily_limit)
+            )
+    
+    def add_usage(self, increments, calibration=None):
+        """הוספת שימוש בטרנזקציה אחת.
+        
+        increments: מילון {(project_id, day): tokens}; calibration: מילון {(model, stage): [samples, estimated, actual]}.
+        """
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO daily_usage (project_id, day, tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT(project_id, day) DO UPDATE SET tokens = tokens + excluded.tokens",
+                [(project_id, day, tokens) for (project_id, day), tokens in increments.items()]
+            )
+            conn.executemany(
+                "INSERT INTO calibration (model, stage, samples, estimated_tokens, actual_tokens) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(model, stage) DO UPDATE SET samples = samples + excluded.samples, "
+                "estimated_tokens = estimated_tokens + excluded.estimated_tokens, "
+                "actual_tokens = actual_tokens + excluded.actual_tokens",
+                [(model, stage, *totals) for (model, stage), totals in (calibration or {}).items()]
+            )
+    
+    def read_calibration(self):
+        rows = self._connect().execute(
+            "SELECT model, stage, samples, estimated_tokens, actual_tokens FROM calibration ORDER BY model, stage"
+        ).fetchall()
+        return {(model, stage): [samples, estimated, actual] for model, stage, samples, estimated, actual in rows}
+    
+    def read_usage(self, day):
+        """מגבלה, שימוש ביום הנתון ושימוש כולל לכל פרויקט רשום."""
+        rows = self._connect().execute("""
+            SELECT p.project_id, p.daily_limit,
+                   COALESCE(SUM(CASE WHEN u.day = ? THEN u.tokens END), 0),
+                   COALESCE(SUM(u.tokens), 0)
+            FROM projects p LEFT JOIN daily_usage u ON u.project_id = p.project_id
+            GROUP BY p.project_id
+            ORDER BY p.rowid
+        """, (day,)).fetchall()
+        return {
+            project_id: {"daily_limit": daily_limit, "daily_usage": daily_usage, "total_usage": total_usage}
+            for project_id, daily_limit, daily_usage, total_usage in rows
+        }
+    
+    def import_legacy_json(self, usage_file):
+        """העברה חד-פעמית של נתונים מקובץ token_usage.json הישן; הקובץ נשמר בשם ‎.migrated."""
+        if not os.path.exists(usage_file):
+            return
+        conn = self._connect()
+        if conn.execute("SELECT COUNT(*) FROM projects").fetchone()[0] == 0:
+            with open(usage_file, "r") as f:
+                legacy = json.load(f)
+            last_updated = legacy.get("last_updated") or datetime.datetime.now().strftime("%Y-%m-%d")
+            with conn:
+                for project_id, data in legacy.get("projects", {}).items():
+                    conn.execute("INSERT INTO projects (project_id, daily_limit) VALUES (?, ?)",
+                                 (project_id, data.get("daily_limit", 1000000)))
+                    daily = data.get("daily_usage", 0)
+                    # השימוש של הימים הקודמים לא נשמר לפי יום בקובץ הישן, ולכן נרשם בשורה אחת
+                    earlier = data.get("total_usage", daily) - daily
+                    for day, tokens in ((last_updated, daily), ("legacy", earlier)):
+                        if tokens > 0:
+                            conn.execute("INSERT INTO daily_usage (project_id, day, tokens) VALUES (?, ?, ?)",
+                                         (project_id, day, tokens))
+        os.replace(usage_file, usage_file + ".migrated")
+
+
+class TokenUsageManager:
+    """מנהל שימוש בטוקנים בפרויקטים שונים של Google AI Studio.
+    
+    השימוש נצבר בזיכרון ונכתב למאגר בקבוצות (write-behind) לכל היותר פעם ב-flush_interval שניות,
+    או מיד כשמבקשים סיכום או קוראים ל-flush.
+    """
+    
+    def __init__(self, store=None, usage_file="token_usage.json", flush_interval=2.0):
+        self.store = store or SqliteUsageStore()
+        self.flush_interval = flush_interval
+        # נעילה לשימוש בטוח ממספר תהליכונים של עיבוד מקביל
+        self._lock = threading.RLock()
+        try:
+            self.store.import_legacy_json(usage_file)
+        except Exception:
+            traceback.print_exc()
+        self._pending = {}
+        self._pending_calibration = {}
+        self._last_flush = time.monotonic()
+        self._snapshot_day = None
+        self._snapshot = {}
+        self._calibration = {}
+        self._refresh_snapshot()
+    
+    @staticmethod
+    def _today():
+        return datetime.datetime.now().strftime("%Y-%m-%d")
+    
+    def _refresh_snapshot(self):
+        self._snapshot_day = self._today()
+        self._snapshot = self.store.read_usage(self._snapshot_day)
+        self._calibration = self.store.read_calibration()
+    
+    def flush(self):
+        """כתיבת השימוש שנצבר בזיכרון למאגר ורענון הנתונים ממנו (כולל שימוש של תהליכים אחרים)."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            pending_calibration, self._pending_calibration = self._pending_calibration, {}
+            self._last_flush = time.monotonic()
+            try:
+                if pending or pending_calibration:
+                    self.store.add_usage(pending, pending_calibration)
+                self._refresh_snapshot()
+            except Exception:
+                # השימוש שלא נכתב חוזר לתור ויכתב בניסיון הבא
+                for key, tokens in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + tokens
+                for key, totals in pending_calibration.items():
+                    self._add_calibration(key, totals)
+                traceback.print_exc()
+    
+    def _projects(self):
+        """נתוני השימוש היומי לפי המאגר, בתוספת השימוש שעדיין לא נכתב."""
+        if self._snapshot_day != self._today():
+            self.flush()
+        projects = {project_id: dict(data) for project_id, data in self._snapshot.items()}
+        for (project_id, day), tokens in self._pending.items():
+            if project_id in projects:
+                projects[project_id]["total_usage"] += tokens
+                if day == self._snapshot_day:
+                    projects[project_id]["daily_usage"] += tokens
+        return projects
+    
+    def register_project(self, project_id, daily_limit=1000000):
+        """רישום פרויקט חדש או עדכון המגבלות שלו."""
+        with self._lock:
+            self.store.set_daily_limit(project_id, daily_limit)
+            self._refresh_snapshot()
+    
+    def record_usage(self, project_id, tokens_used):
+        """רישום שימוש בטוקנים לפרויקט."""
+        with self._lock:
+            if project_id not in self._snapshot:
+                self.register_project(project_id)
+            
+            key = (project_id, self._today())
+            self._pending[key] = self._pending.get(key, 0) + tokens_used
+            
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+    
+    def _add_calibration(self, key, totals):
+        current = self._pending_calibration.setdefault(key, [0, 0, 0])
+        for n, value in enumerate(totals):
+            current[n] += value
+    
+    def record_request(self, project_id, model, stage, estimated_tokens, usage=None, calibrate=True):
+        """רישום שימוש של בקשה אחת: לפי usageMetadata מהתשובה אם התקבל, ואחרת לפי האומדן.
+        
+        estimated_tokens הוא אומדן הבסיס (לפני כיול), כך שהיחס הנלמד לא מצטבר על עצמו.
+        calibrate=False רושם בלי לעדכן את היחס הנלמד (למשל בניסיון שנקטע באמצע).
+        מחזיר את מספר הטוקנים שנרשם - הספירה מהתשובה, או האומדן המכויל אם היא חסרה.
+        """
+        actual_tokens = (usage or {}).get("total_tokens")
+        metrics = current_metrics()
+        for counter in ("prompt_tokens", "output_tokens", "total_tokens"):
+            if (usage or {}).get(counter):
+                metrics.add(counter, usage[counter])
+        with self._lock:
+            if actual_tokens is None:
+                recorded_tokens = self.estimate_tokens(model, stage, estimated_tokens)
+                self.record_usage(project_id, recorded_tokens)
+                return recorded_tokens
+            if calibrate:
+                self._add_calibration((model, stage), (1, estimated_tokens, actual_tokens))
+            self.record_usage(project_id, actual_tokens)
+            return actual_tokens
+    
+    def _calibration_totals(self, key):
+        samples, estimated, actual = self._calibration.get(key, (0, 0, 0))
+        pending = self._pending_calibration.get(key, (0, 0, 0))
+        return samples + pending[0], estimated + pending[1], actual + pending[2]
+    
+    def estimate_tokens(self, model, stage, estimated_tokens, min_samples=3):
+        """אומדן טוקנים לפני שליחה: אומדן הבסיס מוכפל ביחס שנמדד בפועל עבור המודל והשלב."""
+        with self._lock:
+            samples, estimated, actual = self._calibration_totals((model, stage))
+        if samples < min_samples or estimated <= 0:
+            return estimated_tokens
+        return int(estimated_tokens * actual / estimated)
+    
+    def calibration_report(self):
+        """השוואת האומדן לשימוש בפועל לכל מודל ושלב."""
+        with self._lock:
+            keys = set(self._calibration) | set(self._pending_calibration)
+            totals = {key: self._calibration_totals(key) for key in keys}
+        return [
+            {
+                "model": model,
+                "stage": stage,
+                "samples": samples,
+                "estimated_tokens": estimated,
+                "actual_tokens": actual,
+                "ratio": actual / estimated if estimated else None
+            }
+            for (model, stage), (samples, estimated, actual) in sorted(totals.items())
+        ]
+    
+    def get_available_project(self, project_ids):
+        """מציאת פרויקט עם טוקנים זמינים מרשימה נתונה."""
+        with self._lock:
+            projects = self._projects()
+            
+            for project_id in project_ids:
+                if project_id not in projects:
+                    # פרויקט חדש, רישום אוטומטי
+                    self.register_project(project_id)
+                    return project_id
+                
+                project_data = projects[project_id]
+                if project_data["daily_usage"] < project_data["daily_limit"]:
+                    return project_id
+            
+            return None
+    
+    def daily_remaining(self, project_ids):
+        """המכסה היומית שנותרה לכל פרויקט, כולל שימוש שעדיין לא נכתב למאגר."""
+        with self._lock:
+            projects = self._projects()
+            for project_id in project_ids:
+                if project_id not in projects:
+                    self.register_project(project_id)
+                    projects = self._projects()
+            return {project_id: projects[project_id]["daily_limit"] - projects[project_id]["daily_usage"]
+                    for project_id in project_ids}
+    
+    def get_usage_summary(self):
+        """הצגת סיכום שימוש בטוקנים בכל הפרויקטים."""
+        with self._lock:
+            self.flush()
+            projects = self._projects()
+        
+        summary = []
+        for project_id, data in projects.items():
+            remaining = data["daily_limit"] - data["daily_usage"]
+            percent_used = (data["daily_usage"] / data["daily_limit"]) * 100 if data["daily_limit"] > 0 else 0
+            
+            summary.append({
+                "project_id": project_id,
+                "daily_limit": data["daily_limit"],
+                "daily_usage": data["daily_usage"],
+                "remaining": remaining,
+                "percent_used": percent_used,
+                "total_usage": data["total_usage"]
+            })
+        
+        return summary
+
+
+# מגבלות קצב לדקה לכל פרויקט (ברירת המחדל לפי השכבה החינמית) - ניתנות לשינוי במשתני סביבה
+PROJECT_REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_PROJECT_RPM", "15"))
+PROJECT_TOKENS_PER_MINUTE = int(os.environ.get("GEMINI_PROJECT_TPM", "1000000"))
+
+# זמן ההמתנה של פרויקט שקיבל שגיאת מגבלת קצב (429) בלי Retry-After, לפני שנשלחות אליו בקשות נוספות
+PROJECT_RATE_LIMIT_COOLDOWN_SECONDS = 60
+
+# שיעור השגיאות של פרויקט דועך בזמן, כך שפרויקט שהתאושש חוזר לקבל בקשות גם אם לא נבחר בינתיים
+PROJECT_ERROR_RATE_HALF_LIFE_SECONDS = 60
+
+# מפסק לכל פרויקט: אחרי מספר כשלים רצופים הפרויקט מושבת לזמן קצוב, ואז נשלחת בקשת בדיקה אחת
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN_SECONDS = 30
+CIRCUIT_BREAKER_MAX_COOLDOWN_SECONDS = 600
+
+
+class TokenBucket:
+    """דלי אסימונים שמתמלא בקצב קבוע לדקה, עד קיבולת של דקה אחת."""
+    
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount, now):
+        """כמה שניות יש להמתין עד שאפשר לצרוך amount (בקשה גדולה מהקיבולת ממתינה לדלי מלא)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+    
+    def consume(self, amount, now):
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+
+class ProjectPool:
+    """מצב משותף לכל פרויקט בין כל העבודות בתהליך: מגבלות הקצב לדקה, חסימה אחרי 429, שיעור השגיאות והמפסק.
+    
+    המכסה לדקה שייכת לפרויקט ולא לעבודה, ולכן עבודות שרצות במקביל (בתור העבודות או כמה קבצים
+    מה-CLI) צורכות מאותם דליים ולא מקבלות כל אחת מכסה מלאה משלה.
+    """
+    
+    def __init__(self, requests_per_minute=PROJECT_REQUESTS_PER_MINUTE, tokens_per_minute=PROJECT_TOKENS_PER_MINUTE,
+                 error_window=20, error_half_life=PROJECT_ERROR_RATE_HALF_LIFE_SECONDS):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # ממוצע נע מעריכי: משקל כל תוצאה כמו בחלון של error_window בקשות, ודעיכה לפי זמן
+        self.error_weight = 2 / (error_window + 1)
+        self.error_half_life = error_half_life
+        self.cond = threading.Condition()
+        self.projects = {}
+    
+    def project(self, project_id):
+        """מצב הפרויקט, נוצר בשימוש הראשון."""
+        with self.cond:
+            if project_id not in self.projects:
+                self.projects[project_id] = {
+                    "requests_bucket": TokenBucket(self.requests_per_minute),
+                    "tokens_bucket": TokenBucket(self.tokens_per_minute),
+                    "in_flight": 0,
+                    "error_rate": 0.0,
+                    "error_updated": time.monotonic(),
+                    "blocked_until": 0.0,
+                    "consecutive_failures": 0,
+                    "breaker_until": 0.0,
+                    "breaker_cooldown": CIRCUIT_BREAKER_COOLDOWN_SECONDS,
+                    "probing": False
+                }
+            return self.projects[project_id]
+    
+    def error_rate(self, project, now):
+        """שיעור השגיאות האחרון של הפרויקט, אחרי דעיכה לפי הזמן שעבר מהעדכון האחרון."""
+        return project["error_rate"] * 0.5 ** ((now - project["error_updated"]) / self.error_half_life)
+    
+    def record_outcome(self, project, failed, now):
+        rate = self.error_rate(project, now)
+        project["error_rate"] = rate + self.error_weight * ((1.0 if failed else 0.0) - rate)
+        project["error_updated"] = now
+
+
+project_pool = ProjectPool()
+
+
+class ProjectScheduler:
+    """חלוקת בקשות בין כל הפרויקטים של עבודה.
+    
+    כל בקשה מקבלת את הפרויקט הפנוי ביותר לפי המכסה היומית שנותרה, מספר הבקשות הפעילות בו
+    ושיעור השגיאות האחרון, בכפוף למגבלות הבקשות והטוקנים לדקה של כל פרויקט.
+    פרויקט שמוצה או שקיבל 429 מדולג, והעבודה ממשיכה בפרויקטים האחרים.
+    מצב הפרויקטים נשמר ב-ProjectPool המשותף לכל העבודות; המונים ב-stats הם של העבודה בלבד.
+    """
+    
+    def __init__(self, token_manager, project_ids, api_keys, pool=None):
+        if len(api_keys) == 1:
+            api_keys = api_keys * len(project_ids)
+        if len(api_keys) != len(project_ids):
+            raise Exception("מספר מפתחות ה-API חייב להיות 1 או כמספר הפרויקטים")
+        
+        self.token_manager = token_manager
+        self.project_ids = list(project_ids)
+        self.pool = pool or project_pool
+        self._cond = self.pool.cond
+        self.api_keys = dict(zip(self.project_ids, api_keys))
+        self.projects = {project_id: self.pool.project(project_id) for project_id in self.project_ids}
+        self.counts = {project_id: {"requests": 0, "errors": 0} for project_id in self.project_ids}
+    
+    def api_key(self, project_id):
+        return self.api_keys[project_id]
+    
+    def _pick(self, estimated_tokens):
+        """בחירת פרויקט לבקשה. מחזיר (פרויקט, 0) או (None, זמן המתנה בשניות)."""
+        now = time.monotonic()
+        remaining = self.token_manager.daily_remaining(self.project_ids)
+        candidates = [project_id for project_id in self.project_ids if remaining[project_id] > 0]
+        if not candidates:
+            raise Exception("לא נמצאו פרויקטים עם מכסת טוקנים זמינה. נסה שוב מחר.")
+        
+        ready, wait = [], None
+        for project_id in candidates:
+            project = self.projects[project_id]
+            if self._breaker_tripped(project) and project["probing"]:
+                # המפסק פתוח למחצה ובקשת הבדיקה עדיין רצה
+                project_wait = 1.0
+            else:
+                project_wait = max(
+                    project["blocked_until"] - now,
+                    project["breaker_until"] - now,
+                    project["requests_bucket"].wait_time(1, now),
+                    project["tokens_bucket"].wait_time(estimated_tokens, now)
+                )
+            if project_wait <= 0:
+                ready.append(project_id)
+            elif wait is None or project_wait < wait:
+                wait = project_wait
+        
+        if not ready:
+            return None, wait
+        
+        # פחות בקשות פעילות ופחות שגיאות עדיף; בשוויון - הפרויקט עם יותר מכסה יומית
+        best = min(ready, key=lambda project_id: (
+            self.projects[project_id]["in_flight"] + 4 * self.pool.error_rate(self.projects[project_id], now),
+            -remaining[project_id]
+        ))
+        return best, 0
+    
+    @staticmethod
+    def _breaker_tripped(project):
+        return project["consecutive_failures"] >= CIRCUIT_BREAKER_FAILURE_THRESHOLD
+    
+    def _record_outcome(self, project_id, error, probe=False):
+        """עדכון שיעור השגיאות והמפסק של הפרויקט לפי תוצאת בקשה; probe - זו בקשת הבדיקה של המפסק."""
+        now = time.monotonic()
+        project = self.projects[project_id]
+        if probe:
+            # רק בקשת הבדיקה עצמה משחררת את המפסק לבדיקה הבאה, ולא בקשה שרצה כבר כשהמפסק נפתח
+            project["probing"] = False
+        if error is None:
+            self.pool.record_outcome(project, False, now)
+            project["consecutive_failures"] = 0
+            project["breaker_cooldown"] = CIRCUIT_BREAKER_COOLDOWN_SECONDS
+            return
+        
+        self.counts[project_id]["errors"] += 1
+        # שגיאה בבקשה עצמה (למשל 400) אינה מעידה על מצב הפרויקט
+        if not gemini_retry_policy.is_project_failure(error):
+            return
+        self.pool.record_outcome(project, True, now)
+        project["consecutive_failures"] += 1
+        
+        if isinstance(error, GeminiAPIError) and error.status_code == 429:
+            # הפרויקט הגיע למגבלה - הבקשות הבאות יעברו לפרויקטים האחרים עד שיתפנה
+            project["blocked_until"] = now + (error.retry_after or PROJECT_RATE_LIMIT_COOLDOWN_SECONDS)
+        
+        if self._breaker_tripped(project):
+            # פתיחת המפסק; כל כשל נוסף של בקשת הבדיקה מכפיל את זמן ההשבתה
+            project["breaker_until"] = now + project["breaker_cooldown"]
+            project["breaker_cooldown"] = min(project["breaker_cooldown"] * 2, CIRCUIT_BREAKER_MAX_COOLDOWN_SECONDS)
+    
+    @contextmanager
+    def lease(self, estimated_tokens, deadline=None):
+        """בחירת פרויקט לבקשה אחת והמתנה עד שמגבלות הקצב שלו מאפשרות אותה; מחזיר את מזהה הפרויקט.
+        
+        deadline (לפי time.monotonic) מגביל את זמן ההמתנה לפרויקט פנוי.
+        """
+        wait_started = time.monotonic()
+        with self._cond:
+            while True:
+                project_id, wait = self._pick(estimated_tokens)
+                if project_id:
+                    break
+                if deadline is not None:
+                    if time.monotonic() + wait > deadline:
+                        raise Exception(f"אין פרויקט פנוי בזמן המוקצב (נדרשת המתנה של {wait:.0f} שניות)")
+                self._cond.wait(timeout=min(wait, 5.0))
+            
+            project = self.projects[project_id]
+            now = time.monotonic()
+            if now - wait_started > 0.001:
+                current_metrics().record("scheduler_wait", now - wait_started, started=wait_started,
+                                         project=project_id)
+            project["requests_bucket"].consume(1, now)
+            project["tokens_bucket"].consume(estimated_tokens, now)
+            project["in_flight"] += 1
+            self.counts[project_id]["requests"] += 1
+            probe = self._breaker_tripped(project)
+            if probe:
+                project["probing"] = True
+        
+        error = None
+        try:
+            yield project_id
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            with self._cond:
+                project["in_flight"] -= 1
+                self._record_outcome(project_id, error, probe)
+                self._cond.notify_all()
+    
+    def stats(self):
+        with self._cond:
+            return {
+                project_id: {
+                    **self.counts[project_id],
+                    "breaker_open": self.projects[project_id]["breaker_until"] > time.monotonic()
+                }
+                for project_id in self.project_ids
+            }
+
+
+# כתובת הבסיס של ה-API - ניתן להפנות לשרת מקומי לבדיקות באמצעות משתנה סביבה
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+
+# מעל גודל זה (אחרי base64) האודיו מועלה כקובץ במקום להישלח בתוך גוף הבקשה
+INLINE_PAYLOAD_LIMIT_BYTES = 15 * 1024 * 1024
+
+# גודל חלק בהעלאה מתחדשת - חייב להיות כפולה של 256KB
+UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+
+# קבצים שהועלו נשמרים בשרת 48 שעות; משאירים מרווח ביטחון
+UPLOADED_FILE_TTL_SECONDS = 46 * 60 * 60
+
+
+# מעקב אחר פתיחת חיבורים חדשים בתהליכון הנוכחי - כדי לדעת אם קריאה השתמשה בחיבור קיים
+_connection_events = threading.local()
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _connection_events.opened = getattr(_connection_events, "opened", 0) + 1
+        super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _connection_events.opened = getattr(_connection_events, "opened", 0) + 1
+        super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _ConnectionCountingAdapter(HTTPAdapter):
+    """מתאם HTTP שסופר חיבורי TCP/TLS חדשים שנפתחו במאגר."""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool
+        }
+
+
+class GeminiAPIError(Exception):
+    """תשובת שגיאה מה-API של Gemini, עם קוד ה-HTTP לצורך החלטה על ניסיון חוזר או מעבר פרויקט."""
+    
+    def __init__(self, status_code, text, retry_after=None):
+        super().__init__(f"בקשת Gemini נכשלה עם קוד {status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+        # זמן ההמתנה שהשרת ביקש, בשניות (מכותרת Retry-After או מפרטי RetryInfo בגוף השגיאה)
+        self.retry_after = retry_after
+    
+    @classmethod
+    def from_response(cls, response):
+        return cls(response.status_code, response.text, parse_retry_after(response))
+
+
+def parse_retry_after(response):
+    """זמן ההמתנה שהשרת ביקש: כותרת Retry-After (שניות או תאריך), או retryDelay מתוך RetryInfo."""
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(header)
+                return max(0.0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    
+    try:
+        details = response.json().get("error", {}).get("details", [])
+    except ValueError:
+        return None
+    for detail in details:
+        if detail.get("@type", "").endswith("google.rpc.RetryInfo"):
+            match = re.fullmatch(r"([\d.]+)s", detail.get("retryDelay", ""))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+class RetryPolicy:
+    """מדיניות ניסיונות חוזרים משותפת לכל הקריאות ל-Gemini.
+    
+    שגיאות זמניות (429, 5xx, זמן המתנה, ניתוק) מנוסות שוב בהמתנה אקספוננציאלית עם רעש אקראי,
+    ושגיאות קבועות (400, 401, 403, 404) נכשלות מיד.
+    """
+    
+    RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+    
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, deadline_seconds=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # הזמן הכולל המוקצב לשלב של מקטע, כולל כל הניסיונות וההמתנות
+        self.deadline_seconds = deadline_seconds or int(os.environ.get("GEMINI_SEGMENT_DEADLINE_SECONDS", "900"))
+    
+    def is_retryable(self, error):
+        if isinstance(error, GeminiAPIError):
+            return error.status_code in self.RETRYABLE_STATUS_CODES
+        return isinstance(error, (requests.Timeout, requests.ConnectionError,
+                                  requests.exceptions.ChunkedEncodingError, StreamInterrupted,
+                                  PromptCacheExpired))
+    
+    def is_project_failure(self, error):
+        """האם השגיאה מעידה על בעיה בפרויקט (מגבלה, הרשאה, שרת) ולא בבקשה עצמה."""
+        if isinstance(error, GeminiAPIError):
+            return error.status_code in (401, 403) or error.status_code in self.RETRYABLE_STATUS_CODES
+        return self.is_retryable(error) and not isinstance(error, PromptCacheExpired)
+    
+    def delay(self, attempt):
+        """המתנה לפני ניסיון מספר attempt (מ-1): אקספוננציאלית עם רעש אקראי מלא."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+    
+    def run(self, call, status=None, deadline=None, description="בקשה"):
+        """הרצת call() עם ניסיונות חוזרים עד להצלחה, לשגיאה קבועה, למיצוי הניסיונות או לחריגה מהזמן."""
+        if deadline is None:
+            deadline = time.monotonic() + self.deadline_seconds
+        attempt = 0
+        while True:
+            try:
+                return call(deadline)
+            except Exception as e:
+                attempt += 1
+                if not self.is_retryable(e) or attempt >= self.max_attempts:
+                    raise
+                delay = self.delay(attempt)
+                if time.monotonic() + delay > deadline:
+                    # השגיאה המקורית נזרקת כמו שהיא כדי לשמור על קוד ה-HTTP וה-Retry-After להחלטות המתקשר
+                    if status:
+                        status.text(f"  {description}: חריגה מהזמן המוקצב אחרי {attempt} ניסיונות ({e})")
+                    raise
+                if status:
+                    status.text(f"  שגיאה זמנית ב{description} (ניסיון {attempt}/{self.max_attempts}): {e} "
+                                f"- ניסיון נוסף בעוד {delay:.1f} שניות")
+                metrics = current_metrics()
+                metrics.add("retries")
+                with metrics.span("backoff", description=description, attempt=attempt):
+                    time.sleep(delay)
+
+
+gemini_retry_policy = RetryPolicy()
+
+
+# מגבלה כוללת על מספר הקריאות המקבילות ל-Gemini מכל העבודות בשרת
+GEMINI_MAX_CONCURRENT_REQUESTS = int(os.environ.get("GEMINI_MAX_CONCURRENT_REQUESTS", "8"))
+
+
+class GeminiClient:
+    """לקוח HTTP משותף לכל הקריאות ל-Gemini: חיבורים קבועים, זמני המתנה, דחיסה וסטטיסטיקת חיבורים."""
+    
+    def __init__(self, base_url=GEMINI_API_BASE, pool_size=8, connect_timeout=10, read_timeout=300,
+                 max_concurrent_requests=GEMINI_MAX_CONCURRENT_REQUESTS):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = 0
+        self._lock = threading.Lock()
+        # כל קריאה תופסת משבצת; כך התעבורה הכוללת מוגבלת גם כשרצות כמה עבודות במקביל
+        self._request_slots = threading.BoundedSemaphore(max_concurrent_requests)
+        self._slot_holder = threading.local()
+        self.session = requests.Session()
+        # התשובות מגיעות דחוסות ומפוענחות אוטומטית
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        self.ensure_pool_size(pool_size)
+        self.stats = {"calls": 0, "new_connections": 0, "reused_connections": 0}
+        self.recent_calls = deque(maxlen=1000)
+    
+    def ensure_pool_size(self, pool_size):
+        """הגדלת מאגר החיבורים כך שיתאים למספר הקריאות המקבילות."""
+        with self._lock:
+            if pool_size <= self.pool_size:
+                return
+            previous_adapters = {self.session.get_adapter("https://"), self.session.get_adapter("http://")}
+            adapter = _ConnectionCountingAdapter(pool_connections=4, pool_maxsize=pool_size)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            self.pool_size = pool_size
+            # סגירת המאגר הקודם - חיבורים פנויים נסגרים, וחיבורים בשימוש נסגרים כשהבקשה שלהם מסתיימת
+            for previous in previous_adapters:
+                previous.close()
+    
+    def url(self, path):
+        """כתובת מלאה לנתיב API; כתובות מלאות (כמו כתובת העלאה) מוחזרות כמו שהן."""
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+    
+    @contextmanager
+    def request_slot(self):
+        """תפיסת משבצת קריאה לאורך פעולה שלמה (למשל קריאת זרם עד סופו)."""
+        if getattr(self._slot_holder, "held", False):
+            yield
+            return
+        wait_started = time.monotonic()
+        with self._request_slots:
+            if time.monotonic() - wait_started > 0.001:
+                current_metrics().record("request_slot_wait", time.monotonic() - wait_started, started=wait_started)
+            self._slot_holder.held = True
+            try:
+                yield
+            finally:
+                self._slot_holder.held = False
+    
+    def request(self, method, path, api_key=None, **kwargs):
+        """ביצוע קריאה דרך מאגר החיבורים המשותף ורישום האם נעשה שימוש חוזר בחיבור."""
+        if api_key:
+            kwargs["params"] = {**kwargs.get("params", {}), "key": api_key}
+        kwargs.setdefault("timeout", self.timeout)
+        
+        with self.request_slot():
+            _connection_events.opened = 0
+            started = time.monotonic()
+            response = None
+            try:
+                response = self.session.request(method, self.url(path), **kwargs)
+                return response
+            finally:
+                self._record_call(method, path, started)
+                self._record_metrics(method, path, started, response, kwargs.get("stream", False))
+    
+    def _record_metrics(self, method, path, started, response, stream):
+        """מקטע זמן לקריאה: זמן עד הכותרות (כולל שליחת הבקשה) וזמן קריאת הגוף, ומוני קריאות ובתים."""
+        seconds = time.monotonic() - started
+        metrics = current_metrics()
+        metrics.add("http_requests")
+        attributes = {"path": path.split("?")[0] if not path.startswith("http") else "upload"}
+        if response is None:
+            metrics.add("http_failures")
+            metrics.record("http_request", seconds, started=started, error=True, **attributes)
+            return
+        headers_seconds = response.elapsed.total_seconds()
+        attributes.update(status=response.status_code, headers_seconds=round(headers_seconds, 4))
+        if not stream:
+            # בקריאת זרם הגוף נקרא אחר כך ונמדד בנפרד (http_stream_body)
+            attributes["body_seconds"] = round(max(seconds - headers_seconds, 0.0), 4)
+            metrics.add("bytes_received", len(response.content))
+        metrics.add("bytes_sent", int(response.request.headers.get("Content-Length") or 0))
+        if response.status_code >= 400:
+            metrics.add("http_errors")
+        metrics.record("http_request", seconds, started=started, **attributes)
+    
+    def _record_call(self, method, path, started):
+        """רישום הקריאה והאם נפתח עבורה חיבור חדש."""
+        new_connection = _connection_events.opened > 0
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["new_connections" if new_connection else "reused_connections"] += 1
+            self.recent_calls.append({
+                "method": method,
+                "path": path.split("?")[0] if not path.startswith("http") else "upload",
+                "reused_connection": not new_connection,
+                "seconds": time.monotonic() - started
+            })
+    
+    def post(self, path, api_key=None, **kwargs):
+        return self.request("POST", path, api_key=api_key, **kwargs)
+    
+    def get(self, path, api_key=None, **kwargs):
+        return self.request("GET", path, api_key=api_key, **kwargs)
+    
+    def connection_stats(self):
+        """עותק של מוני הקריאות והחיבורים."""
+        with self._lock:
+            return dict(self.stats)
+
+
+gemini_client = GeminiClient()
+
+
+# הגדרות יצירה קבועות לכל שלב - חלק ממפתח המטמון
+TRANSCRIPTION_GENERATION_CONFIG = {
+    "temperature": 0.1,  # טמפרטורה נמוכה לתמלול מדויק יותר
+    "maxOutputTokens": 8192
+}
+PROCESSING_GENERATION_CONFIG = {
+    "temperature": 0.3,
+    "maxOutputTokens": 8192
+}
+
+
+class TranscriptCache:
+    """מטמון תמלולים על הדיסק לפי גיבוב התוכן, הפרומפט, המודל והגדרות היצירה.
+    
+    גודל המטמון מוגבל; כשהוא חורג נמחקות הרשומות שהשימוש האחרון בהן הוא הישן ביותר.
+    """
+    
+    def __init__(self, cache_dir="transcript_cache", max_bytes=200 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+    
+    @staticmethod
+    def make_key(stage, model, prompt, generation_config, content_hash):
+        """מפתח המטמון - כל שינוי בקלט, בפרומפט, במודל או בהגדרות יוצר מפתח חדש."""
+        key_material = json.dumps({
+            "stage": stage,
+            "model": model,
+            "prompt": prompt,
+            "generation_config": generation_config,
+            "content": content_hash
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.txt")
+    
+    def get(self, key):
+        """החזרת הטקסט השמור למפתח, או None אם אינו במטמון."""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            # עדכון זמן השימוש האחרון לצורך פינוי LRU
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return text
+    
+    def put(self, key, text):
+        """שמירת טקסט במטמון ופינוי רשומות ישנות אם המטמון חרג מגודלו."""
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temp_path, path)
+        except OSError:
+            # המטמון הוא אופטימיזציה בלבד - כשל בשמירה לא עוצר את התמלול
+            return
+        with self._lock:
+            self._total_bytes += os.path.getsize(path) - previous_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def _evict(self):
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.is_file() and entry.name.endswith(".txt")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries:
+            if self._total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._total_bytes -= size
+            except OSError:
+                pass
+    
+    def stats(self):
+        """מוני פגיעות והחטאות וגודל המטמון הנוכחי."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self._total_bytes}
+
+
+# זמן החיים של ההוראות הקבועות השמורות בשרת; העבודה מוחקת אותן בסיומה
+PROMPT_CONTEXT_TTL_SECONDS = 2 * 60 * 60
+
+
+class PromptCacheExpired(Exception):
+    """ההוראות השמורות בשרת פגו או נמחקו - הניסיון הבא ישלח אותן שוב או בתוך הבקשה."""
+
+
+class PromptContext:
+    """ההוראות הקבועות של עבודה, שנשלחות פעם אחת לכל מפתח API כ-cachedContents בשרת.
+    
+    כל בקשה מפנה למשאב השמור ושולחת רק את החלק המשתנה של הפרומפט. אם יצירת המשאב נכשלת
+    (למשל כשההוראות קצרות ממגבלת המינימום של המודל) ההוראות נשלחות בתוך כל בקשה כ-systemInstruction.
+    """
+    
+    def __init__(self, model, instructions, use_server_cache=True, ttl_seconds=PROMPT_CONTEXT_TTL_SECONDS):
+        self.model = model
+        self.instructions = instructions
+        self.use_server_cache = use_server_cache
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # לכל מפתח API: שם המשאב בשרת, או None אחרי שהיצירה נכשלה
+        self._resources = {}
+        # מפתחות API שהמשאב שלהם כבר נוצר מחדש פעם אחת אחרי שפג
+        self._recreated = set()
+        self.stats = {"created": 0, "failed": 0, "expired": 0}
+    
+    def _create(self, api_key):
+        response = gemini_client.post("v1beta/cachedContents", api_key=api_key, json={
+            "model": f"models/{self.model}",
+            "systemInstruction": {"parts": [{"text": self.instructions}]},
+            "ttl": f"{self.ttl_seconds}s"
+        })
+        if response.status_code != 200:
+            raise GeminiAPIError.from_response(response)
+        return response.json()["name"]
+    
+    def request_fields(self, api_key, status=None):
+        """השדות שמוסיפים לגוף הבקשה: הפניה למשאב השמור, או ההוראות עצמן בתוך הבקשה."""
+        if self.use_server_cache:
+            with self._lock:
+                if api_key not in self._resources:
+                    try:
+                        self._resources[api_key] = self._create(api_key)
+                        self.stats["created"] += 1
+                    except Exception as e:
+                        self._resources[api_key] = None
+                        self.stats["failed"] += 1
+                        if status:
+                            status.text(f"  שמירת ההוראות בשרת נכשלה ({e}) - ההוראות יישלחו בתוך כל בקשה")
+                name = self._resources[api_key]
+            if name:
+                return {"cachedContent": name}
+        return {"systemInstruction": {"parts": [{"text": self.instructions}]}}
+    
+    @contextmanager
+    def guard(self, api_key, fields):
+        """זיהוי שגיאה שנובעת ממשאב שפג; המשאב נשכח והשגיאה הופכת לניסיון חוזר."""
+        try:
+            yield
+        except GeminiAPIError as e:
+            if "cachedContent" in fields and e.status_code in (400, 403, 404) and "cachedcontent" in e.text.lower():
+                with self._lock:
+                    if self._resources.get(api_key) == fields["cachedContent"]:
+                        # יצירה מחדש פעם אחת; אם גם היא תיכשל - ההוראות יישלחו בתוך הבקשה
+                        if api_key in self._recreated:
+                            self._resources[api_key] = None
+                        else:
+                            self._resources.pop(api_key)
+                            self._recreated.add(api_key)
+                        self.stats["expired"] += 1
+                raise PromptCacheExpired(f"ההוראות השמורות בשרת אינן זמינות: {e}") from e
+            raise
+    
+    def close(self):
+        """מחיקת המשאבים השמורים בסיום העבודה; כשל במחיקה לא חשוב כי הם פגים מעצמם."""
+        with self._lock:
+            resources, self._resources = self._resources, {}
+        for api_key, name in resources.items():
+            if name:
+                try:
+                    gemini_client.request("DELETE", f"v1beta/{name}", api_key=api_key)
+                except Exception:
+                    pass
+
+
+def inline_payload_size(audio_size_bytes, prompt=""):
+    """אומדן גודל הבקשה כשהאודיו נשלח בתוכה כ-base64."""
+    return (audio_size_bytes + 2) // 3 * 4 + len(prompt.encode("utf-8"))
+
+
+class UploadedFileRegistry:
+    """מאגר קבצים שהועלו ל-Gemini לפי גיבוב התוכן - לשימוש חוזר בניסיונות חוזרים ובעיבוד מחדש."""
+    
+    def __init__(self, registry_file="uploaded_files.json"):
+        self.registry_file = registry_file
+        self._lock = threading.Lock()
+        self.entries = self._load_entries()
+    
+    def _load_entries(self):
+        """טעינת המאגר מקובץ, או מאגר ריק אם הקובץ לא קיים או לא תקין."""
+        if os.path.exists(self.registry_file):
+            try:
+                with open(self.registry_file, "r") as f:
+                    return json.load(f)
+            except Exception:
+                pass
+        return {}
+    
+    def _save_entries(self):
+        """כתיבה אטומית של המאגר - קריסה באמצע הכתיבה לא משאירה קובץ פגום."""
+        try:
+            with open(f"{self.registry_file}.tmp", "w") as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(f"{self.registry_file}.tmp", self.registry_file)
+        except Exception:
+            # המאגר הוא אופטימיזציה בלבד - כשל בשמירה לא עוצר את התמלול
+            pass
+    
+    @staticmethod
+    def _key(api_key, sha256):
+        # הקבצים שייכים למפתח ה-API שהעלה אותם; שומרים רק גיבוב של המפתח
+        api_key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        return f"{api_key_hash}:{sha256}"
+    
+    def get(self, api_key, sha256):
+        """החזרת רשומת הקובץ אם קיימת ולא פגה."""
+        with self._lock:
+            entry = self.entries.get(self._key(api_key, sha256))
+            if entry and entry.get("uri") and entry.get("expires_at", 0) > time.time():
+                return entry
+            return None
+    
+    def get_pending_upload(self, api_key, sha256):
+        """החזרת כתובת העלאה שהתחילה ולא הסתיימה, להמשך מאותה נקודה."""
+        with self._lock:
+            entry = self.entries.get(self._key(api_key, sha256))
+            if entry and not entry.get("uri") and entry.get("upload_started_at", 0) > time.time() - UPLOADED_FILE_TTL_SECONDS:
+                return entry.get("upload_url")
+            return None
+    
+    def set_pending_upload(self, api_key, sha256, upload_url):
+        with self._lock:
+            self.entries[self._key(api_key, sha256)] = {
+                "upload_url": upload_url,
+                "upload_started_at": time.time()
+            }
+            self._save_entries()
+    
+    def set_uploaded(self, api_key, sha256, file_info):
+        with self._lock:
+            self.entries[self._key(api_key, sha256)] = {
+                "uri": file_info["uri"],
+                "name": file_info["name"],
+                "expires_at": time.time() + UPLOADED_FILE_TTL_SECONDS
+            }
+            self._save_entries()
+    
+    def forget(self, api_key, sha256):
+        with self._lock:
+            if self.entries.pop(self._key(api_key, sha256), None) is not None:
+                self._save_entries()
+
+
+def _query_upload_offset(upload_url):
+    """בירור מצב העלאה מתחדשת: (מצב, בתים שהתקבלו, הקובץ שנוצר אם ההעלאה כבר הסתיימה)."""
+    response = gemini_client.post(upload_url, headers={"X-Goog-Upload-Command": "query"})
+    if response.status_code != 200:
+        return None, None, None
+    status = response.headers.get("X-Goog-Upload-Status", "")
+    received = int(response.headers.get("X-Goog-Upload-Size-Received", 0))
+    file_info = None
+    if status == "final":
+        try:
+            file_info = response.json().get("file")
+        except ValueError:
+            pass
+    return status, received, file_info
+
+
+def upload_audio_file(api_key, path, mime_type, sha256, status=None, max_chunk_retries=3):
+    """העלאת קובץ אודיו ל-Gemini בהעלאה מתחדשת בחלקים והחזרת ה-URI שלו."""
+    uploaded_file_registry = get_uploaded_file_registry()
+    
+    # שימוש חוזר בקובץ שכבר הועלה עבור אותו תוכן
+    existing = uploaded_file_registry.get(api_key, sha256)
+    if existing:
+        if status:
+            status.info(f"  משתמש בקובץ שכבר הועלה: {existing['name']}")
+        return existing["uri"]
+    
+    file_size = os.path.getsize(path)
+    offset = 0
+    file_info = None
+    upload_url = uploaded_file_registry.get_pending_upload(api_key, sha256)
+    
+    # המשך העלאה שהופסקה, אם השרת עדיין מכיר אותה; העלאה שכבר הסתיימה מחזירה את הקובץ עצמו
+    if upload_url:
+        upload_status, received, file_info = _query_upload_offset(upload_url)
+        if upload_status == "active":
+            offset = received
+            if status:
+                status.info(f"  ממשיך העלאה שהופסקה מבית {offset}")
+        elif file_info is None:
+            upload_url = None
+    
+    if not upload_url:
+        response = gemini_client.post(
+            "upload/v1beta/files",
+            api_key=api_key,
+            headers={
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(file_size),
+                "X-Goog-Upload-Header-Content-Type": mime_type,
+                "Content-Type": "application/json"
+            },
+            json={"file": {"display_name": f"segment-{sha256[:16]}"}}
+        )
+        if response.status_code != 200 or "X-Goog-Upload-URL" not in response.headers:
+            raise Exception(f"פתיחת העלאה נכשלה עם קוד {response.status_code}: {response.text}")
+        upload_url = response.headers["X-Goog-Upload-URL"]
+        uploaded_file_registry.set_pending_upload(api_key, sha256, upload_url)
+    
+    failures = 0
+    recovering = False
+    with open(path, "rb") as f:
+        while file_info is None:
+            try:
+                if recovering:
+                    # בירור מאיזו נקודה להמשיך - כשל בבירור נספר כמו כשל בשליחת חלק
+                    upload_status, received, file_info = _query_upload_offset(upload_url)
+                    recovering = False
+                    if upload_status == "final":
+                        # החלק האחרון התקבל למרות השגיאה - הקובץ כבר נוצר
+                        if file_info is None:
+                            raise Exception("ההעלאה הסתיימה בשרת אך הקובץ לא הוחזר")
+                        continue
+                    if upload_status == "active":
+                        offset = received
+                
+                f.seek(offset)
+                chunk = f.read(UPLOAD_CHUNK_BYTES)
+                is_last = offset + len(chunk) >= file_size
+                response = gemini_client.post(
+                    upload_url,
+                    headers={
+                        "X-Goog-Upload-Command": "upload, finalize" if is_last else "upload",
+                        "X-Goog-Upload-Offset": str(offset)
+                    },
+                    data=chunk
+                )
+                if response.status_code != 200:
+                    raise Exception(f"קוד {response.status_code}: {response.text}")
+                current_metrics().add("upload_bytes", len(chunk))
+            except Exception as e:
+                failures += 1
+                if failures > max_chunk_retries:
+                    raise Exception(f"העלאת הקובץ נכשלה: {e}")
+                if status:
+                    status.text(f"  שגיאה בהעלאת חלק (ניסיון {failures}/{max_chunk_retries}): {e}")
+                metrics = current_metrics()
+                metrics.add("retries")
+                with metrics.span("backoff", description="העלאת חלק", attempt=failures):
+                    time.sleep(gemini_retry_policy.delay(failures))
+                recovering = True
+                continue
+            
+            if is_last:
+                file_info = response.json()["file"]
+            else:
+                offset += len(chunk)
+    
+    # המתנה לסיום עיבוד הקובץ בצד השרת
+    deadline = time.time() + 120
+    while file_info.get("state", "ACTIVE") == "PROCESSING" and time.time() < deadline:
+        time.sleep(2)
+        response = gemini_client.get(f"v1beta/{file_info['name']}", api_key=api_key)
+        if response.status_code == 200:
+            file_info = response.json()
+    if file_info.get("state", "ACTIVE") != "ACTIVE":
+        raise Exception(f"הקובץ שהועלה אינו זמין (מצב: {file_info.get('state')})")
+    
+    uploaded_file_registry.set_uploaded(api_key, sha256, file_info)
+    if status:
+        status.info(f"  הקובץ הועלה: {file_info['name']}")
+    return file_info["uri"]
+
+
+class InlineAudioRequestBody:
+    """גוף בקשת JSON שמקודד את קובץ האודיו ל-base64 בחלקים תוך כדי שליחה.
+    
+    הקובץ נקרא דרך mmap ולא נטען כולו לזיכרון, וניתן לשלוח את הגוף שוב בכל ניסיון חוזר.
+    """
+    
+    # כפולה של 3 כך שכל חלק מקודד ל-base64 ללא ריפוד באמצע
+    chunk_size = 3 * 64 * 1024
+    placeholder = "@@AUDIO_BASE64@@"
+    
+    def __init__(self, payload, audio_path):
+        # מעטפת ה-JSON נבנית פעם אחת; האודיו מוזרק במקום מחזיק המקום בזמן השליחה
+        with current_metrics().span("payload_build"):
+            envelope = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.prefix, self.suffix = envelope.split(f'"{self.placeholder}"'.encode("utf-8"))
+        self.prefix += b'"'
+        self.suffix = b'"' + self.suffix
+        self.audio_path = audio_path
+        self.audio_size = os.path.getsize(audio_path)
+        self.upload_seconds = None
+    
+    def __len__(self):
+        return len(self.prefix) + (self.audio_size + 2) // 3 * 4 + len(self.suffix)
+    
+    def __iter__(self):
+        started = time.monotonic()
+        # זמן הקידוד בלבד, בלי זמן השליחה שבין החלקים
+        encode_seconds = 0.0
+        yield self.prefix
+        if self.audio_size:
+            with open(self.audio_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for offset in range(0, self.audio_size, self.chunk_size):
+                        chunk_started = time.monotonic()
+                        chunk = base64.b64encode(view[offset:offset + self.chunk_size])
+                        encode_seconds += time.monotonic() - chunk_started
+                        yield chunk
+        current_metrics().record("payload_base64", encode_seconds, started=started, bytes=self.audio_size)
+        yield self.suffix
+        # הקריאה האחרונה מתבצעת רק אחרי שהחלק האחרון נשלח
+        self.upload_seconds = time.monotonic() - started
+
+
+class StreamInterrupted(Exception):
+    """הזרם נקטע לפני שהמודל סיים - הטקסט החלקי נשמר להמשך."""
+
+
+def iter_stream_events(response):
+    """קריאת אירועי server-sent events מתשובת streamGenerateContent."""
+    for line in response.iter_lines():
+        if line.startswith(b"data:"):
+            yield json.loads(line[len(b"data:"):].strip().decode("utf-8"))
+
+
+def parse_usage_metadata(response_data):
+    """חילוץ ספירת הטוקנים המדויקת מ-usageMetadata שבתשובת Gemini, או None אם חסרה."""
+    metadata = response_data.get("usageMetadata") or {}
+    if "totalTokenCount" not in metadata:
+        return None
+    return {
+        "prompt_tokens": metadata.get("promptTokenCount", 0),
+        "output_tokens": metadata.get("candidatesTokenCount", 0),
+        "total_tokens": metadata["totalTokenCount"]
+    }
+
+
+def merge_usage(usage, usage_metadata):
+    """הוספת ספירת הטוקנים של תשובה אחת לסיכום הבקשה - כל הניסיונות שחויבו נספרים."""
+    if usage is None or usage_metadata is None:
+        return
+    for key, value in usage_metadata.items():
+        usage[key] = usage.get(key, 0) + value
+
+
+def mark_billed(usage):
+    """סימון שהבקשה הגיעה למודל ותחויב, גם אם ספירת הטוקנים לא תתקבל (למשל זרם שנקטע באמצע)."""
+    if usage is not None:
+        usage["billed"] = True
+
+
+def with_resume_instructions(prompt, partial_text):
+    """הוספת הנחיה להמשך מהנקודה שבה נקטע הפלט הקודם."""
+    if not partial_text:
+        return prompt
+    return (f"{prompt}\n\nחלק מהפלט כבר הופק בבקשה קודמת שנקטעה. הפלט הקודם הסתיים במילים:\n"
+            f"...{partial_text[-1500:]}\n\n"
+            f"המשך בדיוק מהנקודה שבה הפלט נעצר, בלי לחזור על טקסט שכבר הופק.")
+
+
+def _read_partial_output(partial_path):
+    if not os.path.exists(partial_path):
+        return ""
+    with open(partial_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def stream_generate_content(api_key, model, build_request, output_path, on_text=None, status=None, usage=None):
+    """הפעלת streamGenerateContent וכתיבת הטקסט לקובץ חלקי תוך כדי קבלתו.
+    
+    build_request(partial_text) מחזיר את פרמטרי הבקשה. אם הזרם נקטע, הקריאה נכשלת והטקסט נשאר
+    בקובץ output_path.partial, כך שהניסיון החוזר (לפי מדיניות הניסיונות) ממשיך ממנו.
+    ספירת הטוקנים של הזרם מצטברת ב-usage, אם סופק.
+    """
+    partial_path = f"{output_path}.partial"
+    text = _read_partial_output(partial_path)
+    if text and status:
+        status.info(f"  ממשיך מפלט חלקי קיים: {len(text)} תווים")
+    
+    # המשבצת נתפסת עד סוף קריאת הזרם ולא רק עד קבלת הכותרות
+    with gemini_client.request_slot():
+        text = _consume_stream(api_key, model, build_request, partial_path, text, on_text, usage)
+    os.remove(partial_path)
+    return text
+
+
+def _consume_stream(api_key, model, build_request, partial_path, text, on_text, usage=None):
+    """קריאת זרם אחד עד סופו; הטקסט נכתב לקובץ החלקי תוך כדי."""
+    response = gemini_client.post(
+        f"v1beta/models/{model}:streamGenerateContent",
+        api_key=api_key, params={"alt": "sse"}, stream=True,
+        **build_request(text)
+    )
+    with response:
+        if response.status_code != 200:
+            raise GeminiAPIError.from_response(response)
+        mark_billed(usage)
+        
+        finished = False
+        # כל אירוע נושא את הספירה המצטברת של הזרם, ולכן נשמרת רק האחרונה
+        stream_usage = None
+        try:
+            with current_metrics().span("http_stream_body") as attributes:
+                with open(partial_path, "a", encoding="utf-8") as f:
+                    for event in iter_stream_events(response):
+                        stream_usage = parse_usage_metadata(event) or stream_usage
+                        candidate = (event.get("candidates") or [{}])[0]
+                        chunk = "".join(part.get("text", "") for part in candidate.get("content", {}).get("parts", []))
+                        if chunk:
+                            # כתיבה מיידית לדיסק כך ששום טקסט שהתקבל לא הולך לאיבוד
+                            f.write(chunk)
+                            f.flush()
+                            text += chunk
+                            if on_text:
+                                on_text(text)
+                        if candidate.get("finishReason"):
+                            finished = True
+                attributes["chars"] = len(text)
+        finally:
+            merge_usage(usage, stream_usage)
+        
+        if not finished:
+            raise StreamInterrupted(f"הזרם הסתיים לפני סיום הפלט ({len(text)} תווים)")
+    
+    return text
+
+
+def transcribe_with_gemini(api_key, model, prompt, audio_path, progress_bar=None,
+                           mime_type="audio/mp3", upload_stats=None, file_uri=None,
+                           stream_to=None, on_text=None, usage=None, prompt_fields=None):
+    """תמלול אודיו באמצעות ה-API של Gemini - האודיו נשלח בתוך הבקשה או כהפניה לקובץ שהועלה.
+    
+    prompt_fields (מ-PromptContext) מוסיף לבקשה את ההוראות הקבועות, ואז prompt הוא רק החלק המשתנה.
+    """
+    
+    # נקודת קצה של ה-API
+    path = f"v1beta/models/{model}:generateContent"
+    
+    if file_uri:
+        # הפניה לקובץ שכבר הועלה - הבקשה עצמה קטנה
+        audio_part = {"file_data": {"mime_type": mime_type, "file_uri": file_uri}}
+    else:
+        # הכנת בקשה מרובת חלקים - זהו המבנה הנדרש לשליחת קבצים ל-Gemini
+        audio_part = {"inline_data": {"mime_type": mime_type, "data": InlineAudioRequestBody.placeholder}}
+    
+    def build_body(request_prompt):
+        payload = {
+            **(prompt_fields or {}),
+            "contents": [
+                {
+                    "parts": [
+                        {"text": request_prompt},
+                        audio_part
+                    ]
+                }
+            ],
+            "generationConfig": TRANSCRIPTION_GENERATION_CONFIG
+        }
+        if file_uri:
+            return json.dumps(payload).encode("utf-8")
+        return InlineAudioRequestBody(payload, audio_path)
+    
+    # מצב זרימה: הטקסט נכתב לקובץ ומוצג תוך כדי קבלתו
+    if stream_to:
+        transcript = stream_generate_content(
+            api_key, model,
+            lambda partial_text: {
+                "data": build_body(with_resume_instructions(prompt, partial_text)),
+                "headers": {"Content-Type": "application/json"}
+            },
+            stream_to, on_text=on_text, status=progress_bar, usage=usage
+        )
+        return transcript.strip()
+    
+    # ניסיון אחד בלבד - ניסיונות חוזרים מנוהלים במדיניות המשותפת אצל הקורא
+    body = build_body(prompt)
+    response = gemini_client.post(path, api_key=api_key, data=body,
+                                  headers={"Content-Type": "application/json"})
+    
+    # מדידת נפח וזמן ההעלאה של הבקשה
+    if upload_stats is not None and not file_uri:
+        upload_stats["request_bytes"] = len(body)
+        upload_stats["upload_seconds"] = body.upload_seconds
+    
+    if response.status_code != 200:
+        raise GeminiAPIError.from_response(response)
+    
+    # פענוח התשובה
+    mark_billed(usage)
+    response_data = response.json()
+    merge_usage(usage, parse_usage_metadata(response_data))
+    
+    # חילוץ התמלול מהתשובה
+    try:
+        transcript = response_data["candidates"][0]["content"]["parts"][0]["text"]
+        return transcript.strip()
+    except (KeyError, IndexError) as e:
+        if progress_bar:
+            progress_bar.text(f"שגיאה בפענוח תשובת Gemini: {e}")
+            progress_bar.text(f"מבנה התשובה: {json.dumps(response_data, indent=2)}")
+        return ""
+
+
+@dataclass(frozen=True)
+class SegmentInfo:
+    """תיאור מקטע אודיו שנוצר פעם אחת בשלב החלוקה ומועבר לאורך כל הצינור."""
+    index: int
+    start_ms: int
+    end_ms: int
+    path: str
+    size_bytes: int
+    sha256: str
+    mime_type: str = "audio/mp3"
+    original_size_bytes: int = None  # גודל המקטע בקידוד המקורי, רק במצב מדידה
+    
+    @property
+    def duration_ms(self):
+        return self.end_ms - self.start_ms
+    
+    @property
+    def duration_seconds(self):
+        return self.duration_ms / 1000
+    
+    @classmethod
+    def from_file(cls, index, start_ms, end_ms, path, mime_type="audio/mp3", original_size_bytes=None):
+        """יצירת תיאור מקטע מקובץ שנחתך - גודל וגיבוב נקראים פעם אחת בלבד."""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return cls(index, start_ms, end_ms, path, os.path.getsize(path), digest.hexdigest(),
+                   mime_type, original_size_bytes)
+
+
+# פרופילי קידוד לפני העלאה - תמלול דיבור לא צריך סטריאו או קצב דגימה גבוה
+# פלט זהה בכל הרצה (בלי מספר זרם Ogg אקראי ובלי גרסת ffmpeg בכותרות), כך שהגיבוב של מקטע
+# נשאר קבוע - מטמון התמלולים ושימוש חוזר בקבצים שהועלו מבוססים עליו
+BITEXACT_ARGS = ["-fflags", "+bitexact", "-flags:a", "+bitexact"]
+
+ENCODING_PROFILES = {
+    "original": {
+        "label": "מקורי (ללא קידוד מחדש)",
+        "extension": "mp3",
+        "mime_type": "audio/mp3",
+        "ffmpeg_args": ["-c", "copy", *BITEXACT_ARGS],
+    },
+    "speech_mp3": {
+        "label": "MP3 מונו 16kHz 32kbps",
+        "extension": "mp3",
+        "mime_type": "audio/mp3",
+        "ffmpeg_args": ["-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-b:a", "32k", *BITEXACT_ARGS],
+    },
+    "speech_opus": {
+        "label": "Opus/OGG מונו 16kHz 24kbps",
+        "extension": "ogg",
+        "mime_type": "audio/ogg",
+        "ffmpeg_args": ["-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", "-application", "voip",
+                        *BITEXACT_ARGS],
+    },
+}
+
+
+class JobStore:
+    """מאגר עבודות תמלול על הדיסק - מצב כל מקטע נשמר אחרי כל שלב כדי שניתן יהיה להמשיך עבודה שנקטעה."""
+    
+    def __init__(self, jobs_dir="transcription_jobs"):
+        self.jobs_dir = jobs_dir
+        self._lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+    
+    def job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+    
+    def source_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), "uploaded_audio.mp3")
+    
+    def _manifest_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), "job.json")
+    
+    def _write_manifest(self, manifest):
+        """כתיבה אטומית של קובץ העבודה - קריסה באמצע הכתיבה לא משאירה קובץ פגום."""
+        manifest["updated_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+        path = self._manifest_path(manifest["job_id"])
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+    
+    def load(self, job_id):
+        with open(self._manifest_path(job_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    
+    def create_job(self, file_name, audio_buffer, settings):
+        """יצירת עבודה חדשה: שמירת הקובץ המקורי וההגדרות בספריית העבודה."""
+        self.cleanup()
+        job_id = f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(self.job_dir(job_id))
+        write_started = time.monotonic()
+        with open(self.source_path(job_id), "wb") as f:
+            f.write(audio_buffer)
+        # זמן הכתיבה נשמר בעבודה ונכנס לציר הזמן שלה בהרצה הראשונה
+        source_write = {"seconds": round(time.monotonic() - write_started, 4), "bytes": len(audio_buffer)}
+        
+        with self._lock:
+            self._write_manifest({
+                "job_id": job_id,
+                "file_name": file_name,
+                "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                "status": "created",
+                "settings": settings,
+                "num_segments": None,
+                "segments": {},
+                "source_write": source_write
+            })
+        return job_id
+    
+    def update(self, job_id, **fields):
+        with self._lock:
+            manifest = self.load(job_id)
+            manifest.update(fields)
+            self._write_manifest(manifest)
+    
+    def checkpoint(self, job_id, segment, stage, ok):
+        """שמירת מצב שלב של מקטע מיד עם סיומו."""
+        with self._lock:
+            manifest = self.load(job_id)
+            entry = manifest["segments"].setdefault(str(segment.index), {"stages": {}})
+            if stage == "split":
+                entry["segment"] = asdict(segment)
+            entry["stages"][stage] = "done" if ok else "failed"
+            self._write_manifest(manifest)
+    
+    def saved_segment(self, manifest, index):
+        """תיאור מקטע שכבר נחתך בהרצה קודמת, אם הקובץ שלו עדיין קיים."""
+        entry = manifest["segments"].get(str(index))
+        if not entry or "segment" not in entry or not os.path.exists(entry["segment"]["path"]):
+            return None
+        return SegmentInfo(**entry["segment"])
+    
+    def prepare_resume(self, job_id):
+        """מחיקת תוצרים של שלבים שנכשלו כדי שיורצו שוב; מחזיר את מספר המקטע הראשון שלא הושלם."""
+        with self._lock:
+            manifest = self.load(job_id)
+            job_dir = self.job_dir(job_id)
+            for index, entry in manifest["segments"].items():
+                stages = entry["stages"]
+                if stages.get("transcribed") == "failed":
+                    # תמלול שנכשל מחייב גם עיבוד מחדש
+                    for name in (f"raw_{int(index):03d}.txt", f"processed_{int(index):03d}.txt"):
+                        if os.path.exists(os.path.join(job_dir, name)):
+                            os.remove(os.path.join(job_dir, name))
+                    stages.pop("transcribed")
+                    stages.pop("processed", None)
+                elif stages.get("processed") == "failed":
+                    if os.path.exists(os.path.join(job_dir, f"processed_{int(index):03d}.txt")):
+                        os.remove(os.path.join(job_dir, f"processed_{int(index):03d}.txt"))
+                    stages.pop("processed")
+            self._write_manifest(manifest)
+        
+        num_segments = manifest["num_segments"] or 0
+        for index in range(num_segments):
+            if manifest["segments"].get(str(index), {}).get("stages", {}).get("processed") != "done":
+                return index
+        return num_segments
+    
+    @contextmanager
+    def running(self, job_id):
+        """סימון העבודה כרצה.
+        
+        הרצה שנקטעה בחריגה מסומנת כניתנת להמשך; הרצה שהסתיימה בלי להשלים את העבודה
+        (למשל אין פרויקט זמין או שהחיתוך נכשל) מסומנת כנכשלה, כי המשך יסתיים באותה דרך.
+        """
+        self.update(job_id, status="running")
+        try:
+            yield self.job_dir(job_id)
+        except BaseException:
+            if self.load(job_id)["status"] == "running":
+                self.update(job_id, status="interrupted")
+            raise
+        if self.load(job_id)["status"] == "running":
+            self.update(job_id, status="failed")
+    
+    def complete(self, job_id, combined_text):
+        with open(os.path.join(self.job_dir(job_id), "transcript.txt"), "w", encoding="utf-8") as f:
+            f.write(combined_text)
+        self.update(job_id, status="completed")
+    
+    def list_jobs(self, include_completed=False):
+        """רשימת העבודות מהחדשה לישנה."""
+        jobs = []
+        for job_id in os.listdir(self.jobs_dir):
+            try:
+                manifest = self.load(job_id)
+            except (OSError, ValueError):
+                continue
+            if include_completed or manifest["status"] != "completed":
+                jobs.append(manifest)
+        return sorted(jobs, key=lambda job: job["created_at"], reverse=True)
+    
+    def cleanup(self, max_age_days=14):
+        """מחיקת עבודות שהושלמו לפני יותר מ-max_age_days ימים."""
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=max_age_days)).isoformat(timespec="seconds")
+        for job in self.list_jobs(include_completed=True):
+            if job["status"] == "completed" and job["updated_at"] < cutoff:
+                shutil.rmtree(self.job_dir(job["job_id"]), ignore_errors=True)
+
+
+def run_ffmpeg_tool(args):
+    """הרצת ffmpeg/ffprobe והחזרת הפלט, עם הודעת שגיאה קריאה במקרה של כשל."""
+    try:
+        result = subprocess.run(args, capture_output=True, text=True, check=True)
+    except FileNotFoundError:
+        raise Exception(f"{args[0]} לא נמצא")
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"{args[0]} נכשל: {e.stderr.strip()}")
+    return result.stdout
+
+
+def probe_audio_duration_ms(audio_path):
+    """קריאת משך קובץ אודיו במילישניות ממטא-דאטה של ffprobe, ללא פענוח האודיו."""
+    output = run_ffmpeg_tool([
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        audio_path
+    ])
+    return int(float(output.strip()) * 1000)
+
+
+# מספר תהליכי ffmpeg שמקודדים מקטעים במקביל - כברירת מחדל כמספר הליבות.
+# המגבלה משותפת לכל העבודות בתהליך, כך שכמה עבודות במקביל לא מעמיסות יותר מהליבות הקיימות
+SEGMENT_ENCODE_WORKERS = int(os.environ.get("SEGMENT_ENCODE_WORKERS", str(os.cpu_count() or 1)))
+
+_segment_encode_slots = threading.BoundedSemaphore(SEGMENT_ENCODE_WORKERS)
+
+
+def cut_audio_segment(source_path, output_path, start_ms, end_ms, encoding_profile="original"):
+    """חיתוך מקטע מקובץ האודיו בקפיצה ישירה למיקום, בהעתקת זרם או בקידוד לפי פרופיל."""
+    with _segment_encode_slots, current_metrics().span("segment_export", profile=encoding_profile):
+        run_ffmpeg_tool([
+            "ffmpeg", "-v", "error", "-y",
+            "-ss", f"{start_ms / 1000:.3f}",
+            "-t", f"{(end_ms - start_ms) / 1000:.3f}",
+            "-i", source_path,
+            "-map", "0:a:0",
+            *ENCODING_PROFILES[encoding_profile]["ffmpeg_args"],
+            output_path
+        ])
+
+
+def ordered_parallel_map(function, items, workers=SEGMENT_ENCODE_WORKERS):
+    """הרצת function על הפריטים במאגר תהליכונים, כמחולל עצל שמחזיר את התוצאות לפי הסדר.
+    
+    לכל היותר workers פריטים רצים לפני הצרכן, כך שהמחולל לא מקדים את תור התמלול ביותר מכך.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="segment-encoder")
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(bind_metrics(function), item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # אם הצרכן הפסיק באמצע (למשל בשגיאה), פריטים שעוד לא התחילו לא ירוצו
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+# ניתוח שתיקות: האודיו מפוענח לקצב דגימה נמוך ומחולק למסגרות קצרות
+SILENCE_ANALYSIS_SAMPLE_RATE = 8000
+SILENCE_FRAME_MS = 20
+# חלון החיפוש לפני כל נקודת חיתוך, ואורך ההפסקה המינימלי שנחשב נקודת חיתוך נקייה
+SILENCE_SEARCH_WINDOW_MS = 60 * 1000
+SILENCE_MIN_PAUSE_MS = 300
+
+
+def compute_energy_envelope(audio_path, sample_rate=SILENCE_ANALYSIS_SAMPLE_RATE, frame_ms=SILENCE_FRAME_MS):
+    """מעטפת אנרגיה (dB לכל מסגרת) של האודיו, מפוענח דרך ffmpeg כ-PCM מונו בקצב דגימה נמוך.
+    
+    הפלט נקרא בחלקים, כך שגם הקלטה של כמה שעות לא נטענת כולה לזיכרון.
+    """
+    frame_samples = sample_rate * frame_ms // 1000
+    frame_bytes = frame_samples * 2
+    try:
+        process = subprocess.Popen(
+            ["ffmpeg", "-v", "error", "-i", audio_path, "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "-"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except FileNotFoundError:
+        raise Exception("ffmpeg לא נמצא")
+    
+    envelopes = []
+    leftover = b""
+    with process:
+        while True:
+            data = process.stdout.read(frame_bytes * 500)
+            if not data:
+                break
+            data = leftover + data
+            usable = len(data) - len(data) % frame_bytes
+            leftover = data[usable:]
+            frames = np.frombuffer(data[:usable], dtype=np.int16).astype(np.float32).reshape(-1, frame_samples)
+            envelopes.append(10 * np.log10(np.mean(frames * frames, axis=1) + 1.0))
+        stderr = process.stderr.read().decode("utf-8", errors="replace")
+    
+    if process.returncode != 0:
+        raise Exception(f"ffmpeg נכשל: {stderr.strip()}")
+    return np.concatenate(envelopes) if envelopes else np.zeros(0, dtype=np.float32)
+
+
+def fixed_segment_bounds(total_duration_ms, segment_length_ms, overlap_ms):
+    """חלוקה קבועה: מקטעים באורך קבוע עם חפיפה קבועה בכל גבול."""
+    effective_length_ms = segment_length_ms - overlap_ms
+    num_segments = max(1, (total_duration_ms - overlap_ms + effective_length_ms - 1) // effective_length_ms)
+    return [
+        [i * effective_length_ms, min(total_duration_ms, i * effective_length_ms + segment_length_ms), False]
+        for i in range(num_segments)
+    ]
+
+
+def silence_segment_bounds(envelope, total_duration_ms, segment_length_ms, overlap_ms,
+                           frame_ms=SILENCE_FRAME_MS, search_window_ms=SILENCE_SEARCH_WINDOW_MS,
+                           min_pause_ms=SILENCE_MIN_PAUSE_MS):
+    """חלוקה לפי שתיקות: כל מקטע נחתך בהפסקה הארוכה ביותר בחלון שלפני אורך המקטע המקסימלי.
+    
+    גבול שנחתך בהפסקה לא צריך חפיפה; רק כשאין הפסקה בחלון נחתך בנקודת היעד עם החפיפה הרגילה.
+    מחזיר רשימת [התחלה, סוף, האם נחתך בהפסקה] במילישניות.
+    """
+    if len(envelope) == 0:
+        return fixed_segment_bounds(total_duration_ms, segment_length_ms, overlap_ms)
+    
+    # סף השתיקה יחסי לרמות הרעש והדיבור של ההקלטה עצמה
+    noise_floor, speech_level = np.percentile(envelope, [10, 90])
+    silent = envelope < noise_floor + (speech_level - noise_floor) * 0.25
+    
+    # רצפי מסגרות שקטות (התחלה כוללת, סוף לא כולל), רק באורך של הפסקה אמיתית
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], silent.astype(np.int8), [0]))))
+    run_starts, run_ends = edges[0::2], edges[1::2]
+    min_frames = max(1, min_pause_ms // frame_ms)
+    long_enough = run_ends - run_starts >= min_frames
+    run_starts, run_ends = run_starts[long_enough], run_ends[long_enough]
+    
+    bounds = []
+    start_ms = 0
+    while total_duration_ms - start_ms > segment_length_ms:
+        target_ms = start_ms + segment_length_ms
+        # לא מחפשים לפני חצי מקטע, כדי שהמקטעים לא יתקצרו יותר מדי
+        window_start = max(start_ms + segment_length_ms // 2, target_ms - search_window_ms) // frame_ms
+        window_end = target_ms // frame_ms
+        lengths = np.minimum(run_ends, window_end) - np.maximum(run_starts, window_start)
+        
+        if lengths.size and lengths.max() >= min_frames:
+            # ההפסקה הארוכה ביותר; בשוויון - הקרובה ביותר לנקודת היעד, כדי שהמקטעים יישארו ארוכים
+            best = len(lengths) - 1 - int(np.argmax(lengths[::-1]))
+            pause_start = max(int(run_starts[best]), window_start)
+            pause_end = min(int(run_ends[best]), window_end)
+            cut_ms = (pause_start + pause_end) // 2 * frame_ms
+            bounds.append([start_ms, cut_ms, True])
+            start_ms = cut_ms
+        else:
+            bounds.append([start_ms, target_ms, False])
+            start_ms = target_ms - overlap_ms
+    
+    bounds.append([start_ms, total_duration_ms, False])
+    return bounds
+
+
+def segmentation_report(total_duration_ms, segment_length_ms, overlap_ms, bounds):
+    """השוואת שניות האודיו שנשלחות בחלוקה שנבחרה לעומת החלוקה הקבועה."""
+    fixed = fixed_segment_bounds(total_duration_ms, segment_length_ms, overlap_ms)
+    return {
+        "audio_seconds": total_duration_ms / 1000,
+        "fixed_segments": len(fixed),
+        "fixed_seconds_sent": sum(end - start for start, end, _ in fixed) / 1000,
+        "segments": len(bounds),
+        "seconds_sent": sum(end - start for start, end, _ in bounds) / 1000,
+        "cuts_at_pause": sum(1 for _, _, at_pause in bounds[:-1] if at_pause),
+        "boundaries": len(bounds) - 1
+    }
+
+
+class ProgressListener:
+    """ממשק ההתקדמות של הצינור.
+    
+    process_audio והפונקציות שמתחתיו מקבלים אובייקט כזה כמד התקדמות, כאזור סטטוס וכאזור תצוגה.
+    רכיבי Streamlit מקיימים את אותו ממשק, וכל מימוש אחר דורס רק את מה שמעניין אותו.
+    """
+    
+    def progress(self, value, text=None):
+        pass
+    
+    def message(self, level, message):
+        pass
+    
+    def info(self, message):
+        self.message("info", message)
+    
+    def warning(self, message):
+        self.message("warning", message)
+    
+    def error(self, message):
+        self.message("error", message)
+    
+    def success(self, message):
+        self.message("success", message)
+    
+    def text(self, message):
+        self.message("info", message)
+    
+    def markdown(self, body, unsafe_allow_html=False):
+        pass
+    
+    def empty(self):
+        pass
+
+
+class LocalAudioFile:
+    """קובץ אודיו מהדיסק בממשק של קובץ שהועלה ב-Streamlit (name ו-getbuffer), לשימוש מחוץ לממשק."""
+    
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+    
+    def getbuffer(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def process_audio(uploaded_file, api_key, projects, model, segment_length, overlap, custom_prompt, progress_bar, status_text, max_workers=1,
+                  encoding_profile="speech_mp3", measure_encoding=False, stream_output=False, preview_area=None,
+                  use_cache=True, job_id=None, silence_split=False, batch_processing=False, context_cache=True,
+                  metrics=None):
+    """עיבוד קובץ אודיו: טעינה, חלוקה, תמלול ושילוב - כעבודה שנשמרת על הדיסק וניתנת להמשך.
+    
+    מקטעי הזמן והמונים נרשמים ב-metrics (או במדידה חדשה) ונשמרים כ-timeline.json בספריית העבודה.
+    """
+    
+    # מנהל השימוש בטוקנים ומאגר העבודות המשותפים לכל העבודות
+    token_manager = get_token_usage_manager()
+    job_store = get_job_store()
+    
+    # רישום כל הפרויקטים
+    project_ids = [p.strip() for p in projects.split(",") if p.strip()]
+    if not project_ids:
+        status_text.error("שגיאה: יש לספק לפחות מזהה פרויקט אחד של Google Cloud")
+        return None
+    
+    for project_id in project_ids:
+        token_manager.register_project(project_id)
+    
+    # הצגת שימוש בטוקנים לפני התחלה
+    status_text.info("שימוש נוכחי בטוקנים בפרויקטים:")
+    for project in token_manager.get_usage_summary():
+        status_text.info(f"  {project['project_id']}: {project['daily_usage']}/{project['daily_limit']} טוקנים בשימוש ({project['percent_used']:.1f}%)")
+    
+    # יצירת עבודה חדשה (שמירת הקובץ המועלה לדיסק), או המשך עבודה קיימת
+    if job_id is None:
+        job_id = create_transcription_job(
+            uploaded_file, projects, model, segment_length, overlap, custom_prompt,
+            max_workers=max_workers, encoding_profile=encoding_profile, measure_encoding=measure_encoding,
+            stream_output=stream_output, use_cache=use_cache, silence_split=silence_split,
+            batch_processing=batch_processing, context_cache=context_cache
+        )
+    job = job_store.load(job_id)
+    
+    if metrics is None:
+        metrics = JobMetrics(job_id)
+    if job.get("source_write") and not job["segments"]:
+        metrics.record("file_write", job["source_write"]["seconds"], bytes=job["source_write"]["bytes"])
+    
+    # ספריית העבודה נשמרת גם אחרי סיום או קריסה, כך שמקטעים שהושלמו לא יעובדו שוב
+    with job_store.running(job_id) as temp_dir, use_metrics(metrics):
+        status_text.info(f"עבודה {job_id} בספריה: {temp_dir}")
+        
+        try:
+            mp3_path = job_store.source_path(job_id)
+            
+            status_text.info(f"מעבד קובץ אודיו: {job['file_name']}")
+            
+            # קריאת משך האודיו מהמטא-דאטה - ללא פענוח הקובץ כולו לזיכרון
+            try:
+                status_text.info("קורא את משך קובץ האודיו...")
+                with metrics.span("probe"):
+                    total_duration_ms = probe_audio_duration_ms(mp3_path)
+                status_text.info(f"משך קובץ האודיו: {total_duration_ms / 1000 / 60:.2f} דקות")
+            except Exception as e:
+                status_text.error(f"נכשל בקריאת קובץ האודיו: {e}. ודא שהתקנת ffmpeg ושהוא נמצא ב-PATH שלך.")
+                return None
+            
+            # חישוב גודל מקטע וחפיפה במילישניות
+            segment_length_ms = segment_length * 60 * 1000
+            overlap_ms = overlap * 1000
+            
+            if segment_length_ms <= overlap_ms:
+                status_text.error(f"אורך המקטע ({segment_length} דקות) חייב להיות גדול מהחפיפה ({overlap} שניות)")
+                return None
+            
+            # גבולות המקטעים נשמרים בעבודה, כך שהמשך עבודה חותך בדיוק באותן נקודות
+            bounds = job.get("segment_bounds")
+            if bounds is None:
+                if silence_split:
+                    # ניתוח ההפסקות מפענח את כל הקובץ לפני שאפשר לחתוך את המקטע הראשון
+                    status_text.info("מחפש הפסקות בדיבור לחיתוך המקטעים (מפענח את כל הקובץ לפני התחלת התמלול)...")
+                    with metrics.span("decode"):
+                        envelope = compute_energy_envelope(mp3_path)
+                    bounds = silence_segment_bounds(envelope, total_duration_ms, segment_length_ms, overlap_ms)
+                else:
+                    bounds = fixed_segment_bounds(total_duration_ms, segment_length_ms, overlap_ms)
+                num_segments = len(bounds)
+                report = segmentation_report(total_duration_ms, segment_length_ms, overlap_ms, bounds)
+                job_store.update(job_id, num_segments=num_segments, segment_bounds=bounds, segmentation=report)
+                with open(os.path.join(temp_dir, "segmentation_report.json"), "w", encoding="utf-8") as f:
+                    json.dump({**report, "bounds_ms": bounds}, f, indent=2)
+            else:
+                num_segments = len(bounds)
+                report = job["segmentation"]
+            
+            status_text.info(f"האודיו יחולק ל-{num_segments} מקטעים:")
+            status_text.info(f"- כל מקטע: מקסימום {segment_length} דקות")
+            if silence_split:
+                status_text.info(f"- {report['cuts_at_pause']}/{report['boundaries']} גבולות נחתכו בהפסקה ללא חפיפה; "
+                                 f"בשאר - חפיפה של {overlap} שניות")
+                status_text.info(f"- אודיו שיישלח: {report['seconds_sent'] / 60:.1f} דקות, לעומת "
+                                 f"{report['fixed_seconds_sent'] / 60:.1f} דקות בחלוקה קבועה")
+            else:
+                status_text.info(f"- חפיפה בין מקטעים: {overlap} שניות")
+            status_text.info(f"- קידוד לפני העלאה: {ENCODING_PROFILES[encoding_profile]['label']}, "
+                             f"{SEGMENT_ENCODE_WORKERS} מקטעים במקביל")
+            
+            profile = ENCODING_PROFILES[encoding_profile]
+            # במצב מדידה משווים לגודל המקטע בקידוד המקורי
+            measure_encoding = measure_encoding and encoding_profile != "original"
+            
+            # הגדרת מד התקדמות
+            progress_bar.progress(0, text="מתחיל עיבוד...")
+            
+            # יצירת מקטע אחד - כל מקטע נחתך בתהליך ffmpeg נפרד שקופץ למיקומו בקובץ המקורי
+            def export_segment(i):
+                # מקטע שכבר נחתך בהרצה קודמת של העבודה לא נחתך שוב
+                saved_segment = job_store.saved_segment(job, i)
+                if saved_segment is not None:
+                    return saved_segment
+                
+                start_ms, end_ms, _ = bounds[i]
+                
+                # חיתוך מקטע לקובץ זמני ישירות מהקובץ המקורי ויצירת תיאור המקטע
+                temp_file = os.path.join(temp_dir, f"segment_{i:03d}.{profile['extension']}")
+                cut_audio_segment(mp3_path, temp_file, start_ms, end_ms, encoding_profile)
+                
+                original_size_bytes = None
+                if measure_encoding:
+                    original_file = os.path.join(temp_dir, f"segment_{i:03d}_original.mp3")
+                    cut_audio_segment(mp3_path, original_file, start_ms, end_ms, "original")
+                    original_size_bytes = os.path.getsize(original_file)
+                    os.remove(original_file)
+                
+                return SegmentInfo.from_file(i, start_ms, end_ms, temp_file,
+                                             profile["mime_type"], original_size_bytes)
+            
+            # המקטעים מקודדים במקביל על כל הליבות, ומגיעים לתור התמלול לפי הסדר
+            # ורק מעט לפני שיש בו מקום - מחולל עצל כמו קודם
+            def export_segments():
+                return ordered_parallel_map(export_segment, range(num_segments))
+            
+            # עיבוד כל מקטע
+            processed_transcriptions = process_segments(
+                api_key, model, token_manager, project_ids, 
+                export_segments(), temp_dir, custom_prompt, 
+                progress_bar, status_text, num_segments,
+                max_workers=max_workers,
+                stream_output=stream_output,
+                preview_area=preview_area,
+                use_cache=use_cache,
+                checkpoint=lambda segment, stage, ok: job_store.checkpoint(job_id, segment, stage, ok),
+                batch_processing=batch_processing,
+                context_cache=context_cache
+            )
+            
+            if not processed_transcriptions:
+                status_text.error("לא הצלחנו לקבל תמלול לאף מקטע")
+                return None
+            
+            # שילוב כל התמלולים המעובדים
+            combined_text = combine_transcriptions(processed_transcriptions, bounds, progress_bar, status_text)
+            
+            # הצג שימוש בטוקנים מעודכן
+            status_text.info("\nשימוש בטוקנים מעודכן לאחר עיבוד:")
+            for project in token_manager.get_usage_summary():
+                status_text.info(f"  {project['project_id']}: {project['daily_usage']}/{project['daily_limit']} טוקנים בשימוש ({project['percent_used']:.1f}%)")
+            
+            job_store.complete(job_id, combined_text)
+            metrics.add("jobs_completed")
+            progress_bar.progress(1.0, text="הושלם בהצלחה!")
+            status_text.success("תמלול הקובץ הושלם בהצלחה")
+            
+            return combined_text
+            
+        except Exception as e:
+            status_text.error(f"שגיאה: {str(e)}")
+            traceback.print_exc()
+            token_manager.flush()
+            job_store.update(job_id, status="failed", error=str(e))
+            metrics.add("jobs_failed")
+            progress_bar.progress(1.0, text="נכשל")
+            return None
+        
+        finally:
+            # ציר הזמן של העבודה וקובץ המדדים המצטברים נכתבים גם כשהעבודה נכשלה
+            metrics.write_timeline(os.path.join(temp_dir, "timeline.json"))
+            metrics_registry.write()
+
+
+def create_transcription_job(uploaded_file, projects, model, segment_length, overlap, custom_prompt,
+                             max_workers=1, encoding_profile="speech_mp3", measure_encoding=False,
+                             stream_output=False, use_cache=True, silence_split=False, batch_processing=False,
+                             context_cache=True):
+    """שמירת הקובץ המועלה וההגדרות כעבודה חדשה במאגר העבודות (ללא מפתח ה-API)."""
+    return get_job_store().create_job(uploaded_file.name, uploaded_file.getbuffer(), {
+        "projects": projects,
+        "model": model,
+        "segment_length": segment_length,
+        "overlap": overlap,
+        "custom_prompt": custom_prompt,
+        "max_workers": max_workers,
+        "encoding_profile": encoding_profile,
+        "measure_encoding": measure_encoding,
+        "stream_output": stream_output,
+        "use_cache": use_cache,
+        "silence_split": silence_split,
+        "batch_processing": batch_processing,
+        "context_cache": context_cache
+    })
+
+
+def run_saved_job(job_id, api_key, progress_bar, status_text, preview_area=None, projects=None, metrics=None):
+    """הרצת עבודה שמורה עם ההגדרות שנשמרו בה."""
+    settings = get_job_store().load(job_id)["settings"]
+    
+    return process_audio(
+        None, api_key, projects or settings["projects"], settings["model"],
+        settings["segment_length"], settings["overlap"], settings["custom_prompt"],
+        progress_bar, status_text,
+        max_workers=settings["max_workers"],
+        encoding_profile=settings["encoding_profile"],
+        measure_encoding=settings["measure_encoding"],
+        stream_output=settings["stream_output"],
+        preview_area=preview_area if settings["stream_output"] else None,
+        use_cache=settings["use_cache"],
+        job_id=job_id,
+        silence_split=settings.get("silence_split", False),
+        batch_processing=settings.get("batch_processing", False),
+        context_cache=settings.get("context_cache", False),
+        metrics=metrics
+    )
+
+
+def resume_job(job_id, api_key, progress_bar, status_text, preview_area=None, projects=None, metrics=None):
+    """המשך עבודה שנקטעה מהמקטע הראשון שלא הושלם, עם ההגדרות שנשמרו בעבודה."""
+    first_incomplete = get_job_store().prepare_resume(job_id)
+    status_text.info(f"ממשיך את עבודה {job_id} ממקטע {first_incomplete + 1}")
+    return run_saved_job(job_id, api_key, progress_bar, status_text, preview_area=preview_area, projects=projects,
+                         metrics=metrics)
+
+
+class JobProgress(ProgressListener):
+    """מצב התקדמות של עבודה ברקע.
+    
+    מחליף את מד ההתקדמות, אזור הסטטוס ואזור התצוגה של Streamlit עבור תהליכוני העבודה,
+    והממשק קורא ממנו בכל רענון. listener (אופציונלי) מקבל גם הוא כל עדכון התקדמות והודעה.
+    """
+    
+    def __init__(self, job_id, file_name, listener=None):
+        self.job_id = job_id
+        self.listener = listener
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        self.state = "queued"
+        self.value = 0.0
+        self.progress_text = "ממתין בתור..."
+        self.messages = deque(maxlen=300)
+        self.preview = None
+        self.result = None
+        self.finished_at = None
+        self.metrics = JobMetrics(job_id)
+    
+    def progress(self, value, text=None):
+        with self._lock:
+            self.value = value
+            if text is not None:
+                self.progress_text = text
+        if self.listener:
+            self.listener.progress(value, text)
+    
+    def message(self, level, message):
+        with self._lock:
+            self.messages.append((level, message))
+        if self.listener:
+            self.listener.message(level, message)
+    
+    def markdown(self, body, unsafe_allow_html=False):
+        with self._lock:
+            self.preview = body
+    
+    def empty(self):
+        with self._lock:
+            self.preview = None
+    
+    def set_state(self, state, result=None):
+        with self._lock:
+            self.state = state
+            if result is not None:
+                self.result = result
+            if state in ("completed", "failed"):
+                self.finished_at = time.monotonic()
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "file_name": self.file_name,
+                "state": self.state,
+                "value": self.value,
+                "progress_text": self.progress_text,
+                "messages": list(self.messages),
+                "preview": self.preview,
+                "result": self.result,
+                "timing": self.metrics.summary(),
+                "counters": self.metrics.counter_values()
+            }
+
+
+# מספר העבודות שרצות במקביל בשרת; שאר העבודות ממתינות בתור
+TRANSCRIPTION_JOB_WORKERS = int(os.environ.get("TRANSCRIPTION_JOB_WORKERS", "2"))
+
+# עדיפויות עבודה - מספר נמוך יותר רץ קודם; בתוך אותה עדיפות הסדר הוא לפי זמן ההגשה
+JOB_PRIORITIES = {"גבוהה": 0, "רגילה": 1, "נמוכה": 2}
+
+# כמה זמן נשמר בזיכרון מצב של עבודה שהסתיימה; אחר כך המצב נקרא ממאגר העבודות שעל הדיסק
+JOB_PROGRESS_RETENTION_SECONDS = int(os.environ.get("JOB_PROGRESS_RETENTION_SECONDS", "1800"))
+
+
+class TranscriptionJobQueue:
+    """תור עבודות תמלול משותף לכל המשתמשים בשרת, עם מאגר קבוע של תהליכוני עבודה ברקע."""
+    
+    def __init__(self, num_workers=TRANSCRIPTION_JOB_WORKERS, retention_seconds=JOB_PROGRESS_RETENTION_SECONDS):
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self.retention_seconds = retention_seconds
+        self.jobs = {}
+        self.workers = [
+            threading.Thread(target=self._worker, name=f"transcription-worker-{n}", daemon=True)
+            for n in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+    
+    def submit(self, job_id, api_key, priority=JOB_PRIORITIES["רגילה"], resume=False, projects=None,
+               listener=None):
+        """הוספת עבודה לתור; מחזיר False אם העבודה כבר ממתינה או רצה."""
+        with self._lock:
+            self._evict_finished()
+            if self.is_active(job_id):
+                return False
+            job_store = get_job_store()
+            self.jobs[job_id] = JobProgress(job_id, job_store.load(job_id)["file_name"], listener=listener)
+            job_store.update(job_id, status="queued")
+            self._queue.put((priority, next(self._sequence), job_id, api_key, resume, projects))
+            return True
+    
+    def is_active(self, job_id):
+        progress = self.jobs.get(job_id)
+        return progress is not None and progress.state in ("queued", "running")
+    
+    def snapshot(self, job_id):
+        with self._lock:
+            self._evict_finished()
+            progress = self.jobs.get(job_id)
+        return progress.snapshot() if progress else self._stored_snapshot(job_id)
+    
+    def _evict_finished(self):
+        """הסרת עבודות שהסתיימו לפני יותר מזמן השמירה - התוצאה והיומן שלהן נשמרים במאגר העבודות."""
+        cutoff = time.monotonic() - self.retention_seconds
+        for job_id in [job_id for job_id, progress in self.jobs.items()
+                       if progress.finished_at is not None and progress.finished_at < cutoff]:
+            del self.jobs[job_id]
+    
+    def _stored_snapshot(self, job_id):
+        """מצב עבודה שהסתיימה והוסרה מהזיכרון, מתוך מאגר העבודות; None לעבודה שלא הסתיימה."""
+        job_store = get_job_store()
+        try:
+            job = job_store.load(job_id)
+        except (OSError, ValueError):
+            return None
+        if job["status"] not in ("completed", "failed"):
+            return None
+        
+        completed = job["status"] == "completed"
+        result = None
+        if completed:
+            with open(os.path.join(job_store.job_dir(job_id), "transcript.txt"), "r", encoding="utf-8") as f:
+                result = f.read()
+        return {
+            "job_id": job_id,
+            "file_name": job["file_name"],
+            "state": job["status"],
+            "value": 1.0,
+            "progress_text": "הושלם בהצלחה!" if completed else "נכשל",
+            "messages": [("error", f"שגיאה: {job['error']}")] if job.get("error") else [],
+            "preview": None,
+            "result": result,
+            "timing": [],
+            "counters": {}
+        }
+    
+    def queue_position(self, job_id):
+        """מקומה של עבודה ממתינה בתור (1 = הבאה בתור)."""
+        with self._queue.mutex:
+            waiting = sorted(self._queue.queue)
+        for position, entry in enumerate(waiting, 1):
+            if entry[2] == job_id:
+                return position
+        return None
+    
+    def _worker(self):
+        while True:
+            priority, _, job_id, api_key, resume, projects = self._queue.get()
+            progress = self.jobs[job_id]
+            # ציר הזמן מתחיל כשהעבודה מתחילה לרוץ, לא כשנכנסה לתור
+            progress.metrics = JobMetrics(job_id)
+            progress.set_state("running")
+            try:
+                run = resume_job if resume else run_saved_job
+                result = run(job_id, api_key, progress, progress, preview_area=progress, projects=projects,
+                             metrics=progress.metrics)
+                progress.set_state("completed" if result else "failed", result)
+            except Exception as e:
+                traceback.print_exc()
+                progress.error(f"שגיאה: {str(e)}")
+                progress.set_state("failed")
+            finally:
+                self._queue.task_done()
+
+
+# הוספת פונקציה חדשה ליצירת פרומפט אחיד
+def create_unified_prompt(base_prompt, segment_index, total_segments, is_processing=False):
+    """יצירת פרומפט אחיד לכל שלבי התהליך - תמלול ועיבוד"""
+    
+    prompt = base_prompt
+
+    # הוספת מידע על המיקום של המקטע
+    if segment_index == 0:
+        prompt += "\n\nזהו החלק הראשון של השיעור."
+    elif segment_index == total_segments - 1:
+        prompt += f"\n\nזהו החלק האחרון של השיעור (חלק {segment_index+1} מתוך {total_segments})."
+    else:
+        prompt += f"\n\nזהו חלק אמצעי של השיעור (חלק {segment_index+1} מתוך {total_segments})."
+    
+    # אם זה עבור שלב העיבוד, הוסף הנחיה ספציפית לעיבוד
+    if is_processing:
+        prompt += "\n\nנא לעבד את הטקסט הגולמי לתמלול נקי ומדויק תוך שמירה קפדנית על כל ההנחיות לעיל."
+    
+    return prompt
+
+
+# תקציב טוקני הפלט של בקשת עיבוד מקובצת - עם מרווח מתחת למגבלת הפלט של המודל
+BATCH_PROCESSING_TOKEN_BUDGET = int(os.environ.get(
+    "GEMINI_BATCH_TOKEN_BUDGET", str(int(PROCESSING_GENERATION_CONFIG["maxOutputTokens"] * 0.75))
+))
+
+# סמני התחלה וסוף של כל מקטע בבקשה מקובצת ובתשובה עליה
+BATCH_SEGMENT_START = "<<<מקטע {}>>>"
+BATCH_SEGMENT_END = "<<<סוף מקטע {}>>>"
+
+
+def estimate_batch_output_tokens(raw_text):
+    """אומדן שמרני לטוקני הפלט של עיבוד מקטע: טוקן לכל תו של הטקסט הגולמי."""
+    return len(raw_text)
+
+
+def create_batch_processing_prompt(base_prompt, items, total_segments):
+    """פרומפט עיבוד לכמה מקטעים בבקשה אחת; items היא רשימת (מספר מקטע, טקסט גולמי)."""
+    prompt = base_prompt
+    prompt += f"\n\nלהלן {len(items)} חלקים מתוך {total_segments} חלקי השיעור, כל חלק בין סמן התחלה לסמן סוף."
+    prompt += ("\n\nנא לעבד כל חלק בנפרד לתמלול נקי ומדויק תוך שמירה קפדנית על כל ההנחיות לעיל. "
+               "החזר כל חלק מעובד בין אותם סמנים בדיוק ובאותו סדר, בלי לאחד חלקים ובלי טקסט מחוץ לסמנים.")
+    for index, raw_text in items:
+        prompt += f"\n\n{BATCH_SEGMENT_START.format(index + 1)}\n{raw_text}\n{BATCH_SEGMENT_END.format(index + 1)}"
+    return prompt
+
+
+def split_batch_response(response_text, batch, min_length_ratio=0.3):
+    """פירוק תשובה מקובצת לפי הסמנים.
+    
+    מחזיר מילון {מספר מקטע: טקסט מעובד} רק למקטעים שנמצאו בתשובה ואינם קצרים באופן חשוד
+    ביחס לטקסט הגולמי; השאר יעובדו בנפרד.
+    """
+    pieces = {}
+    for segment, raw_text in batch:
+        match = re.search(
+            re.escape(BATCH_SEGMENT_START.format(segment.index + 1)) + r"\s*(.*?)\s*"
+            + re.escape(BATCH_SEGMENT_END.format(segment.index + 1)),
+            response_text, re.DOTALL
+        )
+        if match and len(match.group(1)) >= len(raw_text.strip()) * min_length_ratio:
+            pieces[segment.index] = match.group(1)
+    return pieces
+
+
+class QueuedStatus(ProgressListener):
+    """אזור סטטוס בטוח לתהליכונים - ההודעות נאספות בתור ומוצגות מהתהליכון הראשי."""
+    
+    def __init__(self, message_queue):
+        self.message_queue = message_queue
+    
+    def message(self, level, message):
+        self.message_queue.put((level, message))
+
+
+def drain_status_messages(message_queue, status_text):
+    """הצגת כל ההודעות שהצטברו בתור באזור הסטטוס."""
+    while True:
+        try:
+            level, message = message_queue.get_nowait()
+        except queue.Empty:
+            return
+        getattr(status_text, level)(message)
+
+
+# עדכון בפונקציה process_segments:
+def process_segments(api_key, model, token_manager, project_ids, segments, temp_dir, 
+                    custom_prompt, progress_bar, status_text, num_segments, max_workers=1,
+                    stream_output=False, preview_area=None, use_cache=True, checkpoint=None,
+                    batch_processing=False, context_cache=True):
+    """עיבוד מקטעי אודיו בצינור של חלוקה, תמלול ועיבוד LLM, עם מספר מקטעים במקביל בכל שלב."""
+    transcript_cache = get_transcript_cache()
+    
+    # פרומפט תמלול מותאם אישית או פרומפט ברירת מחדל
+    if not custom_prompt or custom_prompt.strip() == "":
+        # פרומפט תמלול ברירת מחדל
+        base_transcription_prompt = """# תפקידך הוא תמלול מקצועי של שיעורי תורה עם דגש על דיוק בפרטים
+## מטרה
+אתה מתמלל מקצועי המתמחה בתמלול שיעורי תורה בעברית. עליך לייצר טקסט מדויק במיוחד תוך שימוש בהקשר להבנה נכונה של מילים, שמות ומונחים.
+
+## הנחיות לדיוק מבוסס הקשר
+### שמות ומושגים
+- הקדש תשומת לב מיוחדת לשמות של רבנים, פרשנים, ספרים, וחכמי תורה
+- השתמש בהקשר השיעור כדי לזהות נכון שמות ומונחים שנשמעים לא ברורים
+- כשאתה נתקל במילים לא ברורות, התייחס להקשר המשפט, נושא השיחה, והטרמינולוגיה המתאימה
+- היה זהיר במיוחד עם מילים הומופוניות בעברית (מילים שנשמעות דומה) ובחר את המשמעות הנכונה על פי ההקשר
+- עבור מונחים מקצועיים (מונחי הלכה, מושגי ישיבה וכו'), השתמש בידע שלך כדי לזהות אותם במדויק
+- אם הדיון עוסק בפרשנות או טקסט מסוים, ודא שהמונחים הקשורים מתומללים בצורה מדויקת
+- שים לב להבחנות בין עברית לארמית בציטוטים
+
+### דיוק בציטוטים מהמקורות
+- היה מדויק במיוחד בציטוטי פסוקים מהתנ"ך
+- הקפד על דיוק בציטוטים מחז"ל, גמרא, משנה והלכה
+- סמן ציטוטים במירכאות ותקן שגיאות קלות בציטוט אם ישנן
+- התייחס להקשר התוכן כדי להבין נכון ציטוטים חלקיים או מרומזים
+
+### הבחנה בין דוברים
+- הבחן בבירור בין דברי הרב לשאלות הקהל
+- סמן שאלות מהקהל בפורמט: [שאלה מהקהל]: תוכן השאלה
+- סמן את תשובת הרב בפורמט: [הרב]: תוכן התשובה
+- אם יש דו-שיח ארוך, המשך לסמן כל חילופי דברים
+
+### תיקונים חכמים
+- הסר חזרות מיותרות ומילות מילוי אך שמור על דיוק בתוכן
+- תקן שגיאות דיבור רק כאשר ברור מההקשר מה הכוונה האמיתית
+- שמור על המשמעות המדויקת גם כשאתה מנסח מחדש משפטים לא ברורים
+- בהתלבטות בין שתי אפשרויות פירוש, בחר את זו המתאימה יותר להקשר התוכן
+
+## מה לא לעשות
+- אל תנחש שמות או מונחים כשאתה לא בטוח, במקום זאת השתמש בהקשר להבנה טובה יותר
+- אל תוסיף פרשנות או הסברים משלך
+- אל תשנה את סגנון הדיבור של הרב
+- אל תשמיט דוגמאות, מונחים מקצועיים או ציטוטים מורכבים גם אם הם קשים להבנה
+
+## פורמט הפלט הסופי
+הגש את התמלול כטקסט רציף עם חלוקה טבעית לפסקאות. השתמש ברווחים בין נושאים שונים ושמור על סדר הגיוני של הרעיונות.
+
+נא לתמלל את ההקלטה המצורפת באופן מדויק לפי ההנחיות לעיל."""
+    else:
+        # שימוש בפרומפט מותאם אישית
+        base_transcription_prompt = custom_prompt
+    
+    # ההוראות הקבועות נשמרות בשרת פעם אחת לעבודה, וכל בקשה שולחת רק את החלק המשתנה
+    prompt_context = PromptContext(model, base_transcription_prompt, use_server_cache=context_cache)
+    
+    # כל בקשה נשלחת לפרויקט הפנוי ביותר, כך שהתפוקה גדלה עם מספר הפרויקטים
+    if not token_manager.get_available_project(project_ids):
+        status_text.error("לא נמצאו פרויקטים עם מכסת טוקנים זמינה. נסה שוב מחר.")
+        return None
+    
+    # מפתח API אחד משותף לכל הפרויקטים, או מפתח לכל פרויקט לפי הסדר
+    api_keys = [key.strip() for key in api_key.split(",") if key.strip()]
+    try:
+        scheduler = ProjectScheduler(token_manager, project_ids, api_keys)
+    except Exception as e:
+        status_text.error(str(e))
+        return None
+    
+    status_text.info(f"מחלק את הבקשות בין {len(project_ids)} פרויקטים: {', '.join(project_ids)}")
+    
+    @contextmanager
+    def record_billed_usage(project_id, stage, estimated_tokens, usage):
+        """רישום השימוש של ניסיון אחד בסופו - גם כשנכשל או נקטע, אם הבקשה כבר הגיעה למודל.
+        
+        נרשם השימוש בפועל מ-usageMetadata, או האומדן אם התשובה לא כללה אותו; רק ניסיון
+        שהצליח משמש לכיול האומדן, כי ספירה של פלט שנקטע חלקית.
+        """
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            if usage:
+                token_manager.record_request(project_id, model, stage, estimated_tokens, usage,
+                                             calibrate=succeeded)
+    
+    # יצירת קובץ לוג לתיעוד הפרומפטים
+    log_file = os.path.join(temp_dir, "prompts_log.txt")
+    log_lock = threading.Lock()
+    
+    # פונקציה לתיעוד הפרומפטים
+    def log_prompt(segment_num, prompt_type, prompt_text):
+        with log_lock, open(log_file, "a", encoding="utf-8") as f:
+            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            f.write(f"[{timestamp}] --- מקטע {segment_num} - {prompt_type} ---\n")
+            f.write(prompt_text + "\n\n")
+    
+    # הודעות מתהליכוני העבודה נאספות בתור ומוצגות מהתהליכון הראשי
+    message_queue = queue.Queue()
+    
+    # הטקסט החלקי האחרון שהתקבל במצב זרימה, להצגה בממשק מהתהליכון הראשי
+    latest_preview = {}
+    preview_lock = threading.Lock()
+    
+    def update_preview(i, stage, text):
+        with preview_lock:
+            latest_preview.update(index=i, stage=stage, text=text, version=latest_preview.get("version", 0) + 1)
+    
+    def transcribe_segment(segment, segment_status):
+        """שלב 1: תמלול מקטע בודד ישירות עם Gemini - רץ בתהליכון עבודה."""
+        i = segment.index
+        raw_file = os.path.join(temp_dir, f"raw_{i:03d}.txt")
+        
+        # בדיקה אם תמלול גולמי כבר קיים (להמשך עיבוד שהופסק)
+        if os.path.exists(raw_file):
+            with open(raw_file, "r", encoding="utf-8") as f:
+                raw_text = f.read()
+            segment_status.info(f"  משתמש בתמלול גולמי קיים: {len(raw_text)} תווים")
+            return raw_text
+        
+        try:
+            segment_status.info(f"  גודל קובץ אודיו: {segment.size_bytes / 1024 / 1024:.2f} MB")
+            
+            # יצירת פרומפט אחיד לתמלול
+            transcription_prompt = create_unified_prompt(
+                base_transcription_prompt, i, num_segments, is_processing=False
+            )
+            
+            # תיעוד הפרומפט
+            log_prompt(i+1, "פרומפט תמלול", transcription_prompt)
+            
+            # עבודה זהה (אותו אודיו, פרומפט, מודל והגדרות) נלקחת מהמטמון ללא קריאת API
+            cache_key = transcript_cache.make_key(
+                "transcription", model, transcription_prompt, TRANSCRIPTION_GENERATION_CONFIG, segment.sha256
+            )
+            cached_text = transcript_cache.get(cache_key) if use_cache else None
+            if cached_text is not None:
+                with open(raw_file, "w", encoding="utf-8") as f:
+                    f.write(cached_text)
+                segment_status.info(f"  תמלול מקטע {i+1} נלקח מהמטמון: {len(cached_text)} תווים")
+                return cached_text
+            
+            # אומדן טוקנים על סמך משך האודיו מתיאור המקטע, מכויל לפי השימוש שנמדד בפועל
+            estimated_tokens = int(segment.duration_seconds * 5)  # אומדן בסיס: 5 טוקנים לשנייה
+            
+            upload_stats = {}
+            
+            def attempt(deadline):
+                """ניסיון תמלול אחד: כל ניסיון מקבל פרויקט מחדש, כך שניסיון חוזר עוקף פרויקט תקול."""
+                usage = {}
+                with scheduler.lease(token_manager.estimate_tokens(model, "transcription", estimated_tokens),
+                                     deadline) as project_id, record_billed_usage(project_id, "transcription",
+                                                                                  estimated_tokens, usage):
+                    segment_status.info(f"  משתמש בפרויקט {project_id} לתמלול מקטע {i+1}")
+                    project_api_key = scheduler.api_key(project_id)
+                    
+                    # בחירת דרך השליחה לפי גודל הבקשה: בתוך הבקשה, או העלאת קובץ והפניה אליו
+                    upload = inline_payload_size(segment.size_bytes, transcription_prompt) > INLINE_PAYLOAD_LIMIT_BYTES
+                    if upload:
+                        segment_status.info("  המקטע גדול מדי לשליחה בתוך הבקשה - מעלה כקובץ")
+                    
+                    # קובץ שהשרת כבר מחק (לפני שפג במאגר המקומי) נשכח מהמאגר ומועלה מחדש פעם אחת
+                    for upload_round in range(2):
+                        file_uri = None
+                        if upload:
+                            file_uri = upload_audio_file(project_api_key, segment.path, segment.mime_type,
+                                                         segment.sha256, segment_status)
+                        
+                        # קריאה ל-API של Gemini עם קובץ האודיו כנספח; ההוראות הקבועות מגיעות מ-prompt_context
+                        fields = prompt_context.request_fields(project_api_key, segment_status)
+                        try:
+                            with prompt_context.guard(project_api_key, fields):
+                                return transcribe_with_gemini(
+                                    project_api_key, model, create_unified_prompt("", i, num_segments).strip(),
+                                    segment.path, segment_status, mime_type=segment.mime_type,
+                                    upload_stats=upload_stats, file_uri=file_uri,
+                                    stream_to=raw_file if stream_output else None,
+                                    on_text=lambda text: update_preview(i, "תמלול", text),
+                                    usage=usage, prompt_fields=fields
+                                )
+                        except GeminiAPIError as e:
+                            if not file_uri or upload_round or e.status_code not in (400, 403, 404):
+                                raise
+                            segment_status.info(f"  הקובץ שהועלה אינו זמין בשרת ({e.status_code}) - מעלה מחדש")
+                            get_uploaded_file_registry().forget(project_api_key, segment.sha256)
+            
+            with current_metrics().span("transcription", segment=i + 1):
+                raw_text = gemini_retry_policy.run(attempt, segment_status, description=f"תמלול מקטע {i+1}")
+            
+            if segment.original_size_bytes is not None:
+                record_encoding_savings(segment, upload_stats, segment_status)
+            
+            # שמירת התמלול הגולמי
+            with open(raw_file, "w", encoding="utf-8") as f:
+                f.write(raw_text)
+            if use_cache:
+                transcript_cache.put(cache_key, raw_text)
+            
+            segment_status.info(f"  תמלול מקטע {i+1} הושלם: {len(raw_text)} תווים")
+        except Exception as e:
+            error_msg = f"שגיאה בתמלול מקטע {i+1}: {str(e)}"
+            segment_status.error(f"  {error_msg}")
+            raw_text = f"[שגיאה: {error_msg}]"
+            
+            # שמירת הודעת שגיאה
+            with open(raw_file, "w", encoding="utf-8") as f:
+                f.write(raw_text)
+        
+        return raw_text
+    
+    def processing_request(segment, raw_text):
+        """פרומפט העיבוד ומפתח המטמון של מקטע בודד."""
+        processing_prompt = create_unified_prompt(
+            base_transcription_prompt, segment.index, num_segments, is_processing=True
+        )
+        cache_key = transcript_cache.make_key(
+            "processing", model, processing_prompt, PROCESSING_GENERATION_CONFIG,
+            hashlib.sha256(raw_text.encode("utf-8")).hexdigest()
+        )
+        return processing_prompt, cache_key
+    
+    def generate_processed_text(request_text, estimated_total_tokens, segment_status, description,
+                                preview_index=None, stream_file=None):
+        """קריאת עיבוד טקסט ל-Gemini דרך המתזמן ומדיניות הניסיונות, עם רישום השימוש בטוקנים.
+        
+        request_text הוא החלק המשתנה של הבקשה; ההוראות הקבועות מגיעות מ-prompt_context.
+        """
+        def build_payload(request_prompt, fields):
+            return {
+                **fields,
+                "contents": [{"parts": [{"text": request_prompt}]}],
+                "generationConfig": PROCESSING_GENERATION_CONFIG
+            }
+        
+        def attempt(deadline):
+            """ניסיון עיבוד אחד בפרויקט שהמתזמן בחר עבורו."""
+            usage = {}
+            with scheduler.lease(token_manager.estimate_tokens(model, "processing", estimated_total_tokens),
+                                 deadline) as project_id, record_billed_usage(project_id, "processing",
+                                                                              estimated_total_tokens, usage):
+                segment_status.info(f"  משתמש בפרויקט {project_id} ל{description} עם מודל: {model}")
+                project_api_key = scheduler.api_key(project_id)
+                fields = prompt_context.request_fields(project_api_key, segment_status)
+                
+                with prompt_context.guard(project_api_key, fields):
+                    if stream_file:
+                        text = stream_generate_content(
+                            project_api_key, model,
+                            lambda partial_text: {
+                                "json": build_payload(with_resume_instructions(request_text, partial_text), fields)
+                            },
+                            stream_file, on_text=lambda text: update_preview(preview_index, "עיבוד", text),
+                            status=segment_status, usage=usage
+                        )
+                    else:
+                        response = gemini_client.post(f"v1beta/models/{model}:generateContent",
+                                                      api_key=project_api_key,
+                                                      json=build_payload(request_text, fields))
+                        
+                        if response.status_code != 200:
+                            raise GeminiAPIError.from_response(response)
+                        
+                        mark_billed(usage)
+                        response_data = response.json()
+                        merge_usage(usage, parse_usage_metadata(response_data))
+                        text = response_data["candidates"][0]["content"]["parts"][0]["text"]
+            return text
+        
+        with current_metrics().span("processing", description=description):
+            return gemini_retry_policy.run(attempt, segment_status, description=description)
+    
+    def save_processed(segment, processed_text, cache_key=None):
+        with open(os.path.join(temp_dir, f"processed_{segment.index:03d}.txt"), "w", encoding="utf-8") as f:
+            f.write(processed_text)
+        if cache_key is not None:
+            transcript_cache.put(cache_key, processed_text)
+    
+    def load_processed(segment, raw_text, segment_status):
+        """תוצאת עיבוד שכבר קיימת בספריית העבודה או במטמון, או None אם צריך לעבד."""
+        proc_file = os.path.join(temp_dir, f"processed_{segment.index:03d}.txt")
+        if os.path.exists(proc_file):
+            with open(proc_file, "r", encoding="utf-8") as f:
+                processed_text = f.read()
+            segment_status.info(f"  משתמש בתמלול מעובד קיים: {len(processed_text)} תווים")
+            return processed_text
+        
+        # תמלול גולמי שנכשל לא נשמר במטמון ולא נלקח ממנו
+        if use_cache and not raw_text.startswith("[שגיאה"):
+            cached_text = transcript_cache.get(processing_request(segment, raw_text)[1])
+            if cached_text is not None:
+                save_processed(segment, cached_text)
+                segment_status.info(f"  עיבוד מקטע {segment.index+1} נלקח מהמטמון: {len(cached_text)} תווים")
+                return cached_text
+        return None
+    
+    def process_raw_segment(segment, raw_text, segment_status):
+        """שלב 2: עיבוד התמלול הגולמי של מקטע בודד עם Gemini - רץ בתהליכון עבודה."""
+        i = segment.index
+        
+        # בדיקה אם תמלול מעובד כבר קיים, בספריית העבודה או במטמון
+        processed_text = load_processed(segment, raw_text, segment_status)
+        if processed_text is not None:
+            return processed_text
+        
+        try:
+            # יצירת פרומפט אחיד לעיבוד - אותו פרומפט בסיסי עם תוספת הנחיות עיבוד
+            processing_prompt, cache_key = processing_request(segment, raw_text)
+            
+            # תיעוד הפרומפט
+            log_prompt(i+1, "פרומפט עיבוד", processing_prompt)
+            
+            # הכנת הפרומפט המלא כולל הטקסט הגולמי
+            full_prompt = f"{processing_prompt}\n\nטקסט גולמי לעיבוד:\n{raw_text}"
+            
+            # אומדן בסיס לספירת טוקנים (1.5 טוקנים לתו), מכויל לפי השימוש שנמדד בפועל
+            estimated_input_tokens = int(len(full_prompt) * 1.5)
+            estimated_output_tokens = int(len(raw_text) * 2)  # פלט עשוי להיות גדול יותר בגלל פורמט
+            estimated_total_tokens = estimated_input_tokens + estimated_output_tokens
+            
+            request_text = (f"{create_unified_prompt('', i, num_segments, is_processing=True).strip()}"
+                            f"\n\nטקסט גולמי לעיבוד:\n{raw_text}")
+            processed_text = generate_processed_text(
+                request_text, estimated_total_tokens, segment_status, f"עיבוד מקטע {i+1}",
+                preview_index=i,
+                stream_file=os.path.join(temp_dir, f"processed_{i:03d}.txt") if stream_output else None
+            )
+            
+            # שמירת טקסט מעובד
+            cacheable = use_cache and not raw_text.startswith("[שגיאה")
+            save_processed(segment, processed_text, cache_key if cacheable else None)
+            
+            segment_status.info(f"  עיבוד מקטע {i+1} הושלם: {len(processed_text)} תווים")
+            
+        except Exception as e:
+            error_msg = f"שגיאה בעיבוד מקטע {i+1} עם LLM: {str(e)}"
+            segment_status.error(f"  {error_msg}")
+            processed_text = f"[שגיאה: {error_msg}]\n\n{raw_text}"
+            
+            # שמירת הודעת שגיאה וטקסט גולמי כחלופה
+            save_processed(segment, processed_text)
+        
+        return processed_text
+    
+    def process_raw_batch(batch, segment_status):
+        """עיבוד כמה תמלולים גולמיים בבקשה אחת; מקטע שלא חזר תקין בתשובה מעובד בנפרד."""
+        indices = [segment.index for segment, _ in batch]
+        label = ", ".join(str(index + 1) for index in indices)
+        batch_prompt = create_batch_processing_prompt(
+            base_transcription_prompt, [(segment.index, raw_text) for segment, raw_text in batch], num_segments
+        )
+        log_prompt(label, "פרומפט עיבוד מקובץ", batch_prompt)
+        
+        # הפרומפט הבסיסי נשלח פעם אחת לכל האצווה במקום פעם לכל מקטע
+        estimated_total_tokens = int(len(batch_prompt) * 1.5) + sum(int(len(raw_text) * 2) for _, raw_text in batch)
+        pieces = {}
+        try:
+            request_text = create_batch_processing_prompt(
+                "", [(segment.index, raw_text) for segment, raw_text in batch], num_segments
+            ).strip()
+            response_text = generate_processed_text(request_text, estimated_total_tokens, segment_status,
+                                                    f"עיבוד מקטעים {label} בבקשה אחת")
+            pieces = split_batch_response(response_text, batch)
+        except Exception as e:
+            segment_status.text(f"  עיבוד מקובץ של מקטעים {label} נכשל: {e}")
+        
+        results = []
+        for segment, raw_text in batch:
+            processed_text = pieces.get(segment.index)
+            if processed_text is None:
+                # מקטע חסר או חשוד בתשובה - עיבוד רגיל של המקטע לבדו
+                segment_status.text(f"  מקטע {segment.index+1} לא חזר תקין מהעיבוד המקובץ - מעבד בנפרד")
+                processed_text = process_raw_segment(segment, raw_text, segment_status)
+            else:
+                save_processed(segment, processed_text, processing_request(segment, raw_text)[1] if use_cache else None)
+                segment_status.info(f"  עיבוד מקטע {segment.index+1} הושלם (בעיבוד מקובץ): {len(processed_text)} תווים")
+            results.append((segment, processed_text))
+        return results
+    
+    # תוצאות מצב המדידה של פרופיל הקידוד
+    encoding_measurements = []
+    
+    def record_encoding_savings(segment, upload_stats, segment_status):
+        """חישוב הבתים וזמן ההעלאה שנחסכו במקטע לעומת הקידוד המקורי."""
+        saved_bytes = segment.original_size_bytes - segment.size_bytes
+        # הנתונים נשלחים ב-base64, ולכן כל 3 בתים הופכים ל-4 בבקשה
+        saved_payload_bytes = (saved_bytes + 2) // 3 * 4
+        saved_seconds = None
+        if upload_stats.get("upload_seconds") and upload_stats.get("request_bytes"):
+            seconds_per_byte = upload_stats["upload_seconds"] / upload_stats["request_bytes"]
+            saved_seconds = saved_payload_bytes * seconds_per_byte
+        
+        encoding_measurements.append({
+            "segment": segment.index + 1,
+            "original_bytes": segment.original_size_bytes,
+            "encoded_bytes": segment.size_bytes,
+            "saved_bytes": saved_bytes,
+            "saved_payload_bytes": saved_payload_bytes,
+            "upload_seconds": upload_stats.get("upload_seconds"),
+            "saved_upload_seconds": saved_seconds,
+        })
+        
+        saved_time_text = f", כ-{saved_seconds:.1f} שניות העלאה" if saved_seconds is not None else ""
+        segment_status.info(
+            f"  מדידת קידוד מקטע {segment.index+1}: {segment.original_size_bytes / 1024 / 1024:.2f} MB -> "
+            f"{segment.size_bytes / 1024 / 1024:.2f} MB (נחסכו {saved_payload_bytes / 1024 / 1024:.2f} MB בבקשה{saved_time_text})"
+        )
+    
+    max_workers = max(1, min(max_workers, num_segments))
+    if max_workers > 1:
+        status_text.info(f"מעבד עד {max_workers} מקטעים במקביל בכל שלב")
+    if batch_processing:
+        status_text.info(f"עיבוד מקובץ: כמה מקטעים בבקשה אחת, עד כ-{BATCH_PROCESSING_TOKEN_BUDGET} טוקני פלט לבקשה")
+    
+    # שלבי התמלול והעיבוד רצים במקביל, ולכן המאגר צריך חיבור לכל תהליכון עבודה
+    gemini_client.ensure_pool_size(max_workers * 2)
+    connection_stats_before = gemini_client.connection_stats()
+    cache_stats_before = transcript_cache.stats()
+    
+    # צינור עיבוד: חלוקה -> תמלול -> עיבוד. תורים חסומים בין השלבים שומרים על זיכרון קבוע
+    # ומאפשרים לייצא את המקטע הבא בזמן שהמקטע הנוכחי נשלח לתמלול
+    transcription_queue = queue.Queue(maxsize=max_workers)
+    processing_queue = queue.Queue(maxsize=max_workers)
+    stage_done = object()  # סימן סיום לתהליכוני השלב הבא
+    
+    # התוצאות נשמרות לפי מספר המקטע כך שהסדר נשמר גם כשמקטעים מסתיימים בסדר שונה
+    processed_transcriptions = [None] * num_segments
+    stage_counts = {"split": 0, "transcribed": 0, "processed": 0}
+    counts_lock = threading.Lock()
+    producer_errors = []
+    transcribers_left = [max_workers]
+    
+    def count_stage(stage, status, segment=None, ok=True):
+        with counts_lock:
+            stage_counts[stage] += 1
+        # שמירת מצב המקטע מיד עם סיום השלב, להמשך העבודה אחרי קריסה
+        if checkpoint and segment is not None:
+            try:
+                checkpoint(segment, stage, ok)
+            except Exception as e:
+                # כשל בשמירת המצב (למשל דיסק מלא) לא עוצר את הצינור - רק המשך עבודה יחזור על המקטע
+                status.error(f"  שמירת מצב מקטע {segment.index+1} נכשלה: {str(e)}")
+    
+    def split_stage():
+        """שלב החלוקה: יצוא מקטעים והעברתם לתור התמלול."""
+        status = QueuedStatus(message_queue)
+        try:
+            for segment in segments:
+                status.info(f"חולק מקטע {segment.index+1}/{num_segments}: "
+                            f"{segment.start_ms/1000/60:.2f}-{segment.end_ms/1000/60:.2f} דקות")
+                count_stage("split", status, segment)
+                transcription_queue.put(segment)
+        except Exception as e:
+            status.error(f"שגיאה בחלוקת האודיו למקטעים: {str(e)}")
+            producer_errors.append(e)
+        finally:
+            for _ in range(max_workers):
+                transcription_queue.put(stage_done)
+    
+    def transcription_stage():
+        """שלב התמלול: צריכת מקטעים מתור החלוקה והעברת התמלול הגולמי לתור העיבוד."""
+        status = QueuedStatus(message_queue)
+        try:
+            while True:
+                segment = transcription_queue.get()
+                if segment is stage_done:
+                    break
+                raw_text = transcribe_segment(segment, status)
+                count_stage("transcribed", status, segment, not raw_text.startswith("[שגיאה"))
+                processing_queue.put((segment, raw_text))
+        finally:
+            # התהליכון האחרון שמסיים מודיע לשלב העיבוד שאין עוד עבודה
+            with counts_lock:
+                transcribers_left[0] -= 1
+                last_transcriber = transcribers_left[0] == 0
+            if last_transcriber:
+                for _ in range(max_workers):
+                    processing_queue.put(stage_done)
+    
+    def processing_stage():
+        """שלב העיבוד: ניקוי התמלולים הגולמיים ושמירת התוצאה לפי מספר המקטע."""
+        status = QueuedStatus(message_queue)
+        
+        def store(segment, processed_text):
+            processed_transcriptions[segment.index] = processed_text
+            count_stage("processed", status, segment, not processed_text.startswith("[שגיאה"))
+        
+        def store_error(items, error):
+            """מקטעים שהעיבוד שלהם נכשל באופן לא צפוי נשמרים עם הודעת שגיאה והטקסט הגולמי, כמו בשלב התמלול."""
+            for segment, raw_text in items:
+                if processed_transcriptions[segment.index] is None:
+                    error_msg = f"שגיאה בעיבוד מקטע {segment.index+1}: {str(error)}"
+                    status.error(f"  {error_msg}")
+                    store(segment, f"[שגיאה: {error_msg}]\n\n{raw_text}")
+        
+        def flush(batch):
+            """שליחת האצווה; מקטע בודד נשלח בבקשה הרגילה, כך שלאותו קלט יש תמיד אותו פרומפט ומפתח מטמון."""
+            try:
+                if len(batch) == 1:
+                    store(batch[0][0], process_raw_segment(batch[0][0], batch[0][1], status))
+                    return
+                for done_segment, processed_text in process_raw_batch(batch, status):
+                    store(done_segment, processed_text)
+            except Exception as e:
+                store_error(batch, e)
+        
+        # במצב אצוות, כל תהליכון אוסף מקטעים עד לתקציב הטוקנים ושולח אותם יחד.
+        # כל כשל נתפס לכל מקטע בנפרד: תהליכון שמת היה משאיר את שלב התמלול חסום על התור המלא
+        batch, batch_tokens = [], 0
+        while True:
+            item = processing_queue.get()
+            if item is stage_done:
+                break
+            segment, raw_text = item
+            
+            try:
+                if not batch_processing or raw_text.startswith("[שגיאה"):
+                    store(segment, process_raw_segment(segment, raw_text, status))
+                    continue
+                processed_text = load_processed(segment, raw_text, status)
+                if processed_text is not None:
+                    store(segment, processed_text)
+                    continue
+                output_tokens = estimate_batch_output_tokens(raw_text)
+                # מקטע שחורג מהתקציב לבדו (למשל מקטעים ארוכים בברירת המחדל) לא נכנס לאצווה כלל
+                if output_tokens >= BATCH_PROCESSING_TOKEN_BUDGET:
+                    store(segment, process_raw_segment(segment, raw_text, status))
+                    continue
+            except Exception as e:
+                store_error([item], e)
+                continue
+            
+            if batch and batch_tokens + output_tokens > BATCH_PROCESSING_TOKEN_BUDGET:
+                flush(batch)
+                batch, batch_tokens = [], 0
+            batch.append((segment, raw_text))
+            batch_tokens += output_tokens
+        
+        if batch:
+            flush(batch)
+    
+    # כל תהליכון רושם למדידה של העבודה שיצרה אותו
+    threads = [threading.Thread(target=bind_metrics(split_stage), name="split", daemon=True)]
+    threads += [threading.Thread(target=bind_metrics(transcription_stage), name=f"transcribe-{n}", daemon=True)
+                for n in range(max_workers)]
+    threads += [threading.Thread(target=bind_metrics(processing_stage), name=f"process-{n}", daemon=True)
+                for n in range(max_workers)]
+    for thread in threads:
+        thread.start()
+    
+    # התהליכון הראשי מציג הודעות והתקדמות אמיתית לכל שלב עד שכל השלבים מסתיימים
+    shown_preview_version = 0
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(0.5)
+        drain_status_messages(message_queue, status_text)
+        
+        with preview_lock:
+            preview = dict(latest_preview)
+        if preview_area is not None and preview.get("version", 0) != shown_preview_version:
+            shown_preview_version = preview["version"]
+            preview_area.markdown(
+                f"<div style='direction: rtl; white-space: pre-wrap; max-height: 300px; overflow-y: auto;'>"
+                f"<b>{preview['stage']} מקטע {preview['index']+1} (חלקי):</b><br>{html.escape(preview['text'][-3000:])}</div>",
+                unsafe_allow_html=True
+            )
+        
+        with counts_lock:
+            split, transcribed, processed = stage_counts["split"], stage_counts["transcribed"], stage_counts["processed"]
+        overall_progress = (split + transcribed + processed) / (num_segments * 3)
+        progress_bar.progress(
+            min(overall_progress, 0.94),
+            text=f"חולקו {split}/{num_segments} | תומללו {transcribed}/{num_segments} | עובדו {processed}/{num_segments}"
+        )
+    
+    for thread in threads:
+        thread.join()
+    # ההוראות השמורות בשרת חיות רק כל עוד העבודה רצה
+    prompt_context.close()
+    drain_status_messages(message_queue, status_text)
+    if preview_area is not None:
+        preview_area.empty()
+    
+    if producer_errors:
+        raise producer_errors[0]
+    
+    # מקטע שלא הגיע לסוף הצינור (למשל תהליכון שנכשל באופן לא צפוי) מסומן כשגיאה ולא נשאר ריק
+    for index, processed_text in enumerate(processed_transcriptions):
+        if processed_text is None:
+            status_text.error(f"מקטע {index+1} לא עובד")
+            processed_transcriptions[index] = f"[שגיאה: מקטע {index+1} לא עובד]"
+    
+    connection_stats = gemini_client.connection_stats()
+    job_calls = connection_stats["calls"] - connection_stats_before["calls"]
+    job_reused = connection_stats["reused_connections"] - connection_stats_before["reused_connections"]
+    status_text.info(f"קריאות API: {job_calls}, מתוכן {job_reused} בחיבור קיים")
+    
+    if context_cache:
+        status_text.info(
+            f"הוראות קבועות בשרת: {prompt_context.stats['created']} נוצרו, {prompt_context.stats['failed']} נכשלו "
+            f"(נשלחו בתוך הבקשה), {prompt_context.stats['expired']} פגו במהלך העבודה"
+        )
+    
+    project_stats = scheduler.stats()
+    for project_id, stats in project_stats.items():
+        status_text.info(f"  פרויקט {project_id}: {stats['requests']} בקשות, {stats['errors']} שגיאות")
+    
+    cache_stats = transcript_cache.stats()
+    if use_cache:
+        status_text.info(
+            f"מטמון תמלולים: {cache_stats['hits'] - cache_stats_before['hits']} פגיעות, "
+            f"{cache_stats['misses'] - cache_stats_before['misses']} החטאות "
+            f"({cache_stats['bytes'] / 1024 / 1024:.1f} MB בשימוש)"
+        )
+    
+    # בסיום העיבוד, שמירת סיכום של כל הפרומפטים ששימשו
+    with open(os.path.join(temp_dir, "prompts_summary.txt"), "w", encoding="utf-8") as f:
+        f.write(f"בסיס הפרומפט: {base_transcription_prompt}\n\n")
+        f.write(f"פרויקטים בשימוש: {json.dumps(project_stats, ensure_ascii=False)}\n")
+        f.write(f"מספר מקטעים: {num_segments}\n")
+        f.write(f"מקטעים במקביל: {max_workers}\n")
+    
+    if encoding_measurements:
+        with open(os.path.join(temp_dir, "encoding_report.json"), "w", encoding="utf-8") as f:
+            json.dump(encoding_measurements, f, indent=2)
+        
+        total_original = sum(m["original_bytes"] for m in encoding_measurements)
+        total_encoded = sum(m["encoded_bytes"] for m in encoding_measurements)
+        total_saved_seconds = sum(m["saved_upload_seconds"] or 0 for m in encoding_measurements)
+        status_text.info(
+            f"סיכום מדידת קידוד: {total_original / 1024 / 1024:.2f} MB -> {total_encoded / 1024 / 1024:.2f} MB "
+            f"(פי {total_original / max(total_encoded, 1):.1f} פחות), כ-{total_saved_seconds:.1f} שניות העלאה נחסכו"
+        )
+    
+    # דוח כיול: כמה טוקנים נצרכו בפועל לעומת אומדן הבסיס, לכל מודל ושלב
+    calibration = token_manager.calibration_report()
+    with open(os.path.join(temp_dir, "token_calibration.json"), "w", encoding="utf-8") as f:
+        json.dump(calibration, f, indent=2)
+    for entry in calibration:
+        if entry["model"] == model and entry["ratio"] is not None:
+            status_text.info(
+                f"כיול אומדן טוקנים ({entry['stage']}): בפועל פי {entry['ratio']:.2f} מהאומדן "
+                f"לפי {entry['samples']} בקשות"
+            )
+    
+    return processed_transcriptions
+
+
+# ניקוד וטעמים, ואותיות סופיות שמנורמלות לצורתן הרגילה לצורך השוואת מילים
+_HEBREW_MARKS = re.compile(r"[֑-ׇ]")
+_NON_WORD = re.compile(r"[^\w]")
+_FINAL_LETTERS = str.maketrans("ךםןףץ", "כמנפצ")
+
+# גודל חלון ההשוואה (במילים) בסוף מקטע ובתחילת המקטע הבא, ואורך רצף המילים שמשמש עוגן
+STITCH_WINDOW_TOKENS = 300
+STITCH_NGRAM = 3
+STITCH_MIN_ANCHORS = 2
+# העוגנים צריכים לכסות לפחות כך מילים, ולפחות חלק כזה מהקטע שהיישור מסמן ככפול
+STITCH_MIN_SPAN_TOKENS = 8
+STITCH_MIN_COVERAGE = 0.4
+# סטייה מותרת בין אורך הקטע הכפול שנמצא לאורך הצפוי לפי חפיפת האודיו (במילים, או חלק יחסי)
+STITCH_POSITION_SLACK_TOKENS = 20
+STITCH_POSITION_TOLERANCE = 0.5
+
+
+def normalize_hebrew_token(token):
+    """נרמול מילה להשוואה: הסרת ניקוד, טעמים ופיסוק, ואותיות סופיות כרגילות."""
+    return _NON_WORD.sub("", _HEBREW_MARKS.sub("", token)).translate(_FINAL_LETTERS).lower()
+
+
+def tokenize_for_alignment(text, offset=0):
+    """רשימת (מילה מנורמלת, התחלה, סוף) לכל מילה בטקסט; מילים שהן פיסוק בלבד מדולגות."""
+    tokens = []
+    for match in re.finditer(r"\S+", text):
+        normalized = normalize_hebrew_token(match.group())
+        if normalized:
+            tokens.append((normalized, offset + match.start(), offset + match.end()))
+    return tokens
+
+
+def find_overlap(previous_text, next_text, expected_tokens=None, window_tokens=STITCH_WINDOW_TOKENS,
+                 ngram=STITCH_NGRAM, min_anchors=STITCH_MIN_ANCHORS, band=2):
+    """איתור הקטע שתומלל פעמיים בסוף המקטע הקודם ובתחילת המקטע הבא.
+    
+    עוגנים הם רצפים זהים של ngram מילים מנורמלות; העוגנים מצביעים על היסט בין הטקסטים,
+    וההיסט שמקבל הכי הרבה עוגנים (בטווח band מילים) נבחר. היישור מתקבל רק אם העוגנים מכסים
+    חלק ניכר מהקטע שהוא מסמן ככפול, ואם אורך הקטע קרוב ל-expected_tokens (כשידוע) - כך
+    ביטוי שחוזר בשני מקטעים שאינם חופפים לא גורם למחיקת טקסט. העבודה לינארית בגודל החלון.
+    מחזיר (מיקום חיתוך בטקסט הקודם, מיקום המשך בטקסט הבא) בתווים, או None אם לא נמצאה חפיפה.
+    """
+    # רק סוף הטקסט הקודם נבדק - מספיק בשביל החלון ונשאר מהיר גם בתמלול של שעות
+    tail_start = max(0, len(previous_text) - window_tokens * 20)
+    tail = tokenize_for_alignment(previous_text[tail_start:], tail_start)[-window_tokens:]
+    head = tokenize_for_alignment(next_text[:window_tokens * 20])[:window_tokens]
+    if len(tail) < ngram or len(head) < ngram:
+        return None
+    
+    tail_ngrams = {}
+    for i in range(len(tail) - ngram + 1):
+        tail_ngrams.setdefault(tuple(token for token, _, _ in tail[i:i + ngram]), []).append(i)
+    
+    anchors = []
+    for j in range(len(head) - ngram + 1):
+        for i in tail_ngrams.get(tuple(token for token, _, _ in head[j:j + ngram]), ()):
+            anchors.append((i - j, i, j))
+    if not anchors:
+        return None
+    
+    # ההיסט עם הכי הרבה עוגנים, בסובלנות של כמה מילים שנוספו או הושמטו באחד התמלולים
+    votes = {}
+    for shift, _, _ in anchors:
+        votes[shift] = votes.get(shift, 0) + 1
+    best_shift = max(votes, key=lambda shift: (sum(votes.get(shift + k, 0) for k in range(-band, band + 1)), shift))
+    aligned = [(i, j) for shift, i, j in anchors if abs(shift - best_shift) <= band]
+    if len(aligned) < min_anchors:
+        return None
+    
+    # הקטע שהיישור מסמן ככפול: מתחילת הטקסט הבא ועד המקום שבו נגמר הטקסט הקודם
+    duplicated_tokens = len(tail) - best_shift
+    if expected_tokens is not None:
+        slack = max(STITCH_POSITION_SLACK_TOKENS, expected_tokens * STITCH_POSITION_TOLERANCE)
+        if abs(duplicated_tokens - expected_tokens) > slack:
+            return None
+    covered = {j + k for _, j in aligned for k in range(ngram)}
+    if len(covered) < max(STITCH_MIN_SPAN_TOKENS, STITCH_MIN_COVERAGE * duplicated_tokens):
+        return None
+    
+    # החיתוך אחרי העוגן האחרון: עד אליו נשמר הטקסט הקודם, וממנו ממשיך הטקסט הבא
+    last_i, last_j = max(aligned)
+    cut_previous = tail[last_i + ngram - 1][2]
+    if last_j + ngram < len(head):
+        resume_next = head[last_j + ngram][1]
+    else:
+        resume_next = head[-1][2]
+    return cut_previous, resume_next
+
+
+def expected_overlap_tokens(previous_segment, next_segment, previous_bounds, next_bounds):
+    """מספר המילים שצפוי להופיע פעמיים בגבול, לפי החפיפה באודיו וקצב הדיבור בשני המקטעים.
+    
+    מחזיר 0 כשהמקטעים לא חופפים באודיו (למשל גבול שנחתך בהפסקה) - אז אין מה להסיר.
+    """
+    overlap_ms = previous_bounds[1] - next_bounds[0]
+    if overlap_ms <= 0:
+        return 0
+    duration_ms = (previous_bounds[1] - previous_bounds[0]) + (next_bounds[1] - next_bounds[0])
+    words = len(tokenize_for_alignment(previous_segment)) + len(tokenize_for_alignment(next_segment))
+    return max(1, round(overlap_ms * words / duration_ms))
+
+
+def stitch_segments(previous_text, next_text, expected_tokens=None):
+    """חיבור מקטע לטקסט שכבר שולב, תוך הסרת הקטע הכפול; מחזיר (טקסט, תווים שהוסרו).
+    
+    expected_tokens=0 מציין גבול ללא חפיפה באודיו - המקטעים מחוברים כמו שהם.
+    """
+    next_text = next_text.strip()
+    overlap = None
+    # מקטע שנכשל מכיל הודעת שגיאה ולא תמלול - אין מה ליישר
+    if (expected_tokens != 0 and not previous_text.lstrip().startswith("[שגיאה")
+            and not next_text.startswith("[שגיאה")):
+        overlap = find_overlap(previous_text, next_text, expected_tokens)
+    
+    if overlap is None:
+        separator = "" if previous_text.endswith("\n\n") else "\n\n"
+        return previous_text + separator + next_text, 0
+    
+    cut_previous, resume_next = overlap
+    removed = (len(previous_text) - cut_previous) + resume_next
+    remainder = next_text[resume_next:]
+    if not remainder.strip():
+        # המקטע הבא כולו כבר נמצא בטקסט הקודם
+        return previous_text, len(next_text)
+    return previous_text[:cut_previous] + " " + remainder.lstrip(), removed
+
+
+def combine_transcriptions(processed_transcriptions, segment_bounds, progress_bar, status_text):
+    """שילוב תמלולים מעובדים למסמך אחד קוהרנטי, עם הסרת הקטעים שתומללו פעמיים בחפיפה בין מקטעים.
+    
+    segment_bounds הם גבולות המקטעים ([התחלה, סוף, האם נחתך בהפסקה]); יישור נעשה רק בגבולות
+    שבהם האודיו באמת חופף.
+    """
+    status_text.info("\nמשלב תמלולים...")
+    progress_bar.progress(0.95, text="משלב את כל המקטעים...")
+    
+    if not processed_transcriptions:
+        status_text.error("אין תמלולים זמינים לשילוב")
+        return None
+    
+    # מקטע ראשון כנקודת התחלה
+    combined_text = processed_transcriptions[0].strip()
+    total_removed = 0
+    
+    for i, segment in enumerate(processed_transcriptions[1:], 1):
+        expected_tokens = expected_overlap_tokens(processed_transcriptions[i - 1], segment,
+                                                  segment_bounds[i - 1], segment_bounds[i])
+        # יישור סוף הטקסט הקודם עם תחילת המקטע והסרת הקטע הכפול
+        with current_metrics().span("stitch", boundary=i) as attributes:
+            combined_text, removed = stitch_segments(combined_text, segment, expected_tokens)
+            attributes["removed_chars"] = removed
+        total_removed += removed
+        if not expected_tokens:
+            status_text.info(f"  משלב מקטע {i+1}/{len(processed_transcriptions)}: גבול ללא חפיפה באודיו")
+        elif removed:
+            status_text.info(f"  משלב מקטע {i+1}/{len(processed_transcriptions)}: הוסרו {removed} תווים כפולים בגבול")
+        else:
+            status_text.info(f"  משלב מקטע {i+1}/{len(processed_transcriptions)}: לא נמצאה חפיפה")
+    
+    status_text.info(f"  אורך כולל: {len(combined_text)} תווים (הוסרו {total_removed} תווים כפולים)")
+    return combined_text